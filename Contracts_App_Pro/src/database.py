@@ -1,21 +1,740 @@
 import sqlite3
 import os
-from typing import Optional, List, Dict, Tuple, Any
-from datetime import datetime
+import threading
+import operator
+import queue
+import time
+import atexit
+import functools
+import itertools
+import bisect
+import sys
+import random
+import re
+import inspect
+import json
+import logging
+import logging.handlers
+import math
+from array import array
+from collections import deque
+from contextlib import contextmanager
+from typing import Optional, List, Dict, Tuple, Any, Sequence, Callable
+from datetime import datetime, date, timedelta, timezone
 from path_utils import get_app_root
-DB_PATH = os.path.join(get_app_root(), "data", "contracts.db")
+# CONTRACTS_DB_PATH points the app at another database (e.g. a generated dataset)
+DB_PATH = os.environ.get("CONTRACTS_DB_PATH") or os.path.join(get_app_root(), "data", "contracts.db")
 
 
-def get_connection():
-    """Get database connection"""
-    return sqlite3.connect(DB_PATH)
+# ============= CONNECTION MANAGEMENT =============
 
+# Connections are opened once and kept alive. The UI (main) thread shares a
+# single connection, every worker thread gets its own thread-local one.
+_shared_connection: Optional[sqlite3.Connection] = None
+_thread_local = threading.local()
+_open_connections: List[sqlite3.Connection] = []
+_connections_lock = threading.Lock()
+_generation = 0
 
-def init_db():
-    """Initialize database with all tables"""
+
+def _open_connection() -> sqlite3.Connection:
+    """Open a new connection and apply the per-connection settings once"""
+    con = sqlite3.connect(DB_PATH, timeout=5.0, check_same_thread=False, factory=_TimedConnection)
+    con.execute("PRAGMA journal_mode = WAL")
+    con.execute("PRAGMA busy_timeout = 5000")
+    con.execute("PRAGMA synchronous = NORMAL")
+    con.execute("PRAGMA cache_size = -20000")  # ~20 MB page cache
+    con.execute("PRAGMA mmap_size = 268435456")  # 256 MB
+    con.execute("PRAGMA temp_store = MEMORY")
+    _register_sql_functions(con)
+    with _connections_lock:
+        _open_connections.append(con)
+    return con
+
+
+def get_connection() -> sqlite3.Connection:
+    """Get the long-lived database connection for the current thread.
+
+    The connection must not be closed by callers; use close_connections()
+    when the database file has to be released (restore, reset, shutdown).
+    """
+    global _shared_connection
+    if threading.current_thread() is threading.main_thread():
+        if _shared_connection is None:
+            _shared_connection = _open_connection()
+        return _shared_connection
+
+    con = getattr(_thread_local, 'connection', None)
+    if con is None or getattr(_thread_local, 'generation', None) != _generation:
+        con = _open_connection()
+        _thread_local.connection = con
+        _thread_local.generation = _generation
+    return con
+
+
+@contextmanager
+def transaction():
+    """Run the enclosed writes as one transaction on the current thread's connection.
+
+    Commits on success and rolls back on any exception. Nested use joins the
+    outer transaction, so helpers can be combined into one atomic unit.
+    Only transactions opened here are joined (the connection keeps the
+    depth); one left open by a plain execute() is rolled back first.
+    """
     con = get_connection()
-    cur = con.cursor()
+    if con.transaction_depth:
+        con.transaction_depth += 1
+        try:
+            yield con
+        finally:
+            con.transaction_depth -= 1
+        return
+
+    if con.in_transaction:
+        con.rollback()
+    con.execute("BEGIN IMMEDIATE")
+    con.transaction_depth = 1
+    try:
+        yield con
+        con.commit()
+    except BaseException:
+        con.rollback()
+        raise
+    finally:
+        con.transaction_depth = 0
+        _note_write()
+
+
+# Retries of a write that found the database locked by another workstation
+# (on top of busy_timeout); the delay doubles each time, with jitter.
+WRITE_RETRIES = 4
+WRITE_RETRY_DELAY = 0.1
+
+
+def _is_busy(error: sqlite3.OperationalError) -> bool:
+    code = getattr(error, 'sqlite_errorcode', None)
+    if code is not None:
+        return code & 0xFF in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+    message = str(error)
+    return "locked" in message or "busy" in message
+
+
+def retry_on_busy(func):
+    """Re-run a write function when SQLite reports the database as busy/locked.
+
+    Inside an enclosing transaction the call is not retried on its own;
+    the error propagates so the outer unit of work is retried as a whole.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in range(WRITE_RETRIES + 1):
+            try:
+                return func(*args, **kwargs)
+            except sqlite3.OperationalError as e:
+                if attempt == WRITE_RETRIES or not _is_busy(e) or get_connection().transaction_depth:
+                    raise
+            time.sleep(WRITE_RETRY_DELAY * (2 ** attempt) * random.uniform(0.5, 1.5))
+    return wrapper
+
+
+class UpdateConflict(Exception):
+    """The row was changed by someone else since it was read (row_version mismatch)"""
+
+
+def close_connections():
+    """Close every pooled connection (all threads), after writing queued audit entries"""
+    global _shared_connection, _generation
+    flush_audit_log()
+    with _connections_lock:
+        connections = list(_open_connections)
+        _open_connections.clear()
+        _shared_connection = None
+        _generation += 1
+    with _query_cache_lock:
+        _query_cache.clear()
+    for con in connections:
+        try:
+            con.close()
+        except sqlite3.Error:
+            pass
+
+
+def set_db_path(path: str):
+    """Point the module at another database file (tests, benchmarks, tools)"""
+    global DB_PATH
+    close_connections()
+    DB_PATH = path
+
+
+def checkpoint_database():
+    """Fold the WAL file back into the main database file.
+
+    Needed before copying contracts.db on its own (backups), otherwise
+    recent commits that still live in contracts.db-wal would be missed.
+    """
+    try:
+        get_connection().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    except sqlite3.Error as e:
+        print(f"WAL checkpoint failed: {e}")
+
+
+def _remove_wal_files(db_path: str):
+    """Remove leftover -wal/-shm files next to a database file"""
+    for suffix in ("-wal", "-shm"):
+        try:
+            os.remove(db_path + suffix)
+        except OSError:
+            pass
+
+
+# ============= DIAGNOSTICS =============
+
+# Optional instrumentation, off by default. When enabled, every public
+# function of this module is timed (see _instrument_public_functions at the
+# end of the file), and so is every SQL statement it runs, through the
+# cursors of _TimedConnection. Calls slower than the threshold go to a
+# rotating log together with the time of each of their statements.
+SLOW_QUERY_THRESHOLD_MS = 200.0
+SLOW_QUERY_LOG_MAX_BYTES = 1024 * 1024
+SLOW_QUERY_LOG_BACKUPS = 3
+SLOW_QUERY_LOG_STATEMENTS = 50  # slowest statements written per logged call
+QUERY_STATS_SAMPLES = 1000  # latencies kept per function/statement for p95
+
+_diagnostics_enabled = False
+_slow_query_threshold_ms = SLOW_QUERY_THRESHOLD_MS
+_diag_local = threading.local()
+_query_stats: Dict[str, Dict[str, Any]] = {}
+_statement_stats: Dict[str, Dict[str, Any]] = {}
+_query_stats_lock = threading.Lock()
+_slow_query_logger = logging.getLogger("contracts.slow_queries")
+_slow_query_logger.propagate = False
+_SQL_COMMENT = re.compile(r"--[^\n]*")
+
+
+def _data_dir() -> str:
+    return os.path.dirname(DB_PATH)
+
+
+def get_slow_query_log_path() -> str:
+    """Path of the slow-query log (next to the database)"""
+    return os.path.join(_data_dir(), "slow_queries.log")
+
+
+def _statement_entry(sql: str) -> List:
+    """[sql, elapsed ms] of a statement, collected for the current timed call"""
+    entry = [sql, 0.0]
+    statements = getattr(_diag_local, 'statements', None)
+    if statements is not None:
+        statements.append(entry)
+    return entry
+
+
+class _TimedCursor(sqlite3.Cursor):
+    """Cursor that, while diagnostics are on, adds the time of execute and of
+    reading the rows to the statement it ran (trigger and FTS5 work included)"""
+    _diag_entry = None
+
+    def _step(self, method, *args):
+        entry = self._diag_entry
+        if entry is None:
+            return method(self, *args)
+        start = time.perf_counter()
+        try:
+            return method(self, *args)
+        finally:
+            entry[1] += (time.perf_counter() - start) * 1000
+
+    def execute(self, sql, parameters=()):
+        self._diag_entry = _statement_entry(sql) if _diagnostics_enabled else None
+        return self._step(sqlite3.Cursor.execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        self._diag_entry = _statement_entry(sql) if _diagnostics_enabled else None
+        return self._step(sqlite3.Cursor.executemany, sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        self._diag_entry = _statement_entry(sql_script) if _diagnostics_enabled else None
+        return self._step(sqlite3.Cursor.executescript, sql_script)
+
+    def fetchone(self):
+        return self._step(sqlite3.Cursor.fetchone)
+
+    def fetchmany(self, *args):
+        return self._step(sqlite3.Cursor.fetchmany, *args)
+
+    def fetchall(self):
+        return self._step(sqlite3.Cursor.fetchall)
+
+    def __iter__(self):
+        # Untimed iteration stays on the C iterator
+        return self if self._diag_entry is None else self._timed_rows()
+
+    def _timed_rows(self):
+        entry = self._diag_entry
+        while True:
+            start = time.perf_counter()
+            try:
+                row = sqlite3.Cursor.__next__(self)
+            except StopIteration:
+                return
+            finally:
+                entry[1] += (time.perf_counter() - start) * 1000
+            yield row
+
+
+class _TimedConnection(sqlite3.Connection):
+    """Connection whose cursors (including those of the execute shortcuts) are _TimedCursor"""
+
+    transaction_depth = 0  # nesting of transaction() blocks on this connection
+
+    def cursor(self, factory=_TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+
+def _statement_text(sql: str) -> str:
+    """One-line SQL without comments: the key of the statement statistics"""
+    return " ".join(_SQL_COMMENT.sub("", sql).split())
+
+
+def _record_timing(table: Dict[str, Dict[str, Any]], key: str, elapsed_ms: float):
+    stats = table.get(key)
+    if stats is None:
+        stats = table[key] = {
+            'count': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+            'samples': deque(maxlen=QUERY_STATS_SAMPLES),
+        }
+    stats['count'] += 1
+    stats['total_ms'] += elapsed_ms
+    stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+    stats['samples'].append(elapsed_ms)
+
+
+def _record_call(name: str, elapsed_ms: float, statements: List[List]):
+    with _query_stats_lock:
+        _record_timing(_query_stats, name, elapsed_ms)
+        for sql, statement_ms in statements:
+            _record_timing(_statement_stats, _statement_text(sql), statement_ms)
+
+
+def _log_slow_call(name: str, elapsed_ms: float, args: Tuple, statements: List[List]):
+    arg_text = ", ".join(repr(a) for a in args)
+    if len(arg_text) > 200:
+        arg_text = arg_text[:200] + "..."
+    lines = [f"{elapsed_ms:.1f} ms  {name}({arg_text})  {len(statements)} statements"]
+    # Slowest first, so the offending statement is at the top
+    slowest = sorted(statements, key=lambda entry: entry[1], reverse=True)[:SLOW_QUERY_LOG_STATEMENTS]
+    lines.extend(f"    {statement_ms:9.1f} ms  " + _statement_text(sql)[:500] for sql, statement_ms in slowest)
+    _slow_query_logger.warning("\n".join(lines))
+
+
+def _timed(func):
+    """Wrap a public function so that, while diagnostics are on, its calls are timed"""
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _diagnostics_enabled:
+            return func(*args, **kwargs)
+
+        depth = getattr(_diag_local, 'depth', 0)
+        if depth == 0:
+            _diag_local.statements = []
+        _diag_local.depth = depth + 1
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            _diag_local.depth = depth
+            if depth == 0:
+                # Only the outermost call records statements; they include the nested calls' ones
+                statements = _diag_local.statements or []
+                _diag_local.statements = None
+                _record_call(name, elapsed_ms, statements)
+                if elapsed_ms >= _slow_query_threshold_ms:
+                    _log_slow_call(name, elapsed_ms, args, statements)
+            else:
+                _record_call(name, elapsed_ms, [])
+    return wrapper
+
+
+def enable_diagnostics(threshold_ms: float = SLOW_QUERY_THRESHOLD_MS):
+    """Start timing database calls and logging the ones slower than threshold_ms"""
+    global _diagnostics_enabled, _slow_query_threshold_ms
+    _slow_query_threshold_ms = threshold_ms
+
+    log_path = get_slow_query_log_path()
+    for handler in list(_slow_query_logger.handlers):
+        if getattr(handler, 'baseFilename', None) != os.path.abspath(log_path):
+            _slow_query_logger.removeHandler(handler)
+            handler.close()
+    if not _slow_query_logger.handlers:
+        os.makedirs(os.path.dirname(log_path), exist_ok=True)
+        handler = logging.handlers.RotatingFileHandler(
+            log_path, maxBytes=SLOW_QUERY_LOG_MAX_BYTES, backupCount=SLOW_QUERY_LOG_BACKUPS, encoding='utf-8')
+        handler.setFormatter(logging.Formatter("%(asctime)s  %(message)s"))
+        _slow_query_logger.addHandler(handler)
+
+    _diagnostics_enabled = True
+
+
+def disable_diagnostics():
+    """Stop timing (collected statistics are kept)"""
+    global _diagnostics_enabled
+    _diagnostics_enabled = False
+
+
+def is_diagnostics_enabled() -> bool:
+    """Whether database calls are currently being timed"""
+    return _diagnostics_enabled
+
+
+def get_slow_query_threshold() -> float:
+    """Current slow-query threshold in milliseconds"""
+    return _slow_query_threshold_ms
+
+
+def _summarize_timings(table: Dict[str, Dict[str, Any]]) -> List[Dict[str, Any]]:
+    result = []
+    with _query_stats_lock:
+        for name, stats in table.items():
+            samples = sorted(stats['samples'])
+            p95 = samples[max(0, math.ceil(len(samples) * 0.95) - 1)] if samples else 0.0
+            result.append({
+                'name': name,
+                'count': stats['count'],
+                'total_ms': stats['total_ms'],
+                'avg_ms': stats['total_ms'] / stats['count'],
+                'p95_ms': p95,
+                'max_ms': stats['max_ms'],
+            })
+    result.sort(key=lambda r: r['total_ms'], reverse=True)
+    return result
+
+
+def get_query_stats() -> List[Dict[str, Any]]:
+    """Get per-function call statistics, slowest total first"""
+    return _summarize_timings(_query_stats)
+
+
+def get_statement_stats() -> List[Dict[str, Any]]:
+    """Get per-statement statistics ('name' is the SQL text), slowest total first"""
+    return _summarize_timings(_statement_stats)
+
+
+def reset_query_stats():
+    """Clear the collected call and statement statistics"""
+    with _query_stats_lock:
+        _query_stats.clear()
+        _statement_stats.clear()
+
+
+def _diagnostics_config_path() -> str:
+    return os.path.join(_data_dir(), "diagnostics.json")
+
+
+def load_diagnostics_config() -> Dict[str, Any]:
+    """Read the saved diagnostics settings ({'enabled', 'threshold_ms'})"""
+    config = {'enabled': False, 'threshold_ms': SLOW_QUERY_THRESHOLD_MS}
+    try:
+        with open(_diagnostics_config_path(), 'r', encoding='utf-8') as f:
+            config.update(json.load(f))
+    except (OSError, ValueError):
+        pass
+    return config
+
+
+def save_diagnostics_config(enabled: bool, threshold_ms: float):
+    """Persist the diagnostics settings and apply them"""
+    os.makedirs(_data_dir(), exist_ok=True)
+    with open(_diagnostics_config_path(), 'w', encoding='utf-8') as f:
+        json.dump({'enabled': enabled, 'threshold_ms': threshold_ms}, f, indent=2)
+    if enabled:
+        enable_diagnostics(threshold_ms)
+    else:
+        disable_diagnostics()
+
+
+# ============= QUERY CACHE =============
+
+# Results of the @cached_query functions, keyed by call. An entry is valid
+# while the data token of the reading connection is unchanged:
+#   PRAGMA data_version - bumped by commits of any *other* connection,
+#                         including other app instances on the same file
+#   total_changes       - rows written through this connection itself
+#   _write_counter      - commits made through transaction()
+_query_cache: Dict[Tuple, Tuple[Tuple, Any]] = {}
+_query_cache_lock = threading.Lock()
+_query_cache_stats = {'hits': 0, 'misses': 0}
+_write_counter = 0
+
+
+def _note_write():
+    """Mark cached query results as stale"""
+    global _write_counter
+    _write_counter += 1
+
+
+def _data_token(con: sqlite3.Connection) -> Tuple:
+    data_version = con.execute("PRAGMA data_version").fetchone()[0]
+    return (_generation, id(con), data_version, con.total_changes, _write_counter)
 
+
+def cached_query(func):
+    """Serve repeated calls of a read-only query function from memory until the data changes.
+
+    Returns a fresh list each time, so callers may modify it freely.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        key = (func.__name__, args, tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:
+            return func(*args, **kwargs)
+
+        con = get_connection()
+        if con.in_transaction:
+            # May see uncommitted rows that a rollback would take back
+            return func(*args, **kwargs)
+
+        token = _data_token(con)
+        with _query_cache_lock:
+            entry = _query_cache.get(key)
+            if entry is not None and entry[0] == token:
+                _query_cache_stats['hits'] += 1
+                return list(entry[1])
+            _query_cache_stats['misses'] += 1
+
+        # Token is taken before the query, so a concurrent write can only cause an extra miss
+        result = func(*args, **kwargs)
+        with _query_cache_lock:
+            _query_cache[key] = (token, result)
+        return list(result)
+    return wrapper
+
+
+def get_query_cache_stats() -> Dict[str, int]:
+    """Get query cache hit/miss counters (for diagnostics)"""
+    with _query_cache_lock:
+        return dict(_query_cache_stats, entries=len(_query_cache))
+
+
+def clear_query_cache():
+    """Drop all cached query results and reset the counters"""
+    with _query_cache_lock:
+        _query_cache.clear()
+        _query_cache_stats.update(hits=0, misses=0)
+
+
+# ============= TEXT NORMALIZATION =============
+
+# SQLite's lower()/LIKE fold ASCII only, so Cyrillic case is folded with
+# Python's str.casefold(). Every connection gets these helpers as SQL
+# functions, and the searchable client/device fields are stored a second
+# time in normalized form (NORMALIZED_COLUMNS), filled on every write.
+_NON_DIGITS = re.compile(r"\D")
+
+
+def fold_text(value: Any) -> str:
+    """Case-folded text for case-insensitive comparison ('' for None)"""
+    return str(value).casefold() if value is not None else ""
+
+
+def fold_eik(value: Any) -> str:
+    """Case-folded EIK/BULSTAT without whitespace"""
+    return "".join(fold_text(value).split())
+
+
+def digits_only(value: Any) -> str:
+    """Digits of a phone number only: '0888/728-005' -> '0888728005'"""
+    return _NON_DIGITS.sub("", str(value)) if value is not None else ""
+
+
+SQL_FUNCTIONS = {'casefold': fold_text, 'fold_eik': fold_eik, 'digits_only': digits_only}
+
+# table -> (normalized column, source column, SQL_FUNCTIONS name)
+NORMALIZED_COLUMNS = {
+    'clients': [
+        ('company_norm', 'company_name', 'casefold'),
+        ('address_norm', 'address', 'casefold'),
+        ('eik_norm', 'eik', 'fold_eik'),
+        ('phone1_digits', 'phone1', 'digits_only'),
+        ('phone2_digits', 'phone2', 'digits_only'),
+    ],
+    'devices': [
+        ('object_address_norm', 'object_address', 'casefold'),
+        ('object_phone_digits', 'object_phone', 'digits_only'),
+    ],
+}
+
+
+def _register_sql_functions(con: sqlite3.Connection):
+    for name, func in SQL_FUNCTIONS.items():
+        con.create_function(name, 1, func, deterministic=True)
+
+
+def _normalized_values(table: str, data: Dict[str, Any]) -> Tuple:
+    """Values of the table's normalized columns for a client/device dict"""
+    return tuple(SQL_FUNCTIONS[func](data.get(source)) for _, source, func in NORMALIZED_COLUMNS[table])
+
+
+def _normalized_assignments(table: str) -> str:
+    """'col = ?, ...' for the table's normalized columns (UPDATE statements)"""
+    return ", ".join(f"{column} = ?" for column, _, _ in NORMALIZED_COLUMNS[table])
+
+
+# ============= DATE NORMALIZATION =============
+
+# Formats accepted on input. Everything is stored as ISO YYYY-MM-DD.
+DATE_INPUT_FORMATS = (
+    '%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S',
+    '%d.%m.%Y', '%d.%m.%y', '%d/%m/%Y', '%d-%m-%Y', '%Y.%m.%d', '%Y/%m/%d',
+)
+EXCEL_EPOCH = date(1899, 12, 30)
+
+
+def normalize_date(value: Any) -> Optional[str]:
+    """Convert a date (object, Excel serial or text in a known format) to ISO YYYY-MM-DD.
+
+    Empty values become None. Raises ValueError for anything unrecognised.
+    """
+    if value is None:
+        return None
+    if hasattr(value, 'strftime'):
+        return value.strftime('%Y-%m-%d')
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        if 20000 <= value <= 80000:
+            return (EXCEL_EPOCH + timedelta(days=int(value))).isoformat()
+        raise ValueError(f"Невалидна дата: {value!r}")
+
+    text = str(value).strip()
+    if text.endswith('г.'):
+        text = text[:-2].strip()
+    if not text:
+        return None
+    for fmt in DATE_INPUT_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).strftime('%Y-%m-%d')
+        except ValueError:
+            pass
+    try:
+        return normalize_date(float(text))
+    except ValueError:
+        raise ValueError(f"Невалидна дата: {value!r}") from None
+
+
+def date_day(value: str) -> int:
+    """Day number of an ISO date, same as CAST(julianday(value) AS INTEGER) in SQL"""
+    return date.fromisoformat(value).toordinal() + 1721424
+
+
+# Generated day-number columns: julianday() gives NULL for anything that is
+# not an ISO date, so range queries on them only ever see valid dates.
+DATE_DAY_COLUMNS = [
+    ("clients", "contract_expiry_day", "contract_expiry"),
+    ("devices", "certificate_expiry_day", "certificate_expiry"),
+]
+
+# Last line of defence for writers that bypass normalize_date()
+DATE_VALIDATION_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS clients_dates_bi BEFORE INSERT ON clients
+    WHEN (new.contract_start IS NOT NULL AND date(new.contract_start) IS NOT new.contract_start)
+      OR (new.contract_expiry IS NOT NULL AND date(new.contract_expiry) IS NOT new.contract_expiry)
+    BEGIN
+        SELECT RAISE(ABORT, 'invalid contract date, expected YYYY-MM-DD');
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS clients_dates_bu BEFORE UPDATE OF contract_start, contract_expiry ON clients
+    WHEN (new.contract_start IS NOT old.contract_start AND new.contract_start IS NOT NULL
+          AND date(new.contract_start) IS NOT new.contract_start)
+      OR (new.contract_expiry IS NOT old.contract_expiry AND new.contract_expiry IS NOT NULL
+          AND date(new.contract_expiry) IS NOT new.contract_expiry)
+    BEGIN
+        SELECT RAISE(ABORT, 'invalid contract date, expected YYYY-MM-DD');
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS devices_dates_bi BEFORE INSERT ON devices
+    WHEN new.certificate_expiry IS NOT NULL AND date(new.certificate_expiry) IS NOT new.certificate_expiry
+    BEGIN
+        SELECT RAISE(ABORT, 'invalid certificate date, expected YYYY-MM-DD');
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS devices_dates_bu BEFORE UPDATE OF certificate_expiry ON devices
+    WHEN new.certificate_expiry IS NOT old.certificate_expiry AND new.certificate_expiry IS NOT NULL
+     AND date(new.certificate_expiry) IS NOT new.certificate_expiry
+    BEGIN
+        SELECT RAISE(ABORT, 'invalid certificate date, expected YYYY-MM-DD');
+    END
+    """,
+]
+
+
+def _normalize_stored_dates(cur):
+    """Rewrite non-ISO dates already in the database to YYYY-MM-DD.
+
+    Values that cannot be parsed are left untouched (their day column stays
+    NULL) and reported, so no data is lost.
+    """
+    targets = [
+        ("clients", "contract_start"),
+        ("clients", "contract_expiry"),
+        ("devices", "certificate_expiry"),
+    ]
+    for table, column in targets:
+        cur.execute(f"""
+            SELECT id, {column} FROM {table}
+            WHERE {column} IS NOT NULL AND date({column}) IS NOT {column}
+        """)
+        updates = []
+        bad_ids = []
+        for row_id, value in cur.fetchall():
+            try:
+                updates.append((normalize_date(value), row_id))
+            except ValueError:
+                bad_ids.append(row_id)
+        if updates:
+            cur.executemany(f"UPDATE {table} SET {column} = ? WHERE id = ?", updates)
+        if bad_ids:
+            print(f"Warning: {len(bad_ids)} unrecognised dates in {table}.{column} (ids {bad_ids[:10]})")
+
+
+def _create_date_columns(cur):
+    """v4: generated day-number columns, their indexes and the date validation triggers"""
+    for table, day_column, source in DATE_DAY_COLUMNS:
+        cur.execute(f"PRAGMA table_xinfo({table})")
+        if day_column not in [col[1] for col in cur.fetchall()]:
+            cur.execute(f"""
+                ALTER TABLE {table} ADD COLUMN {day_column} INTEGER
+                GENERATED ALWAYS AS (CAST(julianday({source}) AS INTEGER)) VIRTUAL
+            """)
+        cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{day_column} ON {table}({day_column})")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_client_status ON clients(status, contract_expiry_day)")
+
+    _normalize_stored_dates(cur)
+    for trigger_sql in DATE_VALIDATION_TRIGGERS:
+        cur.execute(trigger_sql)
+
+
+def _create_base_schema(cur):
+    """v1: core tables, the default admin and the column additions made before versioning.
+
+    Written with IF NOT EXISTS / column probes so it also upgrades databases
+    created by older releases, which all report user_version 0.
+    """
     # Clients table - stores company/contract information
     cur.execute("""
         CREATE TABLE IF NOT EXISTS clients (
@@ -105,8 +824,6 @@ def init_db():
             FOREIGN KEY (device_id) REFERENCES devices(id) ON DELETE CASCADE
         )
     """)
-
-    con.commit()
     
     # Check if we need to create default admin
     cur.execute("SELECT count(*) FROM users")
@@ -120,7 +837,6 @@ def init_db():
                 INSERT INTO users (username, password_hash, full_name)
                 VALUES (?, ?, ?)
             """, ("vladpos", pwd_hash, "Администратор"))
-            con.commit()
             
             # Save super admin to encrypted storage
             save_super_admin("vladpos", pwd_hash, "Администратор")
@@ -163,8 +879,6 @@ def init_db():
         if col_name not in audit_columns:
             cur.execute(f"ALTER TABLE audit_logs ADD COLUMN {col_name} {col_type}")
     
-    con.commit()
-    
     # Migration: Add role column to users
     cur.execute("PRAGMA table_info(users)")
     user_columns = [col[1] for col in cur.fetchall()]
@@ -173,7 +887,6 @@ def init_db():
         cur.execute("ALTER TABLE users ADD COLUMN role TEXT DEFAULT 'user'")
         # Set vladpos as admin
         cur.execute("UPDATE users SET role = 'admin' WHERE username = 'vladpos'")
-        con.commit()
         
     # Products table
     cur.execute("""
@@ -189,28 +902,576 @@ def init_db():
         )
     """)
 
-    con.commit()
-    con.close()
 
+def _create_contract_key(cur):
+    """v3: integer contract key and the contract number sequence"""
+    # Integer contract key, computed by SQLite from contract_number so it can
+    # never go out of sync. Its index serves the main table order
+    # (DEVICE_ROW_ORDER), keyset pagination and the next-number lookup.
+    cur.execute("PRAGMA table_xinfo(clients)")
+    client_columns = [col[1] for col in cur.fetchall()]
+    if "contract_key" not in client_columns:
+        cur.execute("""
+            ALTER TABLE clients ADD COLUMN contract_key INTEGER
+            GENERATED ALWAYS AS (CAST(contract_number AS INTEGER)) VIRTUAL
+        """)
+    cur.execute("DROP INDEX IF EXISTS idx_contract_order")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_contract_key ON clients(contract_key, contract_number)")
 
-# ============= CLIENT OPERATIONS =============
+    # Last allocated contract number (see allocate_contract_number)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS contract_sequence (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+    """)
 
-def add_client(data: Dict[str, Any]) -> int:
-    """Add new client and return client_id"""
-    con = get_connection()
-    cur = con.cursor()
-    
+
+# Searchable text of every device and its client, one FTS5 row per device
+# (rowid = devices.id). The trigram tokenizer gives substring matching and
+# folds case for Cyrillic as well as Latin text.
+SEARCH_INDEX_SOURCE = """
+    SELECT d.id, c.contract_number, c.company_name, c.eik,
+           c.phone1, c.phone2, d.object_phone,
+           c.address, d.object_address, d.serial_number
+    FROM devices d
+    JOIN clients c ON c.id = d.client_id
+"""
+
+SEARCH_INDEX_TRIGGERS = [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS device_search_ai AFTER INSERT ON devices BEGIN
+        INSERT INTO device_search (rowid, contract_number, company_name, eik,
+                                   phone1, phone2, object_phone,
+                                   address, object_address, serial_number)
+        {SEARCH_INDEX_SOURCE} WHERE d.id = new.id;
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS device_search_au AFTER UPDATE ON devices BEGIN
+        DELETE FROM device_search WHERE rowid = old.id;
+        INSERT INTO device_search (rowid, contract_number, company_name, eik,
+                                   phone1, phone2, object_phone,
+                                   address, object_address, serial_number)
+        {SEARCH_INDEX_SOURCE} WHERE d.id = new.id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS device_search_ad AFTER DELETE ON devices BEGIN
+        DELETE FROM device_search WHERE rowid = old.id;
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS device_search_cu AFTER UPDATE ON clients BEGIN
+        DELETE FROM device_search WHERE rowid IN (SELECT id FROM devices WHERE client_id = old.id);
+        INSERT INTO device_search (rowid, contract_number, company_name, eik,
+                                   phone1, phone2, object_phone,
+                                   address, object_address, serial_number)
+        {SEARCH_INDEX_SOURCE} WHERE d.client_id = new.id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS device_search_cd AFTER DELETE ON clients BEGIN
+        DELETE FROM device_search WHERE rowid IN (SELECT id FROM devices WHERE client_id = old.id);
+    END
+    """,
+]
+
+
+def _create_search_index(cur):
+    """v2: device_search FTS5 table and its sync triggers (idempotent)"""
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'device_search'")
+    exists = cur.fetchone() is not None
+
+    cur.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS device_search USING fts5(
+            contract_number, company_name, eik,
+            phone1, phone2, object_phone,
+            address, object_address, serial_number,
+            tokenize = 'trigram'
+        )
+    """)
+    for trigger_sql in SEARCH_INDEX_TRIGGERS:
+        cur.execute(trigger_sql)
+
+    if not exists:
+        # First run on an existing database: index the rows already there
+        cur.execute(f"""
+            INSERT INTO device_search (rowid, contract_number, company_name, eik,
+                                       phone1, phone2, object_phone,
+                                       address, object_address, serial_number)
+            {SEARCH_INDEX_SOURCE}
+        """)
+
+
+# Dashboard counters kept up to date by triggers, read by get_db_stats().
+# kind 'status': clients per status, kind 'model': devices per model,
+# kind 'revenue': maintenance_price of devices per client status (stotinki).
+# A NULL key is stored as STATS_NULL_KEY (key is part of the primary key).
+STATS_NULL_KEY = '<NULL>'
+STATS_ROLLUP_UPSERT = """
+    ON CONFLICT(kind, key) DO UPDATE SET
+        count = count + excluded.count,
+        amount = amount + excluded.amount
+"""
+
+
+def _stats_add(kind: str, key_sql: str, count_sql: str, amount_sql: str = "0", source: str = "",
+               null_key: str = STATS_NULL_KEY) -> str:
+    """One trigger statement adding count/amount to a stats_rollup row"""
+    return f"""
+        INSERT INTO stats_rollup (kind, key, count, amount)
+        SELECT '{kind}', COALESCE({key_sql}, '{null_key}'), {count_sql}, {amount_sql} {source}
+        {STATS_ROLLUP_UPSERT};"""
+
+
+def _cents(price_sql: str) -> str:
+    return f"CAST(ROUND(COALESCE({price_sql}, 0) * 100) AS INTEGER)"
+
+
+def _stats_rollup_triggers(null_key: str) -> List[str]:
+    """Triggers that maintain stats_rollup, storing NULL keys as null_key"""
+    return [
+        f"""
+        CREATE TRIGGER IF NOT EXISTS stats_clients_ai AFTER INSERT ON clients BEGIN
+            {_stats_add('status', 'new.status', '1', source='WHERE 1', null_key=null_key)}
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS stats_clients_ad AFTER DELETE ON clients BEGIN
+            {_stats_add('status', 'old.status', '-1', source='WHERE 1', null_key=null_key)}
+            {_stats_add('revenue', 'old.status', '0', f"-COALESCE(SUM({_cents('maintenance_price')}), 0)",
+                        'FROM devices WHERE client_id = old.id', null_key=null_key)}
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS stats_clients_au AFTER UPDATE OF status ON clients
+        WHEN new.status IS NOT old.status BEGIN
+            {_stats_add('status', 'old.status', '-1', source='WHERE 1', null_key=null_key)}
+            {_stats_add('status', 'new.status', '1', source='WHERE 1', null_key=null_key)}
+            {_stats_add('revenue', 'old.status', '0', f"-COALESCE(SUM({_cents('maintenance_price')}), 0)",
+                        'FROM devices WHERE client_id = new.id', null_key=null_key)}
+            {_stats_add('revenue', 'new.status', '0', f"COALESCE(SUM({_cents('maintenance_price')}), 0)",
+                        'FROM devices WHERE client_id = new.id', null_key=null_key)}
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS stats_devices_ai AFTER INSERT ON devices BEGIN
+            {_stats_add('model', 'new.model', '1', source='WHERE 1', null_key=null_key)}
+            {_stats_add('revenue', 'status', '0', _cents('new.maintenance_price'),
+                        'FROM clients WHERE id = new.client_id', null_key=null_key)}
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS stats_devices_ad AFTER DELETE ON devices BEGIN
+            {_stats_add('model', 'old.model', '-1', source='WHERE 1', null_key=null_key)}
+            {_stats_add('revenue', 'status', '0', '-' + _cents('old.maintenance_price'),
+                        'FROM clients WHERE id = old.client_id', null_key=null_key)}
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS stats_devices_au AFTER UPDATE OF model, maintenance_price, client_id ON devices BEGIN
+            {_stats_add('model', 'old.model', '-1', source='WHERE 1', null_key=null_key)}
+            {_stats_add('model', 'new.model', '1', source='WHERE 1', null_key=null_key)}
+            {_stats_add('revenue', 'status', '0', '-' + _cents('old.maintenance_price'),
+                        'FROM clients WHERE id = old.client_id', null_key=null_key)}
+            {_stats_add('revenue', 'status', '0', _cents('new.maintenance_price'),
+                        'FROM clients WHERE id = new.client_id', null_key=null_key)}
+        END
+        """,
+    ]
+
+
+# v5 stored NULL models under '' (merged with empty ones); v13 keeps them apart
+STATS_ROLLUP_TRIGGERS = _stats_rollup_triggers('')
+STATS_ROLLUP_TRIGGERS_V13 = _stats_rollup_triggers(STATS_NULL_KEY)
+
+
+def rebuild_stats_rollup():
+    """Recompute stats_rollup from clients and devices (the triggers keep it current afterwards)"""
+    with transaction() as con:
+        con.execute("DELETE FROM stats_rollup")
+        con.execute(f"""
+            INSERT INTO stats_rollup (kind, key, count, amount)
+            SELECT 'status', COALESCE(status, '{STATS_NULL_KEY}'), COUNT(*), 0 FROM clients GROUP BY 1, 2
+        """)
+        con.execute(f"""
+            INSERT INTO stats_rollup (kind, key, count, amount)
+            SELECT 'model', COALESCE(model, '{STATS_NULL_KEY}'), COUNT(*), 0 FROM devices GROUP BY 1, 2
+        """)
+        con.execute(f"""
+            INSERT INTO stats_rollup (kind, key, count, amount)
+            SELECT 'revenue', COALESCE(c.status, '{STATS_NULL_KEY}'), 0, SUM({_cents('d.maintenance_price')})
+            FROM devices d JOIN clients c ON c.id = d.client_id
+            GROUP BY 1, 2
+        """)
+
+
+def _create_stats_rollup(cur):
+    """v5: stats_rollup table and the triggers that maintain it"""
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS stats_rollup (
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            amount INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (kind, key)
+        ) WITHOUT ROWID
+    """)
+    for trigger_sql in STATS_ROLLUP_TRIGGERS:
+        cur.execute(trigger_sql)
+    rebuild_stats_rollup()
+
+
+def _create_audit_indexes(cur):
+    """v6: covering indexes for get_device_history / get_contract_history"""
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_audit_device
+        ON audit_logs(device_id, id, timestamp, username, action, details)
+    """)
     cur.execute("""
-        INSERT INTO clients (
-            contract_number, status, contract_start, contract_expiry,
-            company_name, city, postal_code, address,
-            eik, vat_registered, mol, phone1, phone2
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
+        CREATE INDEX IF NOT EXISTS idx_audit_contract
+        ON audit_logs(contract_number, id, timestamp, username, action, details)
+    """)
+
+
+# Row change log: one entry per inserted/updated/deleted client or device,
+# read by ChangeWatcher to patch other workstations' open tables.
+CHANGE_LOG_TRIGGERS = [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS change_{table}_a{op.lower()} AFTER {event} ON {table} BEGIN
+        INSERT INTO change_log (entity, entity_id, op) VALUES ('{entity}', {row}.id, '{op}');
+    END
+    """
+    for table, entity in (("devices", "device"), ("clients", "client"))
+    for event, op, row in (("INSERT", "I", "new"), ("UPDATE", "U", "new"), ("DELETE", "D", "old"))
+]
+
+
+def _create_change_log(cur):
+    """v7: change_log table and the triggers that fill it"""
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS change_log (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            entity TEXT NOT NULL,
+            entity_id INTEGER NOT NULL,
+            op TEXT NOT NULL,
+            changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    for trigger_sql in CHANGE_LOG_TRIGGERS:
+        cur.execute(trigger_sql)
+
+
+def _create_repair_index(cur):
+    """v8: index for get_repair_history (found by check_query_plans.py)"""
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_repair_device ON repair_history(device_id, repair_date)")
+
+
+def _create_maintenance_log(cur):
+    """v9: maintenance_log with one row per run_maintenance()"""
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS maintenance_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            started_at TIMESTAMP NOT NULL,
+            duration_ms REAL,
+            size_before INTEGER,
+            size_after INTEGER,
+            freelist_before INTEGER,
+            freelist_after INTEGER,
+            quick_check TEXT,
+            steps TEXT,
+            errors TEXT
+        )
+    """)
+
+
+def _create_row_versions(cur):
+    """v10: row_version on clients, devices and products for compare-and-swap updates"""
+    for table in ('clients', 'devices', 'products'):
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN row_version INTEGER NOT NULL DEFAULT 1")
+
+
+# Search index rows built from the normalized columns (v11): text is
+# case-folded and phones are digits only, matching search_devices().
+NORMALIZED_SEARCH_SOURCE = """
+    SELECT d.id, c.contract_number, c.company_norm, c.eik_norm,
+           c.phone1_digits, c.phone2_digits, d.object_phone_digits,
+           c.address_norm, d.object_address_norm, d.serial_number
+    FROM devices d
+    JOIN clients c ON c.id = d.client_id
+"""
+NORMALIZED_SEARCH_TRIGGERS = [
+    sql.replace(SEARCH_INDEX_SOURCE, NORMALIZED_SEARCH_SOURCE) for sql in SEARCH_INDEX_TRIGGERS
+]
+
+
+def _fill_normalized_columns(cur):
+    for table, columns in NORMALIZED_COLUMNS.items():
+        assignments = ", ".join(f"{column} = {func}({source})" for column, source, func in columns)
+        cur.execute(f"UPDATE {table} SET {assignments}")
+
+
+def rebuild_normalized_columns():
+    """Recompute the normalized columns (after rows were written with raw SQL, e.g. by tools)"""
+    with transaction() as con:
+        _fill_normalized_columns(con.cursor())
+
+
+def _create_normalized_columns(cur):
+    """v11: normalized copies of the searchable fields; device_search re-indexed from them"""
+    for table, columns in NORMALIZED_COLUMNS.items():
+        cur.execute(f"PRAGMA table_info({table})")
+        existing = {row[1] for row in cur.fetchall()}
+        for column, _, _ in columns:
+            if column not in existing:
+                cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} TEXT")
+    
+    # Swap the search triggers first, so filling the columns does not re-index row by row
+    for trigger_sql in SEARCH_INDEX_TRIGGERS:
+        name = trigger_sql.split("IF NOT EXISTS", 1)[1].split()[0]
+        cur.execute(f"DROP TRIGGER IF EXISTS {name}")
+    # The fill changes no data: keep it out of change_log, or every workstation reloads every row
+    for name in ("change_devices_au", "change_clients_au"):
+        cur.execute(f"DROP TRIGGER IF EXISTS {name}")
+    _fill_normalized_columns(cur)
+    for trigger_sql in NORMALIZED_SEARCH_TRIGGERS + CHANGE_LOG_TRIGGERS:
+        cur.execute(trigger_sql)
+    
+    cur.execute("DELETE FROM device_search")
+    cur.execute(f"""
+        INSERT INTO device_search (rowid, contract_number, company_name, eik,
+                                   phone1, phone2, object_phone,
+                                   address, object_address, serial_number)
+        {NORMALIZED_SEARCH_SOURCE}
+    """)
+
+
+# Data columns per table: an UPDATE OF any of them is a real change, one
+# that only touches bookkeeping (updated_at, normalized columns) is not.
+CHANGE_TRACKED_COLUMNS = {
+    'clients': ("contract_number, status, contract_start, contract_expiry, company_name, city, "
+                "postal_code, address, eik, vat_registered, mol, phone1, phone2"),
+    'devices': ("client_id, fdrid, euro_done, object_name, object_address, object_phone, model, "
+                "certificate_number, certificate_expiry, serial_number, fiscal_memory, nra_report_enabled, "
+                "nra_report_month, nra_td, bim_model, bim_date, maintenance_price, last_renewed_at"),
+    'products': "name, category, price, currency, description",
+}
+CHANGE_LOG_ENTITIES = {'clients': 'client', 'devices': 'device', 'products': 'product'}
+
+# v12 change log: updates are logged only when a data column changes, and products are logged too
+CHANGE_LOG_TRIGGERS_V12 = [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS change_{table}_a{op.lower()} AFTER {event} ON {table} BEGIN
+        INSERT INTO change_log (entity, entity_id, op) VALUES ('{entity}', {row}.id, '{op}');
+    END
+    """
+    for table, entity in CHANGE_LOG_ENTITIES.items()
+    for event, op, row in (("INSERT", "I", "new"),
+                           (f"UPDATE OF {CHANGE_TRACKED_COLUMNS[table]}", "U", "new"),
+                           ("DELETE", "D", "old"))
+]
+
+# v12 search triggers: re-index only when an indexed column changes, so
+# bookkeeping updates (updated_at, row_version) leave device_search alone
+SEARCH_INDEX_TRIGGERS_V12 = [
+    sql.replace("AFTER UPDATE ON devices",
+                "AFTER UPDATE OF client_id, serial_number, object_phone_digits, object_address_norm ON devices")
+       .replace("AFTER UPDATE ON clients",
+                "AFTER UPDATE OF contract_number, company_norm, eik_norm, phone1_digits, phone2_digits, "
+                "address_norm ON clients")
+    for sql in NORMALIZED_SEARCH_TRIGGERS
+]
+
+# updated_at for writers that do not set it themselves (the app's own
+# INSERT/UPDATE statements do, so these only fire for other tools)
+TOUCH_TRIGGERS = [
+    trigger_sql
+    for table, columns in CHANGE_TRACKED_COLUMNS.items()
+    for trigger_sql in (
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_touch_ai AFTER INSERT ON {table}
+        WHEN new.updated_at IS NULL
+        BEGIN
+            UPDATE {table} SET updated_at = CURRENT_TIMESTAMP WHERE id = new.id;
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_touch_au AFTER UPDATE OF {columns} ON {table}
+        WHEN new.updated_at IS old.updated_at
+        BEGIN
+            UPDATE {table} SET updated_at = CURRENT_TIMESTAMP WHERE id = new.id;
+        END
+        """,
+    )
+]
+
+
+def _create_change_timestamps(cur):
+    """v12: trigger-maintained updated_at, narrower change_log/search triggers, change_log time index"""
+    for name in ("change_devices_au", "change_clients_au", "device_search_au", "device_search_cu"):
+        cur.execute(f"DROP TRIGGER IF EXISTS {name}")
+    for trigger_sql in CHANGE_LOG_TRIGGERS_V12 + SEARCH_INDEX_TRIGGERS_V12:
+        cur.execute(trigger_sql)
+    
+    cur.execute("PRAGMA table_info(clients)")
+    if "updated_at" not in {row[1] for row in cur.fetchall()}:
+        cur.execute("ALTER TABLE clients ADD COLUMN updated_at TIMESTAMP")
+    for table in CHANGE_TRACKED_COLUMNS:
+        cur.execute(f"UPDATE {table} SET updated_at = CURRENT_TIMESTAMP WHERE updated_at IS NULL")
+    cur.execute("UPDATE devices SET created_at = updated_at WHERE created_at IS NULL")
+    for trigger_sql in TOUCH_TRIGGERS:
+        cur.execute(trigger_sql)
+    
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_change_log_time ON change_log(changed_at)")
+
+
+def _create_stats_null_keys(cur):
+    """v13: keep NULL and empty models apart in stats_rollup"""
+    for table in ("clients", "devices"):
+        for event in ("ai", "ad", "au"):
+            cur.execute(f"DROP TRIGGER IF EXISTS stats_{table}_{event}")
+    for trigger_sql in STATS_ROLLUP_TRIGGERS_V13:
+        cur.execute(trigger_sql)
+    rebuild_stats_rollup()
+
+
+# ============= SCHEMA MIGRATIONS =============
+
+# Ordered (version, migration) pairs. The database stores the last applied
+# version in PRAGMA user_version; append new steps, never reorder or edit
+# applied ones.
+SCHEMA_MIGRATIONS = [
+    (1, _create_base_schema),
+    (2, _create_search_index),
+    (3, _create_contract_key),
+    (4, _create_date_columns),
+    (5, _create_stats_rollup),
+    (6, _create_audit_indexes),
+    (7, _create_change_log),
+    (8, _create_repair_index),
+    (9, _create_maintenance_log),
+    (10, _create_row_versions),
+    (11, _create_normalized_columns),
+    (12, _create_change_timestamps),
+    (13, _create_stats_null_keys),
+]
+SCHEMA_VERSION = SCHEMA_MIGRATIONS[-1][0]
+
+
+def get_schema_version() -> int:
+    """Get the schema version stored in the database"""
+    return get_connection().execute("PRAGMA user_version").fetchone()[0]
+
+
+def init_db():
+    """Bring the database schema up to date (a single PRAGMA read if it already is)"""
+    if get_schema_version() >= SCHEMA_VERSION:
+        return
+
+    con = get_connection()
+    if get_schema_version() == 0 and not con.execute("SELECT 1 FROM sqlite_master").fetchone():
+        # New file: enable incremental vacuum while it is still empty (VACUUM is instant)
+        con.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        con.execute("VACUUM")
+
+    for version, migrate in SCHEMA_MIGRATIONS:
+        with transaction() as con:
+            # Re-check under the write lock: another instance may have migrated meanwhile
+            if get_schema_version() >= version:
+                continue
+            migrate(con.cursor())
+            con.execute(f"PRAGMA user_version = {version}")
+
+
+# ============= ROW RECORDS =============
+
+class Record(tuple):
+    """Read-only row with attribute and dict-style access (namedtuple-style).
+
+    The values are the tuple fetched by sqlite3; field names, attribute
+    properties and getters live on the record type, which is shared by every
+    row of a query. Existing callers keep using row['x'] / row.get('x');
+    as_dict() gives a mutable copy.
+    """
+    __slots__ = ()
+    _fields: Tuple[str, ...] = ()
+    _getters: Dict[str, Any] = {}
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self._getters[key](self)
+        return tuple.__getitem__(self, key)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        getter = self._getters.get(key)
+        return default if getter is None else getter(self)
+
+    def keys(self) -> Tuple[str, ...]:
+        return self._fields
+
+    def items(self) -> List[Tuple[str, Any]]:
+        return [(key, self._getters[key](self)) for key in self._fields]
+
+    def as_dict(self) -> Dict[str, Any]:
+        return dict(self.items())
+
+    def __contains__(self, key) -> bool:
+        return key in self._getters
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.as_dict()!r})"
+
+
+_record_types: Dict[Tuple[str, Tuple[str, ...]], type] = {}
+
+
+def _bool_getter(index: int):
+    return lambda row: bool(tuple.__getitem__(row, index))
+
+
+def _projection(name: str, field_map: Dict[str, str], columns: Optional[Sequence[str]] = None,
+                bools: Tuple[str, ...] = ()) -> Tuple[str, type]:
+    """SELECT list and Record type for the requested columns (all of field_map when None)"""
+    fields = tuple(field_map) if columns is None else tuple(columns)
+    unknown = [f for f in fields if f not in field_map]
+    if unknown:
+        raise ValueError(f"Unknown columns for {name}: {unknown}")
+
+    record_type = _record_types.get((name, fields))
+    if record_type is None:
+        getters = {f: _bool_getter(i) if f in bools else operator.itemgetter(i)
+                   for i, f in enumerate(fields)}
+        namespace = {'__slots__': (), '_fields': fields, '_getters': getters}
+        namespace.update({f: property(getter) for f, getter in getters.items()})
+        record_type = type(name, (Record,), namespace)
+        _record_types[(name, fields)] = record_type
+    return ", ".join(field_map[f] for f in fields), record_type
+
+
+# ============= CLIENT OPERATIONS =============
+
+CLIENT_INSERT_SQL = """
+    INSERT INTO clients (
+        contract_number, status, contract_start, contract_expiry,
+        company_name, city, postal_code, address,
+        eik, vat_registered, mol, phone1, phone2,
+        company_norm, address_norm, eik_norm, phone1_digits, phone2_digits,
+        updated_at
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+"""
+
+
+def _client_params(data: Dict[str, Any]) -> Tuple:
+    """Build the CLIENT_INSERT_SQL parameters from a client dict"""
+    return (
         data.get('contract_number'),
         data.get('status'),
-        data.get('contract_start'),
-        data.get('contract_expiry'),
+        normalize_date(data.get('contract_start')),
+        normalize_date(data.get('contract_expiry')),
         data.get('company_name'),
         data.get('city'),
         data.get('postal_code'),
@@ -220,88 +1481,101 @@ def add_client(data: Dict[str, Any]) -> int:
         data.get('mol'),
         data.get('phone1'),
         data.get('phone2')
-    ))
+    ) + _normalized_values('clients', data)
+
+
+def _bulk_insert(table: str, sql: str, params: List[Tuple]) -> List[int]:
+    """executemany() an INSERT and return the ids of the new rows in order.
+
+    Must run inside transaction(): BEGIN IMMEDIATE holds the write lock, so
+    the AUTOINCREMENT ids handed out by one executemany() are consecutive.
+    """
+    if not params:
+        return []
+    con = get_connection()
+    con.executemany(sql, params)
+    last_id = con.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (table,)).fetchone()[0]
+    return list(range(last_id - len(params) + 1, last_id + 1))
+
+
+@retry_on_busy
+def add_client(data: Dict[str, Any]) -> int:
+    """Add new client and return client_id"""
+    con = get_connection()
+    cur = con.cursor()
     
-    client_id = cur.lastrowid
-    con.commit()
-    con.close()
+    with transaction():
+        cur.execute(CLIENT_INSERT_SQL, _client_params(data))
+        client_id = cur.lastrowid
     return client_id
 
 
-def get_client_by_contract(contract_number: str) -> Optional[Dict[str, Any]]:
+@retry_on_busy
+def add_clients_bulk(clients: List[Dict[str, Any]]) -> List[int]:
+    """Add many clients in one transaction and return their ids (same order)"""
+    with transaction():
+        return _bulk_insert('clients', CLIENT_INSERT_SQL, [_client_params(c) for c in clients])
+
+
+CLIENT_FIELDS = {
+    'id': 'id', 'contract_number': 'contract_number', 'status': 'status',
+    'contract_start': 'contract_start', 'contract_expiry': 'contract_expiry',
+    'company_name': 'company_name', 'city': 'city', 'postal_code': 'postal_code',
+    'address': 'address', 'eik': 'eik', 'vat_registered': 'vat_registered',
+    'mol': 'mol', 'phone1': 'phone1', 'phone2': 'phone2', 'row_version': 'row_version',
+}
+
+
+def get_client_by_contract(contract_number: str, columns: Optional[Sequence[str]] = None) -> Optional[Record]:
     """Get client data by contract number"""
     con = get_connection()
     cur = con.cursor()
+    select, record = _projection('ClientRecord', CLIENT_FIELDS, columns)
     
-    cur.execute("""
-        SELECT id, contract_number, status, contract_start, contract_expiry,
-               company_name, city, postal_code, address,
-               eik, vat_registered, mol, phone1, phone2
+    cur.execute(f"""
+        SELECT {select}
         FROM clients
         WHERE contract_number = ?
         LIMIT 1
     """, (contract_number,))
     
     row = cur.fetchone()
-    con.close()
-    
-    if row:
-        return {
-            'id': row[0],
-            'contract_number': row[1],
-            'status': row[2],
-            'contract_start': row[3],
-            'contract_expiry': row[4],
-            'company_name': row[5],
-            'city': row[6],
-            'postal_code': row[7],
-            'address': row[8],
-            'eik': row[9],
-            'vat_registered': row[10],
-            'mol': row[11],
-            'phone1': row[12],
-            'phone2': row[13]
-        }
-    return None
+    return record(row) if row else None
+
+
+CONTRACT_DEVICE_FIELDS = {
+    'id': 'd.id', 'fdrid': 'd.fdrid', 'euro_done': 'd.euro_done',
+    'object_name': 'd.object_name', 'object_address': 'd.object_address',
+    'object_phone': 'd.object_phone', 'model': 'd.model',
+    'certificate_number': 'd.certificate_number', 'certificate_expiry': 'd.certificate_expiry',
+    'serial_number': 'd.serial_number', 'fiscal_memory': 'd.fiscal_memory',
+    'contract_expiry': 'c.contract_expiry',
+}
 
 
-def get_devices_by_contract(contract_number: str) -> List[Dict[str, Any]]:
+def get_devices_by_contract(contract_number: str, columns: Optional[Sequence[str]] = None) -> List[Record]:
     """Get all devices for a specific contract number"""
     con = get_connection()
     cur = con.cursor()
+    select, record = _projection('ContractDeviceRecord', CONTRACT_DEVICE_FIELDS, columns, bools=('euro_done',))
     
-    cur.execute("""
-        SELECT d.id, d.fdrid, d.euro_done, d.object_name, d.object_address, 
-               d.object_phone, d.model, d.certificate_number, 
-               d.certificate_expiry, d.serial_number, d.fiscal_memory,
-               c.contract_expiry
+    cur.execute(f"""
+        SELECT {select}
         FROM devices d
         JOIN clients c ON c.id = d.client_id
         WHERE c.contract_number = ?
     """, (contract_number,))
     
-    rows = cur.fetchall()
-    con.close()
-    
-    devices = []
-    for row in rows:
-        devices.append({
-            'id': row[0],
-            'fdrid': row[1],
-            'euro_done': bool(row[2]),
-            'object_name': row[3],
-            'object_address': row[4],
-            'object_phone': row[5],
-            'model': row[6],
-            'certificate_number': row[7],
-            'certificate_expiry': row[8],
-            'serial_number': row[9],
-            'fiscal_memory': row[10],
-            'contract_expiry': row[11]
-        })
-    return devices
+    return list(map(record, cur))
 
 
+def get_client_device_ids(client_id: int) -> List[int]:
+    """Get the ids of all devices of a client (the rows a client edit touches)"""
+    con = get_connection()
+    return [row[0] for row in con.execute("SELECT id FROM devices WHERE client_id = ?", (client_id,))]
+
+
+@cached_query
 def get_all_contract_numbers() -> List[str]:
     """Get list of all contract numbers for quick selection"""
     con = get_connection()
@@ -309,27 +1583,28 @@ def get_all_contract_numbers() -> List[str]:
     
     cur.execute("SELECT DISTINCT contract_number FROM clients ORDER BY contract_number")
     rows = cur.fetchall()
-    con.close()
     
     return [row[0] for row in rows if row[0]]
 
 
 # ============= DEVICE OPERATIONS =============
 
-def add_device(client_id: int, data: Dict[str, Any]) -> int:
-    """Add new device and return device_id"""
-    con = get_connection()
-    cur = con.cursor()
-    
-    cur.execute("""
-        INSERT INTO devices (
-            client_id, fdrid, euro_done, object_name, object_address,
-            object_phone, model, certificate_number, certificate_expiry,
-            serial_number, fiscal_memory,
-            nra_report_enabled, nra_report_month, nra_td, bim_model, bim_date,
-            maintenance_price, last_renewed_at
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
+DEVICE_INSERT_SQL = """
+    INSERT INTO devices (
+        client_id, fdrid, euro_done, object_name, object_address,
+        object_phone, model, certificate_number, certificate_expiry,
+        serial_number, fiscal_memory,
+        nra_report_enabled, nra_report_month, nra_td, bim_model, bim_date,
+        maintenance_price, last_renewed_at,
+        object_address_norm, object_phone_digits,
+        created_at, updated_at
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+"""
+
+
+def _device_params(client_id: int, data: Dict[str, Any]) -> Tuple:
+    """Build the DEVICE_INSERT_SQL parameters from a device dict"""
+    return (
         client_id,
         data.get('fdrid'),
         1 if data.get('euro_done') else 0,
@@ -338,7 +1613,7 @@ def add_device(client_id: int, data: Dict[str, Any]) -> int:
         data.get('object_phone'),
         data.get('model'),
         data.get('certificate_number'),
-        data.get('certificate_expiry'),
+        normalize_date(data.get('certificate_expiry')),
         data.get('serial_number'),
         data.get('fiscal_memory'),
         1 if data.get('nra_report_enabled', True) else 0,
@@ -348,16 +1623,38 @@ def add_device(client_id: int, data: Dict[str, Any]) -> int:
         data.get('bim_date'),
         data.get('maintenance_price', 0),
         datetime.now().strftime('%Y-%m-%d')
-    ))
+    ) + _normalized_values('devices', data)
+
+
+@retry_on_busy
+def add_device(client_id: int, data: Dict[str, Any]) -> int:
+    """Add new device and return device_id"""
+    con = get_connection()
+    cur = con.cursor()
     
-    device_id = cur.lastrowid
-    con.commit()
-    con.close()
+    with transaction():
+        cur.execute(DEVICE_INSERT_SQL, _device_params(client_id, data))
+        device_id = cur.lastrowid
     return device_id
 
 
-def update_device(device_id: int, client_data: Dict[str, Any], device_data: Dict[str, Any]) -> bool:
-    """Update existing device and its client data"""
+@retry_on_busy
+def add_devices_bulk(devices: List[Tuple[int, Dict[str, Any]]]) -> List[int]:
+    """Add many (client_id, device_data) pairs in one transaction and return their ids"""
+    with transaction():
+        return _bulk_insert('devices', DEVICE_INSERT_SQL,
+                            [_device_params(client_id, data) for client_id, data in devices])
+
+
+@retry_on_busy
+def update_device(device_id: int, client_data: Dict[str, Any], device_data: Dict[str, Any],
+                  client_version: Optional[int] = None, device_version: Optional[int] = None) -> bool:
+    """Update existing device and its client data.
+
+    Pass the client_version/device_version read with the data (see
+    get_device_full) to update only if nobody changed the rows meanwhile;
+    otherwise UpdateConflict is raised and nothing is written.
+    """
     con = get_connection()
     cur = con.cursor()
     
@@ -365,313 +1662,602 @@ def update_device(device_id: int, client_data: Dict[str, Any], device_data: Dict
     cur.execute("SELECT client_id FROM devices WHERE id = ?", (device_id,))
     result = cur.fetchone()
     if not result:
-        con.close()
         return False
     
     client_id = result[0]
     
-    # Update client data
-    cur.execute("""
-        UPDATE clients SET
-            contract_number = ?, status = ?, contract_start = ?, contract_expiry = ?,
-            company_name = ?, city = ?, postal_code = ?, address = ?,
-            eik = ?, vat_registered = ?, mol = ?, phone1 = ?, phone2 = ?
-        WHERE id = ?
-    """, (
-        client_data.get('contract_number'),
-        client_data.get('status'),
-        client_data.get('contract_start'),
-        client_data.get('contract_expiry'),
-        client_data.get('company_name'),
-        client_data.get('city'),
-        client_data.get('postal_code'),
-        client_data.get('address'),
-        client_data.get('eik'),
-        client_data.get('vat_registered'),
-        client_data.get('mol'),
-        client_data.get('phone1'),
-        client_data.get('phone2'),
-        client_id
-    ))
-    
-    # Update device data
-    cur.execute("""
-        UPDATE devices SET
-            fdrid = ?, euro_done = ?, object_name = ?, object_address = ?,
-            object_phone = ?, model = ?, certificate_number = ?, certificate_expiry = ?,
-            serial_number = ?, fiscal_memory = ?,
-            nra_report_enabled = ?, nra_report_month = ?, nra_td = ?, bim_model = ?, bim_date = ?,
-            maintenance_price = ?,
-            updated_at = CURRENT_TIMESTAMP
-        WHERE id = ?
-    """, (
-        device_data.get('fdrid'),
-        1 if device_data.get('euro_done') else 0,
-        device_data.get('object_name'),
-        device_data.get('object_address'),
-        device_data.get('object_phone'),
-        device_data.get('model'),
-        device_data.get('certificate_number'),
-        device_data.get('certificate_expiry'),
-        device_data.get('serial_number'),
-        device_data.get('fiscal_memory'),
-        1 if device_data.get('nra_report_enabled') else 0,
-        device_data.get('nra_report_month'),
-        device_data.get('nra_td'),
-        device_data.get('bim_model'),
-        device_data.get('bim_date'),
-        device_data.get('maintenance_price', 0),
-        device_id
-    ))
-    
-    con.commit()
-    con.close()
+    with transaction():
+        # Update client data
+        cur.execute(f"""
+            UPDATE clients SET
+                contract_number = ?, status = ?, contract_start = ?, contract_expiry = ?,
+                company_name = ?, city = ?, postal_code = ?, address = ?,
+                eik = ?, vat_registered = ?, mol = ?, phone1 = ?, phone2 = ?,
+                {_normalized_assignments('clients')},
+                updated_at = CURRENT_TIMESTAMP,
+                row_version = row_version + 1
+            WHERE id = ? AND (? IS NULL OR row_version = ?)
+        """, (
+            client_data.get('contract_number'),
+            client_data.get('status'),
+            normalize_date(client_data.get('contract_start')),
+            normalize_date(client_data.get('contract_expiry')),
+            client_data.get('company_name'),
+            client_data.get('city'),
+            client_data.get('postal_code'),
+            client_data.get('address'),
+            client_data.get('eik'),
+            client_data.get('vat_registered'),
+            client_data.get('mol'),
+            client_data.get('phone1'),
+            client_data.get('phone2'),
+            *_normalized_values('clients', client_data),
+            client_id, client_version, client_version
+        ))
+        if client_version is not None and cur.rowcount == 0:
+            raise UpdateConflict("Договорът е променен от друг потребител. Заредете данните отново.")
+    
+        # Update device data
+        cur.execute(f"""
+            UPDATE devices SET
+                fdrid = ?, euro_done = ?, object_name = ?, object_address = ?,
+                object_phone = ?, model = ?, certificate_number = ?, certificate_expiry = ?,
+                serial_number = ?, fiscal_memory = ?,
+                nra_report_enabled = ?, nra_report_month = ?, nra_td = ?, bim_model = ?, bim_date = ?,
+                maintenance_price = ?,
+                {_normalized_assignments('devices')},
+                updated_at = CURRENT_TIMESTAMP,
+                row_version = row_version + 1
+            WHERE id = ? AND (? IS NULL OR row_version = ?)
+        """, (
+            device_data.get('fdrid'),
+            1 if device_data.get('euro_done') else 0,
+            device_data.get('object_name'),
+            device_data.get('object_address'),
+            device_data.get('object_phone'),
+            device_data.get('model'),
+            device_data.get('certificate_number'),
+            normalize_date(device_data.get('certificate_expiry')),
+            device_data.get('serial_number'),
+            device_data.get('fiscal_memory'),
+            1 if device_data.get('nra_report_enabled') else 0,
+            device_data.get('nra_report_month'),
+            device_data.get('nra_td'),
+            device_data.get('bim_model'),
+            device_data.get('bim_date'),
+            device_data.get('maintenance_price', 0),
+            *_normalized_values('devices', device_data),
+            device_id, device_version, device_version
+        ))
+        if device_version is not None and cur.rowcount == 0:
+            raise UpdateConflict("Устройството е променено от друг потребител. Заредете данните отново.")
     return True
 
 
+@retry_on_busy
 def delete_device(device_id: int) -> bool:
     """Delete device by ID"""
     con = get_connection()
     cur = con.cursor()
     
-    cur.execute("DELETE FROM devices WHERE id = ?", (device_id,))
-    deleted = cur.rowcount > 0
-    
-    con.commit()
-    con.close()
+    with transaction():
+        cur.execute("DELETE FROM devices WHERE id = ?", (device_id,))
+        deleted = cur.rowcount > 0
     return deleted
 
 
-def get_device_full(device_id: int) -> Optional[Dict[str, Any]]:
+# Device + client fields returned by get_device_full / get_devices_for_nra_report
+DEVICE_FULL_FIELDS = {
+    'device_id': 'd.id', 'client_id': 'd.client_id', 'contract_number': 'c.contract_number',
+    'status': 'c.status', 'contract_start': 'c.contract_start', 'contract_expiry': 'c.contract_expiry',
+    'company_name': 'c.company_name', 'city': 'c.city', 'postal_code': 'c.postal_code',
+    'address': 'c.address', 'eik': 'c.eik', 'vat_registered': 'c.vat_registered',
+    'mol': 'c.mol', 'phone1': 'c.phone1', 'phone2': 'c.phone2',
+    'fdrid': 'd.fdrid', 'euro_done': 'd.euro_done', 'object_name': 'd.object_name',
+    'object_address': 'd.object_address', 'object_phone': 'd.object_phone', 'model': 'd.model',
+    'certificate_number': 'd.certificate_number', 'certificate_expiry': 'd.certificate_expiry',
+    'serial_number': 'd.serial_number', 'fiscal_memory': 'd.fiscal_memory',
+    'nra_report_enabled': 'd.nra_report_enabled', 'nra_report_month': 'd.nra_report_month',
+    'nra_td': 'd.nra_td', 'bim_model': 'd.bim_model', 'bim_date': 'd.bim_date',
+    'created_at': 'd.created_at', 'updated_at': 'd.updated_at',
+    'maintenance_price': 'd.maintenance_price', 'last_renewed_at': 'd.last_renewed_at',
+    'client_version': 'c.row_version', 'device_version': 'd.row_version',
+}
+DEVICE_FULL_BOOLS = ('euro_done', 'nra_report_enabled')
+
+
+def get_device_full(device_id: int, columns: Optional[Sequence[str]] = None) -> Optional[Record]:
     """Get complete device data with client info"""
     con = get_connection()
     cur = con.cursor()
+    select, record = _projection('DeviceRecord', DEVICE_FULL_FIELDS, columns, DEVICE_FULL_BOOLS)
     
-    cur.execute("""
-        SELECT 
-            d.id, d.client_id,
-            c.contract_number, c.status, c.contract_start, c.contract_expiry,
-            c.company_name, c.city, c.postal_code, c.address,
-            c.eik, c.vat_registered, c.mol, c.phone1, c.phone2,
-            d.fdrid, d.euro_done, d.object_name, d.object_address,
-            d.object_phone, d.model, d.certificate_number, d.certificate_expiry,
-            d.serial_number, d.fiscal_memory,
-            d.nra_report_enabled, d.nra_report_month, d.nra_td, d.bim_model, d.bim_date,
-            d.created_at, d.updated_at, d.maintenance_price, d.last_renewed_at
+    cur.execute(f"""
+        SELECT {select}
         FROM devices d
         JOIN clients c ON c.id = d.client_id
         WHERE d.id = ?
     """, (device_id,))
     
     row = cur.fetchone()
-    con.close()
+    return record(row) if row else None
+
+
+# Column list of the main device table (see MainWindow.load_table for the
+# meaning of each index) and the order it is displayed in.
+DEVICE_ROW_COLUMNS = """
+    SELECT 
+        d.id,                 -- 0
+        c.contract_number,    -- 1
+        c.status,             -- 2
+        c.company_name,       -- 3
+        c.eik,                -- 4
+        c.vat_registered,     -- 5
+        c.mol,                -- 6
+        c.city,               -- 7
+        c.postal_code,        -- 8
+        c.address,            -- 9
+        c.phone1,             -- 10
+        c.phone2,             -- 11
+        c.contract_start,     -- 12
+        c.contract_expiry,    -- 13
+        d.object_name,        -- 14
+        d.object_address,     -- 15
+        d.object_phone,       -- 16
+        d.model,              -- 17
+        d.serial_number,      -- 18
+        d.fdrid,              -- 19
+        d.fiscal_memory,      -- 20
+        d.certificate_number, -- 21
+        d.certificate_expiry, -- 22
+        d.euro_done,          -- 23
+        d.nra_report_enabled  -- 24
+"""
+
+DEVICE_ROW_SELECT = DEVICE_ROW_COLUMNS + """
+    FROM devices d
+    JOIN clients c ON c.id = d.client_id
+"""
+
+# Same rows, but CROSS JOIN pins clients as the outer loop so the planner
+# walks idx_contract_key in order and can stop after LIMIT rows.
+DEVICE_ROW_SELECT_ORDERED = DEVICE_ROW_COLUMNS + """
+    FROM clients c
+    CROSS JOIN devices d ON d.client_id = c.id
+"""
+
+DEVICE_ROW_ORDER = "c.contract_key, c.contract_number, d.id"
+_LEADING_INTEGER = re.compile(r"\s*([+-]?\d+)")
+
+
+def device_row_key(row: Tuple) -> Tuple:
+    """Sort key of a main-table row in DEVICE_ROW_ORDER (get_all_devices(), get_devices_page())"""
+    contract = row[1]
+    if contract is None:
+        return (0,)  # NULL sorts first in SQLite
+    # contract_key is CAST(contract_number AS INTEGER): leading integer, else 0
+    match = _LEADING_INTEGER.match(contract)
+    return (1, int(match.group(1)) if match else 0, contract, row[0])
+
+DEVICE_PAGE_SIZE = 200
+
+
+@cached_query
+def get_all_devices() -> List[Tuple]:
+    """Get all devices with client info for main table display"""
+    con = get_connection()
+    cur = con.cursor()
     
-    if row:
-        return {
-            'device_id': row[0], 'client_id': row[1], 'contract_number': row[2],
-            'status': row[3], 'contract_start': row[4], 'contract_expiry': row[5],
-            'company_name': row[6], 'city': row[7], 'postal_code': row[8],
-            'address': row[9], 'eik': row[10], 'vat_registered': row[11],
-            'mol': row[12], 'phone1': row[13], 'phone2': row[14],
-            'fdrid': row[15], 'euro_done': bool(row[16]), 'object_name': row[17],
-            'object_address': row[18], 'object_phone': row[19], 'model': row[20],
-            'certificate_number': row[21], 'certificate_expiry': row[22],
-            'serial_number': row[23], 'fiscal_memory': row[24],
-            'nra_report_enabled': bool(row[25]), 'nra_report_month': row[26],
-            'nra_td': row[27], 'bim_model': row[28], 'bim_date': row[29],
-            'created_at': row[30], 'updated_at': row[31],
-            'maintenance_price': row[32] if len(row) > 32 else 0,
-            'last_renewed_at': row[33] if len(row) > 33 else None
-        }
-    return None
+    cur.execute(f"""
+        {DEVICE_ROW_SELECT}
+        ORDER BY {DEVICE_ROW_ORDER}
+    """)
+    
+    rows = cur.fetchall()
+    return rows
+
+
+def get_devices_page(after: Optional[Tuple] = None, limit: int = DEVICE_PAGE_SIZE) -> List[Tuple]:
+    """Get one page of main-table rows in the get_all_devices() order.
+
+    Keyset pagination: pass the last row of the previous page as `after`
+    (None for the first page). The index idx_contract_key lets each page
+    start with an index seek, so the cost of a page does not grow with its
+    position or with the size of the database.
+    """
+    con = get_connection()
+    cur = con.cursor()
+    
+    if after is None:
+        cur.execute(f"""
+            {DEVICE_ROW_SELECT_ORDERED}
+            ORDER BY {DEVICE_ROW_ORDER}
+            LIMIT ?
+        """, (limit,))
+    else:
+        last_id, last_contract = after[0], after[1]
+        # The first condition is implied by the second one, but it is the
+        # one the planner can turn into an index range seek
+        cur.execute(f"""
+            {DEVICE_ROW_SELECT_ORDERED}
+            WHERE c.contract_key >= CAST(? AS INTEGER)
+              AND (c.contract_key, c.contract_number, d.id) > (CAST(? AS INTEGER), ?, ?)
+            ORDER BY {DEVICE_ROW_ORDER}
+            LIMIT ?
+        """, (last_contract, last_contract, last_contract, last_id, limit))
+    
+    return cur.fetchall()
+
+
+def get_device_count() -> int:
+    """Get the total number of rows get_all_devices() would return"""
+    con = get_connection()
+    cur = con.cursor()
+    cur.execute("SELECT COUNT(*) FROM devices d JOIN clients c ON c.id = d.client_id")
+    return cur.fetchone()[0]
+
+
+def get_devices_for_nra_report(columns: Optional[Sequence[str]] = None) -> List[Record]:
+    """Get all devices flagged for the NRA report"""
+    con = get_connection()
+    cur = con.cursor()
+    select, record = _projection('DeviceRecord', DEVICE_FULL_FIELDS, columns, DEVICE_FULL_BOOLS)
+
+    cur.execute(f"""
+        SELECT {select}
+        FROM devices d
+        JOIN clients c ON c.id = d.client_id
+        WHERE d.nra_report_enabled = 1
+        ORDER BY c.contract_key, c.contract_number, d.id
+    """)
+
+    return list(map(record, cur))
+
+
+# ============= CHANGE TRACKING =============
+
+CHANGE_POLL_INTERVAL_MS = 2000
+CHANGE_LOG_RETENTION_DAYS = 90  # older change_log entries are pruned by run_maintenance()
+
+
+def get_change_seq() -> int:
+    """Get the sequence number of the newest change_log entry"""
+    cur = get_connection().execute("SELECT MAX(seq) FROM change_log")
+    return cur.fetchone()[0] or 0
+
+
+def get_device_changes(since_seq: int) -> Tuple[int, List[int], List[int]]:
+    """Get (last seq, changed device ids, deleted device ids) for changes after since_seq.
+
+    A changed client counts as a change of all its devices.
+    """
+    con = get_connection()
+    cur = con.cursor()
+    last_seq = get_change_seq()
+    if last_seq <= since_seq:
+        return since_seq, [], []
+    
+    cur.execute("""
+        SELECT entity_id FROM change_log
+        WHERE seq > ? AND seq <= ? AND entity = 'device' AND op <> 'D'
+        UNION
+        SELECT d.id FROM devices d
+        WHERE d.client_id IN (
+            SELECT entity_id FROM change_log
+            WHERE seq > ? AND seq <= ? AND entity = 'client'
+        )
+    """, (since_seq, last_seq, since_seq, last_seq))
+    changed = {row[0] for row in cur.fetchall()}
+    
+    cur.execute("""
+        SELECT DISTINCT entity_id FROM change_log
+        WHERE seq > ? AND seq <= ? AND entity = 'device' AND op = 'D'
+    """, (since_seq, last_seq))
+    deleted = [row[0] for row in cur.fetchall()]
+    
+    changed.difference_update(deleted)
+    return last_seq, sorted(changed), deleted
+
+
+def _utc_timestamp(value: Any) -> str:
+    """change_log/updated_at timestamp (UTC, as CURRENT_TIMESTAMP) for a datetime or string.
+
+    Naive datetimes are local time, like everything else the app writes.
+    """
+    if isinstance(value, datetime):
+        return value.astimezone(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    return str(value)
+
+
+def get_changes_since(since: Any, entity: Optional[str] = None) -> List[Tuple[str, int, str, str]]:
+    """Get (entity, entity_id, op, changed_at) of every row changed at or after since.
+
+    One entry per row with its latest operation ('I', 'U' or 'D'), in
+    change order. since is a datetime or a UTC 'YYYY-MM-DD HH:MM:SS'
+    string; it is inclusive, so re-using the time of the previous export
+    never misses a change made in the same second. entity narrows the
+    result to 'client', 'device' or 'product'.
+    """
+    con = get_connection()
+    params = [_utc_timestamp(since)]
+    entity_filter = ""
+    if entity:
+        entity_filter = "AND entity = ?"
+        params.append(entity)
+    # Bare columns with MAX(seq) come from the newest entry of each group
+    cur = con.execute(f"""
+        SELECT entity, entity_id, op, changed_at, MAX(seq) AS last_seq
+        FROM change_log
+        WHERE changed_at >= ? {entity_filter}
+        GROUP BY entity, entity_id
+        ORDER BY last_seq
+    """, params)
+    return [row[:4] for row in cur.fetchall()]
+
+
+def get_change_log_start() -> Optional[str]:
+    """Timestamp of the oldest retained change_log entry (UTC), or None if the log is empty.
+
+    A sync job whose last run is older than this has to do a full export.
+    """
+    cur = get_connection().execute("SELECT MIN(changed_at) FROM change_log")
+    return cur.fetchone()[0]
+
+
+def _prune_change_log(con: sqlite3.Connection, retention_days: int) -> int:
+    cur = con.execute("DELETE FROM change_log WHERE changed_at < datetime('now', ?)",
+                      (f"-{int(retention_days)} days",))
+    return cur.rowcount
 
 
-def get_all_devices() -> List[Tuple]:
-    """Get all devices with client info for main table display"""
+def prune_change_log(retention_days: Optional[int] = None) -> int:
+    """Delete change_log entries older than retention_days (default CHANGE_LOG_RETENTION_DAYS)"""
+    if retention_days is None:
+        retention_days = CHANGE_LOG_RETENTION_DAYS
+    with transaction() as con:
+        return _prune_change_log(con, retention_days)
+
+
+def get_device_rows(device_ids: Sequence[int]) -> List[Tuple]:
+    """Get main-table rows (DEVICE_ROW_COLUMNS layout) for the given device ids"""
     con = get_connection()
-    cur = con.cursor()
-    
-    cur.execute("""
-        SELECT 
-            d.id,                 -- 0
-            c.contract_number,    -- 1
-            c.status,             -- 2
-            c.company_name,       -- 3
-            c.eik,                -- 4
-            c.vat_registered,     -- 5
-            c.mol,                -- 6
-            c.city,               -- 7
-            c.postal_code,        -- 8
-            c.address,            -- 9
-            c.phone1,             -- 10
-            c.phone2,             -- 11
-            c.contract_start,     -- 12
-            c.contract_expiry,    -- 13
-            d.object_name,        -- 14
-            d.object_address,     -- 15
-            d.object_phone,       -- 16
-            d.model,              -- 17
-            d.serial_number,      -- 18
-            d.fdrid,              -- 19
-            d.fiscal_memory,      -- 20
-            d.certificate_number, -- 21
-            d.certificate_expiry, -- 22
-            d.euro_done,          -- 23
-            d.nra_report_enabled  -- 24
-        FROM devices d
-        JOIN clients c ON c.id = d.client_id
-        ORDER BY CAST(c.contract_number AS INTEGER), c.contract_number, d.id
-    """)
-    
-    rows = cur.fetchall()
-    con.close()
+    rows = []
+    ids = list(device_ids)
+    # Stay well below SQLite's bound-parameter limit
+    for start in range(0, len(ids), 500):
+        chunk = ids[start:start + 500]
+        placeholders = ", ".join("?" * len(chunk))
+        rows.extend(con.execute(f"""
+            {DEVICE_ROW_SELECT}
+            WHERE d.id IN ({placeholders})
+        """, chunk).fetchall())
     return rows
 
 
-def get_devices_for_nra_report() -> List[Dict[str, Any]]:
-    """Get all devices flagged for the NRA report"""
-    con = get_connection()
-    cur = con.cursor()
+class ChangeWatcher:
+    """Detects device/client changes committed through other connections.
 
-    cur.execute("""
-        SELECT 
-            d.id, d.client_id,
-            c.contract_number, c.status, c.contract_start, c.contract_expiry,
-            c.company_name, c.city, c.postal_code, c.address,
-            c.eik, c.vat_registered, c.mol, c.phone1, c.phone2,
-            d.fdrid, d.euro_done, d.object_name, d.object_address,
-            d.object_phone, d.model, d.certificate_number, d.certificate_expiry,
-            d.serial_number, d.fiscal_memory,
-            d.nra_report_enabled, d.nra_report_month, d.nra_td, d.bim_model, d.bim_date,
-            d.created_at, d.updated_at
-        FROM devices d
-        JOIN clients c ON c.id = d.client_id
-        WHERE d.nra_report_enabled = 1
-        ORDER BY CAST(c.contract_number AS INTEGER), c.contract_number, d.id
-    """)
+    poll() costs one PRAGMA data_version read while nothing has changed;
+    only then is change_log consulted for the rows changed since the last
+    poll (or reset()).
+    """
 
-    rows = cur.fetchall()
-    con.close()
+    def __init__(self):
+        self.last_seq = 0
+        self._data_version = None
+        self.reset()
+
+    def reset(self):
+        """Forget pending changes; call right before (re)loading the view"""
+        self.last_seq = get_change_seq()
+        self._data_version = self._read_data_version()
+
+    @staticmethod
+    def _read_data_version() -> int:
+        return get_connection().execute("PRAGMA data_version").fetchone()[0]
+
+    def poll(self) -> Optional[Tuple[List[int], List[int]]]:
+        """Return (changed device ids, deleted device ids) since the last poll, or None"""
+        data_version = self._read_data_version()
+        if data_version == self._data_version:
+            return None
+        self._data_version = data_version
+        
+        self.last_seq, changed, deleted = get_device_changes(self.last_seq)
+        if not changed and not deleted:
+            return None
+        return changed, deleted
 
-    results = []
-    for row in rows:
-        results.append({
-            'device_id': row[0], 'client_id': row[1], 'contract_number': row[2],
-            'status': row[3], 'contract_start': row[4], 'contract_expiry': row[5],
-            'company_name': row[6], 'city': row[7], 'postal_code': row[8],
-            'address': row[9], 'eik': row[10], 'vat_registered': row[11],
-            'mol': row[12], 'phone1': row[13], 'phone2': row[14],
-            'fdrid': row[15], 'euro_done': bool(row[16]), 'object_name': row[17],
-            'object_address': row[18], 'object_phone': row[19], 'model': row[20],
-            'certificate_number': row[21], 'certificate_expiry': row[22],
-            'serial_number': row[23], 'fiscal_memory': row[24],
-            'nra_report_enabled': bool(row[25]), 'nra_report_month': row[26],
-            'nra_td': row[27], 'bim_model': row[28], 'bim_date': row[29],
-            'created_at': row[30], 'updated_at': row[31]
-        })
-    return results
+    def advance(self) -> Tuple[List[int], List[int]]:
+        """Move past everything logged so far; call right after a write on this connection.
+
+        data_version does not change for the connection's own commits, so
+        poll() would only report them after the next foreign commit (as if
+        they came from elsewhere). Returns (changed, deleted) device ids since
+        the last poll, the own write included, so nothing logged by other
+        workstations in between is lost.
+        """
+        self.last_seq, changed, deleted = get_device_changes(self.last_seq)
+        return changed, deleted
 
 
 # ============= SEARCH & FILTER =============
 
-def search_devices(filters: Dict[str, Any]) -> List[Tuple]:
-    """Search devices with Python-side filtering for robust Unicode support"""
-    con = get_connection()
-    cur = con.cursor()
-    
-    cur.execute("""
-        SELECT 
-            d.id,                 -- 0
-            c.contract_number,    -- 1
-            c.status,             -- 2
-            c.company_name,       -- 3
-            c.eik,                -- 4
-            c.vat_registered,     -- 5
-            c.mol,                -- 6
-            c.city,               -- 7
-            c.postal_code,        -- 8
-            c.address,            -- 9
-            c.phone1,             -- 10
-            c.phone2,             -- 11
-            c.contract_start,     -- 12
-            c.contract_expiry,    -- 13
-            d.object_name,        -- 14
-            d.object_address,     -- 15
-            d.object_phone,       -- 16
-            d.model,              -- 17
-            d.serial_number,      -- 18
-            d.fdrid,              -- 19
-            d.fiscal_memory,      -- 20
-            d.certificate_number, -- 21
-            d.certificate_expiry, -- 22
-            d.euro_done,          -- 23
-            d.nra_report_enabled  -- 24
-        FROM devices d
-        JOIN clients c ON c.id = d.client_id
-    """)
-    
-    rows = cur.fetchall()
-    con.close()
-    
-    filtered_rows = []
-    
-    # Text comparisons (case-insensitive)
-    for row in rows:
-        match = True
-        
-        # company: 3
-        if filters.get('company') and filters['company'].lower() not in (row[3] or "").lower(): match = False
-        # eik: 4
-        if filters.get('eik') and filters['eik'].lower() not in (row[4] or "").lower(): match = False
-        # contract: 1
-        if filters.get('contract') and filters['contract'].lower() not in (row[1] or "").lower(): match = False
-        # phone: 10, 11, 16
-        if filters.get('phone'):
-            ph = filters['phone'].lower()
-            in_ph1 = ph in (row[10] or "").lower()
-            in_ph2 = ph in (row[11] or "").lower()
-            in_obj_ph = ph in (row[16] or "").lower()
-            if not (in_ph1 or in_ph2 or in_obj_ph): match = False
-            
-        # address: 9, 15
-        if filters.get('address'):
-            adr = filters['address'].lower()
-            in_c_adr = adr in (row[9] or "").lower()
-            in_obj_adr = adr in (row[15] or "").lower()
-            if not (in_c_adr or in_obj_adr): match = False
-            
-        # serial: 18
-        if filters.get('serial') and filters['serial'].lower() not in (row[18] or "").lower(): match = False
+# Filter key -> (normalizer, [(main-table row index, SQL expression, device_search column)]).
+# The SQL expressions are the stored normalized columns (see NORMALIZED_COLUMNS),
+# so a filter value is normalized once and compared with instr().
+SEARCH_FILTERS = {
+    'company': (fold_text, [(3, 'c.company_norm', 'company_name')]),
+    'eik': (fold_eik, [(4, 'c.eik_norm', 'eik')]),
+    'contract': (fold_text, [(1, 'casefold(c.contract_number)', 'contract_number')]),
+    'phone': (digits_only, [(10, 'c.phone1_digits', 'phone1'),
+                            (11, 'c.phone2_digits', 'phone2'),
+                            (16, 'd.object_phone_digits', 'object_phone')]),
+    'address': (fold_text, [(9, 'c.address_norm', 'address'),
+                            (15, 'd.object_address_norm', 'object_address')]),
+    'serial': (fold_text, [(18, 'casefold(d.serial_number)', 'serial_number')]),
+}
+
+# Phone filter without any digit ("/", "-"): plain substring on the raw numbers
+PHONE_TEXT_FILTER = (fold_text, [(10, 'casefold(c.phone1)', None),
+                                 (11, 'casefold(c.phone2)', None),
+                                 (16, 'casefold(d.object_phone)', None)])
+
+
+def _filter_term(key: str, value: Any) -> Optional[Tuple]:
+    """(normalized value, normalizer, columns) of one text filter, None if it is inactive"""
+    if not value:
+        return None
+    normalize, columns = SEARCH_FILTERS[key]
+    if key == 'phone' and not digits_only(value):
+        normalize, columns = PHONE_TEXT_FILTER
+    term = normalize(value)
+    return (term, normalize, columns) if term else None
+
+
+def _filter_terms(filters: Dict[str, Any]) -> List[Tuple]:
+    """(normalized value, normalizer, columns) for every active text filter"""
+    terms = (_filter_term(key, filters.get(key)) for key in SEARCH_FILTERS)
+    return [term for term in terms if term]
+
+
+def is_narrower_filter(old: Dict[str, Any], new: Dict[str, Any]) -> bool:
+    """True if every row matching new also matches old, so old's result can be narrowed in memory.
+
+    That holds when each active old term is contained in the new term of
+    the same filter (e.g. 'Проф' -> 'Профи', or 'инанс' -> 'Профинанс').
+    """
+    for key in SEARCH_FILTERS:
+        old_term = _filter_term(key, old.get(key))
+        if old_term is None:
+            continue
+        new_term = _filter_term(key, new.get(key))
+        # A phone filter that switches between digits and text compares other columns
+        if new_term is None or new_term[2] is not old_term[2] or old_term[0] not in new_term[0]:
+            return False
+    return not old.get('euro') or bool(new.get('euro'))
+
+
+def filter_matcher(filters: Dict[str, Any]) -> Callable[[Tuple], bool]:
+    """Predicate for main-table rows, with the filter terms normalized once"""
+    terms = _filter_terms(filters)
+    euro = bool(filters.get('euro'))
+    
+    def matches(row: Tuple) -> bool:
+        for term, normalize, columns in terms:
+            if not any(term in normalize(row[index]) for index, _, _ in columns):
+                return False
         # euro: 23
-        if filters.get('euro') and not row[23]: match = False
-            
-        if match:
-            # Return all columns
-            filtered_rows.append(row)
+        return not euro or bool(row[23])
+    return matches
+
+
+def _search_match_query(terms: List[Tuple]) -> str:
+    """Build an FTS5 MATCH expression for the normalized filter terms.
+
+    The trigram index only helps for terms of 3+ characters; shorter terms
+    are matched by the instr() conditions of search_devices() alone.
+    """
+    phrases = []
+    for term, _, columns in terms:
+        fts_columns = [fts for _, _, fts in columns if fts]
+        if fts_columns and len(term) >= 3:
+            phrase = term.replace('"', '""')
+            phrases.append(f'{{{" ".join(fts_columns)}}} : "{phrase}"')
+    return " AND ".join(phrases)
+
+
+def row_matches_filters(row: Tuple, filters: Dict[str, Any]) -> bool:
+    """Check one main-table row against the filter dict, with search_devices() semantics"""
+    return filter_matcher(filters)(row)
+
+
+def search_devices(filters: Dict[str, Any], include_archive: bool = False) -> List[Tuple]:
+    """Search devices by case-insensitive substring on the normalized columns.
+
+    Company, address and EIK are compared case-folded (Cyrillic included) and
+    phone numbers digits only, so '0888728005' finds '0888/728-005'. Terms of
+    3+ characters are narrowed through the device_search FTS5 index first,
+    or the whole filter runs on the resident DeviceIndex if it is enabled.
+    include_archive adds matching rows from the per-year archive databases.
+    """
+    index = get_device_index()
+    if index is not None:
+        filtered_rows = get_device_rows(index.search(filters))
+    else:
+        filtered_rows = _search_devices_sql(filters)
+    if include_archive:
+        filtered_rows.extend(search_archived_devices(filters))
             
     # Sort by contract number
-    filtered_rows.sort(key=lambda x: (int(x[1]) if x[1] and x[1].isdigit() else 999999, x[1], x[0]))
+    filtered_rows.sort(key=search_row_key)
     return filtered_rows
 
 
-def get_next_contract_number() -> str:
-    """Get the next available contract number (max + 1)"""
+def search_row_key(row: Tuple) -> Tuple:
+    """Sort key of a search_devices() row: numeric contract numbers first, by value"""
+    contract = row[1]
+    return (int(contract) if contract and contract.isdigit() else 999999, contract or "", row[0])
+
+
+def _search_devices_sql(filters: Dict[str, Any]) -> List[Tuple]:
+    """search_devices() rows (unsorted) straight from SQLite"""
     con = get_connection()
     cur = con.cursor()
     
-    cur.execute("SELECT contract_number FROM clients")
-    rows = cur.fetchall()
-    con.close()
-    
-    max_num = 0
-    for row in rows:
-        try:
-            num = int(row[0])
-            if num > max_num: max_num = num
-        except:
-            continue
-            
-    return str(max_num + 1)
+    terms = _filter_terms(filters)
+    conditions = []
+    params = []
+    match_query = _search_match_query(terms)
+    if match_query:
+        conditions.append("d.id IN (SELECT rowid FROM device_search WHERE device_search MATCH ?)")
+        params.append(match_query)
+    for term, _, columns in terms:
+        conditions.append("(" + " OR ".join(f"instr({sql}, ?) > 0" for _, sql, _ in columns) + ")")
+        params.extend([term] * len(columns))
+    if filters.get('euro'):
+        conditions.append("d.euro_done <> 0")
+    where = ("WHERE " + " AND ".join(conditions)) if conditions else ""
+    
+    cur.execute(f"""
+        {DEVICE_ROW_SELECT}
+        {where}
+    """, params)
+    return cur.fetchall()
+
+
+def _next_contract_value(cur) -> int:
+    """Next free contract number: above both the highest used and the last allocated one"""
+    cur.execute("SELECT MAX(contract_key) FROM clients")
+    max_used = cur.fetchone()[0] or 0
+    cur.execute("SELECT value FROM contract_sequence WHERE name = 'contract'")
+    row = cur.fetchone()
+    max_allocated = row[0] if row else 0
+    return max(max_used, max_allocated) + 1
+
+
+def get_next_contract_number() -> str:
+    """Get the next available contract number (max + 1) without reserving it"""
+    con = get_connection()
+    cur = con.cursor()
+    return str(_next_contract_value(cur))
+
+
+@retry_on_busy
+def allocate_contract_number() -> str:
+    """Reserve and return the next contract number.
+
+    Runs under the database write lock, so two users (or two instances on
+    the same contracts.db) can never be handed the same number.
+    """
+    with transaction() as con:
+        cur = con.cursor()
+        value = _next_contract_value(cur)
+        cur.execute("""
+            INSERT INTO contract_sequence (name, value) VALUES ('contract', ?)
+            ON CONFLICT(name) DO UPDATE SET value = excluded.value
+        """, (value,))
+    return str(value)
 
 
 def get_expiring_contracts(month: int, year: int) -> List[Tuple]:
@@ -679,21 +2265,21 @@ def get_expiring_contracts(month: int, year: int) -> List[Tuple]:
     con = get_connection()
     cur = con.cursor()
     
-    # Standardize to YYYY-MM
-    target = f"{year}-{month:02d}"
+    # Day-number range of the month, served by idx_contract_expiry_day
+    first = date(year, month, 1)
+    next_month = date(year + month // 12, month % 12 + 1, 1)
     
     cur.execute("""
         SELECT 
             c.contract_number, c.company_name, d.model, d.serial_number,
             c.contract_expiry, c.eik, c.phone1
-        FROM devices d
-        JOIN clients c ON c.id = d.client_id
-        WHERE c.contract_expiry LIKE ?
-        ORDER BY c.contract_expiry ASC
-    """, (f"{target}%",))
+        FROM clients c
+        JOIN devices d ON d.client_id = c.id
+        WHERE c.contract_expiry_day >= ? AND c.contract_expiry_day < ?
+        ORDER BY c.contract_expiry_day ASC
+    """, (date_day(first.isoformat()), date_day(next_month.isoformat())))
     
     rows = cur.fetchall()
-    con.close()
     return rows
 
 
@@ -701,6 +2287,7 @@ def get_expiring_contracts(month: int, year: int) -> List[Tuple]:
 
 # ============= CERTIFICATE OPERATIONS =============
 
+@cached_query
 def get_all_certificates() -> List[Tuple]:
     """Get all certificates (number, expiry_date)"""
     con = get_connection()
@@ -708,7 +2295,6 @@ def get_all_certificates() -> List[Tuple]:
     
     cur.execute("SELECT number, expiry_date FROM certificates ORDER BY number")
     rows = cur.fetchall()
-    con.close()
     return rows
 
 
@@ -718,53 +2304,53 @@ def get_certificate_expiry(number: str) -> Optional[str]:
     cur = con.cursor()
     cur.execute("SELECT expiry_date FROM certificates WHERE number = ?", (number,))
     row = cur.fetchone()
-    con.close()
     return row[0] if row else None
 
 
+@retry_on_busy
 def add_certificate(number: str, expiry_date: str) -> bool:
     """Add or update certificate"""
     con = get_connection()
     cur = con.cursor()
     try:
-        cur.execute("""
-            INSERT INTO certificates (number, expiry_date) 
-            VALUES (?, ?)
-            ON CONFLICT(number) DO UPDATE SET expiry_date = excluded.expiry_date
-        """, (number, expiry_date))
-        con.commit()
-        con.close()
+        with transaction():
+            cur.execute("""
+                INSERT INTO certificates (number, expiry_date) 
+                VALUES (?, ?)
+                ON CONFLICT(number) DO UPDATE SET expiry_date = excluded.expiry_date
+            """, (number, expiry_date))
         return True
-    except Exception:
-        con.close()
+    except sqlite3.Error as e:
+        if _is_busy(e):
+            raise  # retried by retry_on_busy
         return False
 
 
+@retry_on_busy
 def clear_certificates():
     """Clear all certificates (before reimport)"""
     con = get_connection()
     cur = con.cursor()
-    cur.execute("DELETE FROM certificates")
-    con.commit()
-    con.close()
+    
+    with transaction():
+        cur.execute("DELETE FROM certificates")
 
 
 # ============= USER OPERATIONS =============
 
+@retry_on_busy
 def add_user(username: str, password_hash: str, full_name: str, role: str = "user") -> bool:
     """Add a new user"""
     con = get_connection()
     cur = con.cursor()
     try:
-        cur.execute("""
-            INSERT INTO users (username, password_hash, full_name, role)
-            VALUES (?, ?, ?, ?)
-        """, (username, password_hash, full_name, role))
-        con.commit()
-        con.close()
+        with transaction():
+            cur.execute("""
+                INSERT INTO users (username, password_hash, full_name, role)
+                VALUES (?, ?, ?, ?)
+            """, (username, password_hash, full_name, role))
         return True
     except sqlite3.IntegrityError:
-        con.close()
         return False
 
 
@@ -774,7 +2360,6 @@ def get_user_by_username(username: str) -> Optional[Dict[str, Any]]:
     cur = con.cursor()
     cur.execute("SELECT id, username, password_hash, full_name, role FROM users WHERE username = ?", (username,))
     row = cur.fetchone()
-    con.close()
     
     if row:
         return {
@@ -787,88 +2372,165 @@ def get_user_by_username(username: str) -> Optional[Dict[str, Any]]:
     return None
 
 
-def get_all_users() -> List[Dict[str, Any]]:
+USER_FIELDS = {
+    'id': 'id', 'username': 'username', 'full_name': 'full_name',
+    'created_at': 'created_at', 'role': 'role',
+}
+
+
+def get_all_users(columns: Optional[Sequence[str]] = None) -> List[Record]:
     """Get all users"""
     con = get_connection()
     cur = con.cursor()
-    cur.execute("SELECT id, username, full_name, created_at, role FROM users ORDER BY username")
-    rows = cur.fetchall()
-    con.close()
-    
-    users = []
-    for row in rows:
-        users.append({
-            'id': row[0],
-            'username': row[1],
-            'full_name': row[2],
-            'created_at': row[3],
-            'role': row[4] if len(row) > 4 else 'user'
-        })
-    return users
+    select, record = _projection('UserRecord', USER_FIELDS, columns)
+    cur.execute(f"SELECT {select} FROM users ORDER BY username")
+    return list(map(record, cur))
 
 
+@retry_on_busy
 def update_user(user_id: int, full_name: str, role: str, password_hash: Optional[str] = None) -> bool:
     """Update user details"""
     con = get_connection()
     cur = con.cursor()
     try:
-        if password_hash:
-            cur.execute("""
-                UPDATE users 
-                SET full_name = ?, role = ?, password_hash = ?
-                WHERE id = ?
-            """, (full_name, role, password_hash, user_id))
-        else:
-            cur.execute("""
-                UPDATE users 
-                SET full_name = ?, role = ?
-                WHERE id = ?
-            """, (full_name, role, user_id))
-        con.commit()
+        with transaction():
+            if password_hash:
+                cur.execute("""
+                    UPDATE users 
+                    SET full_name = ?, role = ?, password_hash = ?
+                    WHERE id = ?
+                """, (full_name, role, password_hash, user_id))
+            else:
+                cur.execute("""
+                    UPDATE users 
+                    SET full_name = ?, role = ?
+                    WHERE id = ?
+                """, (full_name, role, user_id))
         return True
-    except Exception as e:
+    except sqlite3.Error as e:
+        if _is_busy(e):
+            raise  # retried by retry_on_busy
         print(f"Error updating user: {e}")
         return False
-    finally:
-        con.close()
 
 
 def delete_user(user_id: int) -> bool:
     """Delete a user by ID"""
     con = get_connection()
     cur = con.cursor()
-    cur.execute("DELETE FROM users WHERE id = ?", (user_id,))
-    deleted = cur.rowcount > 0
-    con.commit()
-    con.close()
+    
+    with transaction():
+        cur.execute("DELETE FROM users WHERE id = ?", (user_id,))
+        deleted = cur.rowcount > 0
     return deleted
 
 
 # ============= AUDIT OPERATIONS =============
 
+# log_action() only queues the entry; a background thread writes the queue
+# in batched transactions. An entry waits at most AUDIT_FLUSH_INTERVAL
+# seconds (or until AUDIT_BATCH_SIZE entries are pending) before it is
+# committed, which bounds what a crash can lose.
+AUDIT_BATCH_SIZE = 200
+AUDIT_FLUSH_INTERVAL = 0.5
+AUDIT_WRITE_RETRIES = 3
+
+AUDIT_INSERT_SQL = """
+    INSERT INTO audit_logs (user_id, username, action, details, timestamp, contract_number, device_id)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+
+_audit_queue: queue.Queue = queue.Queue()
+_audit_thread: Optional[threading.Thread] = None
+_audit_lock = threading.Lock()
+_AUDIT_FLUSH = object()  # queue marker: write the current batch now
+_AUDIT_STOP = object()   # queue marker: write the current batch and exit
+
+
+def _write_audit_batch(batch: List[Tuple]):
+    """Insert a batch of audit entries in one transaction, retrying on lock/IO errors"""
+    for attempt in range(1, AUDIT_WRITE_RETRIES + 1):
+        try:
+            with transaction() as con:
+                con.executemany(AUDIT_INSERT_SQL, batch)
+            return
+        except sqlite3.Error as e:
+            print(f"Audit write failed (attempt {attempt}/{AUDIT_WRITE_RETRIES}): {e}")
+            time.sleep(0.2 * attempt)
+    print(f"Audit log: dropped {len(batch)} entries")
+
+
+def _audit_writer():
+    """Background thread body: drain _audit_queue into batched transactions"""
+    while True:
+        item = _audit_queue.get()
+        batch = []
+        markers = 0
+        deadline = time.monotonic() + AUDIT_FLUSH_INTERVAL
+        while True:
+            if item is _AUDIT_FLUSH or item is _AUDIT_STOP:
+                markers += 1
+                break
+            batch.append(item)
+            timeout = deadline - time.monotonic()
+            if len(batch) >= AUDIT_BATCH_SIZE or timeout <= 0:
+                break
+            try:
+                item = _audit_queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+
+        if batch:
+            _write_audit_batch(batch)
+        for _ in range(len(batch) + markers):
+            _audit_queue.task_done()
+        if item is _AUDIT_STOP:
+            return
+
+
+def _start_audit_writer():
+    """Start the audit writer thread if it is not running"""
+    global _audit_thread
+    with _audit_lock:
+        if _audit_thread is None or not _audit_thread.is_alive():
+            _audit_thread = threading.Thread(target=_audit_writer, name="audit-writer", daemon=True)
+            _audit_thread.start()
+
+
+def flush_audit_log():
+    """Block until every queued audit entry has been committed"""
+    if _audit_thread is None or not _audit_thread.is_alive():
+        return
+    _audit_queue.put(_AUDIT_FLUSH)
+    _audit_queue.join()
+
+
+def stop_audit_writer():
+    """Write the remaining audit entries and stop the writer thread"""
+    global _audit_thread
+    with _audit_lock:
+        thread = _audit_thread
+        _audit_thread = None
+    if thread is not None and thread.is_alive():
+        _audit_queue.put(_AUDIT_STOP)
+        thread.join()
+
+
+atexit.register(stop_audit_writer)
+
+
 def log_action(user_id: Optional[int], username: str, action: str, details: str = "", 
                contract_number: Optional[str] = None, device_id: Optional[int] = None):
-    """Log an action to audit_logs with optional contract/device tracking"""
-    con = get_connection()
-    cur = con.cursor()
-    try:
-        # Use local time instead of UTC
-        from datetime import datetime
-        local_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        
-        cur.execute("""
-            INSERT INTO audit_logs (user_id, username, action, details, timestamp, contract_number, device_id)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (user_id, username, action, details, local_time, contract_number, device_id))
-        con.commit()
-    except:
-        pass # Logging should not break app flow
-    finally:
-        con.close()
+    """Queue an action for audit_logs with optional contract/device tracking"""
+    # Use local time instead of UTC, taken when the action happens
+    local_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    _start_audit_writer()
+    _audit_queue.put((user_id, username, action, details, local_time, contract_number, device_id))
 
 
 def get_device_history(device_id: int):
     """Get audit history for a specific device"""
+    flush_audit_log()
     con = get_connection()
     cur = con.cursor()
     
@@ -880,13 +2542,13 @@ def get_device_history(device_id: int):
     """, (device_id,))
     
     rows = cur.fetchall()
-    con.close()
     
     return [{"timestamp": r[0], "username": r[1], "action": r[2], "details": r[3]} for r in rows]
 
 
 def get_contract_history(contract_number: str):
     """Get audit history for a specific contract"""
+    flush_audit_log()
     con = get_connection()
     cur = con.cursor()
     
@@ -898,24 +2560,24 @@ def get_contract_history(contract_number: str):
     """, (contract_number,))
     
     rows = cur.fetchall()
-    con.close()
     
     return [{"timestamp": r[0], "username": r[1], "action": r[2], "details": r[3]} for r in rows]
 
 
 # ============= REPAIR HISTORY OPERATIONS =============
 
+@retry_on_busy
 def add_repair_record(device_id: int, problem: str, date_str: str, path: str = "") -> int:
     """Add a new repair record and return its ID (protocol number)"""
     con = get_connection()
     cur = con.cursor()
-    cur.execute("""
-        INSERT INTO repair_history (device_id, problem_description, repair_date, protocol_path)
-        VALUES (?, ?, ?, ?)
-    """, (device_id, problem, date_str, path))
-    record_id = cur.lastrowid
-    con.commit()
-    con.close()
+    
+    with transaction():
+        cur.execute("""
+            INSERT INTO repair_history (device_id, problem_description, repair_date, protocol_path)
+            VALUES (?, ?, ?, ?)
+        """, (device_id, problem, date_str, path))
+        record_id = cur.lastrowid
     return record_id
 
 
@@ -930,7 +2592,6 @@ def get_repair_history(device_id: int) -> List[Dict[str, Any]]:
         ORDER BY repair_date DESC
     """, (device_id,))
     rows = cur.fetchall()
-    con.close()
     
     history = []
     for row in rows:
@@ -945,107 +2606,101 @@ def get_repair_history(device_id: int) -> List[Dict[str, Any]]:
 
 # ============= PRODUCT OPERATIONS =============
 
+@retry_on_busy
 def add_product(data: Dict[str, Any]) -> int:
     """Add a new product"""
     con = get_connection()
     cur = con.cursor()
-    cur.execute("""
-        INSERT INTO products (name, category, price, currency, description)
-        VALUES (?, ?, ?, ?, ?)
-    """, (
-        data.get('name'),
-        data.get('category'),
-        data.get('price'),
-        data.get('currency', 'BGN'),
-        data.get('description')
-    ))
-    product_id = cur.lastrowid
-    con.commit()
-    con.close()
+    
+    with transaction():
+        cur.execute("""
+            INSERT INTO products (name, category, price, currency, description)
+            VALUES (?, ?, ?, ?, ?)
+        """, (
+            data.get('name'),
+            data.get('category'),
+            data.get('price'),
+            data.get('currency', 'BGN'),
+            data.get('description')
+        ))
+        product_id = cur.lastrowid
     return product_id
 
 
-def update_product(product_id: int, data: Dict[str, Any]) -> bool:
-    """Update an existing product"""
+@retry_on_busy
+def update_product(product_id: int, data: Dict[str, Any], row_version: Optional[int] = None) -> bool:
+    """Update an existing product.
+
+    With row_version, raises UpdateConflict if the product was changed
+    since it was read (False still means the product no longer exists).
+    """
     con = get_connection()
     cur = con.cursor()
-    cur.execute("""
-        UPDATE products SET
-            name = ?, category = ?, price = ?, currency = ?, description = ?,
-            updated_at = CURRENT_TIMESTAMP
-        WHERE id = ?
-    """, (
-        data.get('name'),
-        data.get('category'),
-        data.get('price'),
-        data.get('currency'),
-        data.get('description'),
-        product_id
-    ))
-    updated = cur.rowcount > 0
-    con.commit()
-    con.close()
+    
+    with transaction():
+        cur.execute("""
+            UPDATE products SET
+                name = ?, category = ?, price = ?, currency = ?, description = ?,
+                updated_at = CURRENT_TIMESTAMP,
+                row_version = row_version + 1
+            WHERE id = ? AND (? IS NULL OR row_version = ?)
+        """, (
+            data.get('name'),
+            data.get('category'),
+            data.get('price'),
+            data.get('currency'),
+            data.get('description'),
+            product_id, row_version, row_version
+        ))
+        updated = cur.rowcount > 0
+        if not updated and row_version is not None:
+            cur.execute("SELECT 1 FROM products WHERE id = ?", (product_id,))
+            if cur.fetchone():
+                raise UpdateConflict("Продуктът е променен от друг потребител. Заредете данните отново.")
     return updated
 
 
+@retry_on_busy
 def delete_product(product_id: int) -> bool:
     """Delete a product"""
     con = get_connection()
     cur = con.cursor()
-    cur.execute("DELETE FROM products WHERE id = ?", (product_id,))
-    deleted = cur.rowcount > 0
-    con.commit()
-    con.close()
+    
+    with transaction():
+        cur.execute("DELETE FROM products WHERE id = ?", (product_id,))
+        deleted = cur.rowcount > 0
     return deleted
 
 
-def get_all_products() -> List[Dict[str, Any]]:
+PRODUCT_FIELDS = {
+    'id': 'id', 'name': 'name', 'category': 'category', 'price': 'price',
+    'currency': 'currency', 'description': 'description', 'created_at': 'created_at',
+    'row_version': 'row_version',
+}
+
+
+@cached_query
+def get_all_products(columns: Optional[Sequence[str]] = None) -> List[Record]:
     """Get all products"""
     con = get_connection()
     cur = con.cursor()
-    cur.execute("SELECT id, name, category, price, currency, description, created_at FROM products ORDER BY category, name")
-    rows = cur.fetchall()
-    con.close()
-    
-    products = []
-    for row in rows:
-        products.append({
-            'id': row[0],
-            'name': row[1],
-            'category': row[2],
-            'price': row[3],
-            'currency': row[4],
-            'description': row[5],
-            'created_at': row[6]
-        })
-    return products
+    select, record = _projection('ProductRecord', PRODUCT_FIELDS, columns)
+    cur.execute(f"SELECT {select} FROM products ORDER BY category, name")
+    return list(map(record, cur))
 
-def search_products(query: str) -> List[Dict[str, Any]]:
+def search_products(query: str, columns: Optional[Sequence[str]] = None) -> List[Record]:
     """Search products by name or category"""
     con = get_connection()
     cur = con.cursor()
+    select, record = _projection('ProductRecord', PRODUCT_FIELDS, columns)
     search = f"%{query}%"
-    cur.execute("""
-        SELECT id, name, category, price, currency, description, created_at 
+    cur.execute(f"""
+        SELECT {select}
         FROM products 
         WHERE name LIKE ? OR category LIKE ? OR description LIKE ?
         ORDER BY category, name
     """, (search, search, search))
-    rows = cur.fetchall()
-    con.close()
-    
-    products = []
-    for row in rows:
-        products.append({
-            'id': row[0],
-            'name': row[1],
-            'category': row[2],
-            'price': row[3],
-            'currency': row[4],
-            'description': row[5],
-            'created_at': row[6]
-        })
-    return products
+    return list(map(record, cur))
 
 def restore_database_from_backup(backup_path):
     """
@@ -1054,40 +2709,68 @@ def restore_database_from_backup(backup_path):
     import zipfile
     import shutil
     import os
-    from path_utils import get_app_root
     
-    app_root = get_app_root()
-    db_path = os.path.join(app_root, "data", "contracts.db")
+    # The file the app is using (CONTRACTS_DB_PATH / set_db_path may move it)
+    db_path = DB_PATH
     
     try:
         if not os.path.exists(backup_path):
             return False, "Файлът на бекъпа не съществува."
             
+        # Flush the WAL and release the pooled connections before touching the file
+        checkpoint_database()
+        close_connections()
+            
         # Create a safety backup of current DB
         safety_path = db_path + ".safety"
         if os.path.exists(db_path):
             shutil.copy2(db_path, safety_path)
             
         with zipfile.ZipFile(backup_path, 'r') as zip_ref:
-            # Look for contracts.db inside the zip
-            if 'contracts.db' in zip_ref.namelist():
-                zip_ref.extract('contracts.db', os.path.join(app_root, "data"))
+            # Backups store the database under its own file name; older ones as contracts.db
+            names = zip_ref.namelist()
+            member = next((name for name in (os.path.basename(db_path), 'contracts.db') if name in names), None)
+            if member:
+                # A stale WAL would otherwise be replayed on top of the restored file
+                _remove_wal_files(db_path)
+                with zip_ref.open(member) as src, open(db_path, 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
                 return True, "Базата данни е възстановена успешно."
             else:
                 return False, "В архива не беше намерен файл contracts.db."
     except Exception as e:
         return False, f"Грешка при възстановяване: {str(e)}"
 
+@retry_on_busy
+def _restore_super_admin(admin_data: Dict[str, Any]):
+    """Put the super admin into a freshly initialized database"""
+    con = get_connection()
+    cur = con.cursor()
+    
+    with transaction():
+        # Check if vladpos already exists (init_db might have created it)
+        cur.execute("SELECT id FROM users WHERE username = 'vladpos'")
+        existing = cur.fetchone()
+        
+        if existing:
+            cur.execute("""
+                UPDATE users SET password_hash = ?, full_name = ? WHERE username = 'vladpos'
+            """, (admin_data['password_hash'], admin_data['full_name']))
+        else:
+            cur.execute("""
+                INSERT INTO users (username, password_hash, full_name, role)
+                VALUES (?, ?, ?, 'admin')
+            """, (admin_data['username'], admin_data['password_hash'], admin_data['full_name']))
+
+
 def reset_database():
     """
     Clear all data from the database but preserve the super admin.
     """
     import os
-    from path_utils import get_app_root
     from super_admin_manager import load_super_admin
     
-    app_root = get_app_root()
-    db_path = os.path.join(app_root, "data", "contracts.db")
+    db_path = DB_PATH
     
     try:
         # 1. Load super admin from encrypted storage
@@ -1095,36 +2778,17 @@ def reset_database():
         if not admin_data:
             return False, "Не бе намерена информация за супер администратора."
             
-        # 2. Delete current DB
+        # 2. Delete current DB (pooled connections must be released first)
+        close_connections()
         if os.path.exists(db_path):
-            # We might need to ensure connections are closed, but in this app 
-            # we usually open/close per operation or rely on the fact that 
-            # this will be called from a controlled state.
             os.remove(db_path)
+        _remove_wal_files(db_path)
             
         # 3. Re-initialize empty DB
         init_db()
         
         # 4. Restore super admin into the fresh DB
-        con = sqlite3.connect(db_path)
-        cur = con.cursor()
-        
-        # Check if vladpos already exists (init_db might have created it)
-        cur.execute("SELECT id FROM users WHERE username = 'vladpos'")
-        existing = cur.fetchone()
-        
-        if existing:
-            cur.execute("""
-                UPDATE users SET password_hash = ?, full_name = ? WHERE username = 'vladpos'
-            """, (admin_data['password_hash'], admin_data['full_name']))
-        else:
-            cur.execute("""
-                INSERT INTO users (username, password_hash, full_name, role)
-                VALUES (?, ?, ?, 'admin')
-            """, (admin_data['username'], admin_data['password_hash'], admin_data['full_name']))
-            
-        con.commit()
-        con.close()
+        _restore_super_admin(admin_data)
         
         return True, "Базата данни бе изчистена успешно. Супер администраторът е запазен."
     except Exception as e:
@@ -1132,39 +2796,605 @@ def reset_database():
 
 
 def get_db_stats() -> Dict[str, Any]:
-    """Calculate various statistics from the database"""
+    """Read the dashboard statistics from stats_rollup plus two date-relative index counts"""
     con = get_connection()
     cur = con.cursor()
     
-    from datetime import date, timedelta
-    today = date.today().isoformat()
-    thirty_days_later = (date.today() + timedelta(days=30)).isoformat()
+    today = date_day(date.today().isoformat())
+    thirty_days_later = today + 30
+    
+    status_counts = {}
+    revenue = {}
+    models = {}
+    cur.execute("SELECT kind, key, count, amount FROM stats_rollup")
+    for kind, key, count, amount in cur.fetchall():
+        if kind == 'status':
+            status_counts[key] = count
+        elif kind == 'revenue':
+            revenue[key] = amount
+        elif kind == 'model' and count > 0:
+            models[None if key == STATS_NULL_KEY else key] = count
     
     stats = {}
     
     # 1. Contract counts
-    cur.execute("SELECT COUNT(*) FROM clients WHERE status = 'Активен'")
-    stats['active_contracts'] = cur.fetchone()[0]
+    stats['active_contracts'] = status_counts.get('Активен', 0)
     
-    cur.execute("SELECT COUNT(*) FROM clients WHERE status = 'Изтекъл' OR (contract_expiry IS NOT NULL AND contract_expiry < ?)", (today,))
-    stats['expired_contracts'] = cur.fetchone()[0]
+    # Expired = marked 'Изтекъл' plus contracts past their expiry date that are not marked yet
+    cur.execute("SELECT COUNT(*) FROM clients WHERE contract_expiry_day < ?", (today,))
+    past_expiry = cur.fetchone()[0]
+    cur.execute("SELECT COUNT(*) FROM clients WHERE status = 'Изтекъл' AND contract_expiry_day < ?", (today,))
+    past_expiry_marked = cur.fetchone()[0]
+    stats['expired_contracts'] = status_counts.get('Изтекъл', 0) + past_expiry - past_expiry_marked
     
-    cur.execute("SELECT COUNT(*) FROM clients WHERE status = 'Активен' AND contract_expiry >= ? AND contract_expiry <= ?", 
+    cur.execute("SELECT COUNT(*) FROM clients WHERE status = 'Активен' AND contract_expiry_day BETWEEN ? AND ?", 
                 (today, thirty_days_later))
     stats['expiring_soon'] = cur.fetchone()[0]
     
     # 2. Financials (Monthly Revenue from maintenance_price)
-    cur.execute("SELECT SUM(maintenance_price) FROM devices d JOIN clients c ON d.client_id = c.id WHERE c.status = 'Активен'")
-    result = cur.fetchone()
-    stats['monthly_revenue'] = result[0] if result[0] else 0.0
+    stats['monthly_revenue'] = revenue.get('Активен', 0) / 100
     
     # 3. Model distribution
-    cur.execute("SELECT model, COUNT(*) as count FROM devices GROUP BY model ORDER BY count DESC LIMIT 5")
-    stats['model_dist'] = {row[0]: row[1] for row in cur.fetchall()}
+    stats['model_dist'] = dict(sorted(models.items(), key=lambda item: item[1], reverse=True)[:5])
     
     # 4. Total devices
-    cur.execute("SELECT COUNT(*) FROM devices")
-    stats['total_devices'] = cur.fetchone()[0]
+    stats['total_devices'] = sum(models.values())
     
-    con.close()
     return stats
+
+
+# ============= ARCHIVE =============
+
+# Contracts that expired more than ARCHIVE_AFTER_YEARS ago can be moved,
+# with their devices, repair history and audit rows, into one database per
+# expiry year under data/archive. Archive files are ATTACHed only while
+# they are used, so everyday queries see live data only.
+ARCHIVE_AFTER_YEARS = 3
+ARCHIVE_TABLES = ('clients', 'devices', 'repair_history', 'audit_logs')
+ARCHIVE_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS {schema}.idx_contract_number ON clients(contract_number)",
+    "CREATE INDEX IF NOT EXISTS {schema}.idx_client_id ON devices(client_id)",
+    "CREATE INDEX IF NOT EXISTS {schema}.idx_repair_device ON repair_history(device_id)",
+    "CREATE INDEX IF NOT EXISTS {schema}.idx_audit_device ON audit_logs(device_id)",
+    "CREATE INDEX IF NOT EXISTS {schema}.idx_audit_contract ON audit_logs(contract_number)",
+]
+# Rows of each table that belong to the contracts in temp.archive_clients
+ARCHIVE_PREDICATES = {
+    'clients': "id IN (SELECT id FROM temp.archive_clients)",
+    'devices': "id IN (SELECT id FROM temp.archive_devices)",
+    'repair_history': "device_id IN (SELECT id FROM temp.archive_devices)",
+    'audit_logs': """device_id IN (SELECT id FROM temp.archive_devices)
+        OR (device_id IS NULL AND contract_number IN (SELECT contract_number FROM temp.archive_clients))""",
+}
+
+
+def get_archive_dir() -> str:
+    """Directory holding the per-year archive databases"""
+    return os.path.join(_data_dir(), "archive")
+
+
+def get_archive_files() -> List[Tuple[int, str]]:
+    """(year, path) of every archive database, oldest first"""
+    archive_dir = get_archive_dir()
+    if not os.path.isdir(archive_dir):
+        return []
+    
+    files = []
+    for name in os.listdir(archive_dir):
+        stem, ext = os.path.splitext(name)
+        year = stem.rsplit('_', 1)[-1]
+        if ext == '.db' and stem.startswith('contracts_archive_') and year.isdigit():
+            files.append((int(year), os.path.join(archive_dir, name)))
+    return sorted(files)
+
+
+@contextmanager
+def _attached_archive(con: sqlite3.Connection, year: int, path: str):
+    """ATTACH one archive file for the duration of the block, yielding its schema name"""
+    schema = f"archive_{year}"
+    con.execute("ATTACH DATABASE ? AS " + schema, (path,))
+    try:
+        yield schema
+    finally:
+        con.execute("DETACH DATABASE " + schema)
+
+
+def _archive_columns(con: sqlite3.Connection, table: str) -> List[Tuple[str, str]]:
+    """(name, type) of the stored columns of a live table; generated columns are skipped"""
+    cur = con.execute(f"PRAGMA main.table_xinfo({table})")
+    return [(row[1], row[2]) for row in cur.fetchall() if row[6] == 0]
+
+
+def _ensure_archive_schema(con: sqlite3.Connection, schema: str):
+    """Create the archive tables, adding any columns the live tables gained since"""
+    for table in ARCHIVE_TABLES:
+        columns = _archive_columns(con, table)
+        column_defs = ", ".join(f"{name} {col_type}" for name, col_type in columns if name != 'id')
+        con.execute(f"CREATE TABLE IF NOT EXISTS {schema}.{table} (id INTEGER PRIMARY KEY, {column_defs})")
+        
+        existing = {row[1] for row in con.execute(f"PRAGMA {schema}.table_info({table})")}
+        for name, col_type in columns:
+            if name not in existing:
+                con.execute(f"ALTER TABLE {schema}.{table} ADD COLUMN {name} {col_type}")
+    for index_sql in ARCHIVE_INDEXES:
+        con.execute(index_sql.format(schema=schema))
+
+
+def _move_to_archive(con: sqlite3.Connection, schema: str, first_day: int, end_day: int) -> Dict[str, int]:
+    """Copy the contracts expiring in [first_day, end_day) into schema, then delete them from main"""
+    con.execute("""
+        CREATE TEMP TABLE archive_clients AS
+        SELECT id, contract_number FROM main.clients
+        WHERE contract_expiry_day >= ? AND contract_expiry_day < ?
+    """, (first_day, end_day))
+    con.execute("""
+        CREATE TEMP TABLE archive_devices AS
+        SELECT id FROM main.devices WHERE client_id IN (SELECT id FROM temp.archive_clients)
+    """)
+    
+    counts = {}
+    try:
+        for table in ARCHIVE_TABLES:
+            columns = ", ".join(name for name, _ in _archive_columns(con, table))
+            # OR REPLACE keeps a re-run idempotent (ids are preserved)
+            cur = con.execute(f"""
+                INSERT OR REPLACE INTO {schema}.{table} ({columns})
+                SELECT {columns} FROM main.{table} WHERE {ARCHIVE_PREDICATES[table]}
+            """)
+            counts[table] = cur.rowcount
+        # The numbers leave the live table: keep allocate_contract_number() above them
+        con.execute("""
+            INSERT INTO contract_sequence (name, value)
+            SELECT 'contract', MAX(CAST(contract_number AS INTEGER)) FROM temp.archive_clients WHERE 1
+            ON CONFLICT(name) DO UPDATE SET value = MAX(value, excluded.value)
+        """)
+        # Children first; the device triggers keep search index, stats and change log current
+        for table in reversed(ARCHIVE_TABLES):
+            con.execute(f"DELETE FROM main.{table} WHERE {ARCHIVE_PREDICATES[table]}")
+    finally:
+        con.execute("DROP TABLE temp.archive_devices")
+        con.execute("DROP TABLE temp.archive_clients")
+    return counts
+
+
+def archive_expired_contracts(min_age_years: int = ARCHIVE_AFTER_YEARS) -> Dict[int, Dict[str, int]]:
+    """Move contracts that expired more than min_age_years ago into the per-year archives.
+
+    Returns {expiry year: {table: rows moved}}. Each year is moved in one
+    transaction; with WAL the main and archive files commit separately, so
+    an interrupted run can leave copies in the archive - running it again
+    finishes the move.
+    """
+    flush_audit_log()
+    con = get_connection()
+    
+    today = date.today()
+    try:
+        cutoff = today.replace(year=today.year - min_age_years)
+    except ValueError:  # 29 February
+        cutoff = today.replace(year=today.year - min_age_years, day=28)
+    cutoff_day = date_day(cutoff.isoformat())
+    
+    cur = con.execute("""
+        SELECT DISTINCT CAST(strftime('%Y', contract_expiry) AS INTEGER)
+        FROM clients WHERE contract_expiry_day < ?
+    """, (cutoff_day,))
+    years = sorted(row[0] for row in cur.fetchall() if row[0])
+    if not years:
+        return {}
+    
+    os.makedirs(get_archive_dir(), exist_ok=True)
+    moved = {}
+    for year in years:
+        path = os.path.join(get_archive_dir(), f"contracts_archive_{year}.db")
+        first_day = date_day(f"{year:04d}-01-01")
+        end_day = min(date_day(f"{year + 1:04d}-01-01"), cutoff_day)
+        with _attached_archive(con, year, path) as schema:
+            with transaction():
+                _ensure_archive_schema(con, schema)
+                moved[year] = _move_to_archive(con, schema, first_day, end_day)
+    return moved
+
+
+def search_archived_devices(filters: Dict[str, Any]) -> List[Tuple]:
+    """Search the archive databases; rows have the layout of search_devices() plus the archive year"""
+    con = get_connection()
+    where = "WHERE d.euro_done <> 0" if filters.get('euro') else ""
+    matches = filter_matcher(filters)
+    
+    rows = []
+    for year, path in get_archive_files():
+        with _attached_archive(con, year, path) as schema:
+            cur = con.execute(f"""
+                {DEVICE_ROW_COLUMNS},
+                {year} AS archive_year  -- 25
+                FROM {schema}.devices d
+                JOIN {schema}.clients c ON c.id = d.client_id
+                {where}
+            """)
+            rows.extend(filter(matches, cur))
+    return rows
+
+# ============= MAINTENANCE =============
+
+MAINTENANCE_INTERVAL_HOURS = 24
+MAINTENANCE_VACUUM_STEP = 2000  # pages freed per write transaction
+ANALYSIS_LIMIT = 1000  # rows sampled per index by ANALYZE
+
+
+def _database_size() -> int:
+    """Size of the database file plus its WAL, in bytes"""
+    size = 0
+    for suffix in ("", "-wal"):
+        try:
+            size += os.path.getsize(DB_PATH + suffix)
+        except OSError:
+            pass
+    return size
+
+
+def run_maintenance() -> Dict[str, Any]:
+    """Run ANALYZE/optimize, change_log pruning, incremental vacuum and quick_check and record the result.
+
+    Meant for a background thread: it uses its own connection and keeps
+    every write lock short (the vacuum frees MAINTENANCE_VACUUM_STEP pages
+    per transaction), so the UI and other workstations are not held up.
+    A database created before incremental auto-vacuum was enabled is not
+    vacuumed here (result['vacuum_skipped']): switching it over takes a full
+    VACUUM, which an administrator starts with enable_incremental_vacuum().
+    """
+    con = _open_connection()
+    result = {
+        'started_at': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'size_before': _database_size(),
+        'freelist_before': con.execute("PRAGMA freelist_count").fetchone()[0],
+        'steps': {},
+    }
+    
+    def step(name, func):
+        start = time.perf_counter()
+        try:
+            func()
+        except sqlite3.Error as e:
+            # e.g. busy while another workstation writes; the next run retries
+            result.setdefault('errors', {})[name] = str(e)
+        result['steps'][name] = round((time.perf_counter() - start) * 1000, 1)
+    
+    try:
+        con.execute(f"PRAGMA analysis_limit = {ANALYSIS_LIMIT}")
+        has_stats = con.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone() is not None
+        # optimize only re-analyzes tables whose size changed a lot; the first run needs full ANALYZE
+        step('optimize', lambda: con.execute("PRAGMA optimize" if has_stats else "ANALYZE"))
+        
+        def vacuum():
+            if con.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                result['vacuum_skipped'] = "auto_vacuum не е INCREMENTAL"
+                return
+            free_pages = con.execute("PRAGMA freelist_count").fetchone()[0]
+            while free_pages > 0:
+                con.execute(f"PRAGMA incremental_vacuum({MAINTENANCE_VACUUM_STEP})").fetchall()
+                remaining = con.execute("PRAGMA freelist_count").fetchone()[0]
+                if remaining >= free_pages:
+                    break
+                free_pages = remaining
+        
+        def prune():
+            _prune_change_log(con, CHANGE_LOG_RETENTION_DAYS)
+            con.commit()
+        step('prune_change_log', prune)
+        step('vacuum', vacuum)
+        
+        def quick_check():
+            rows = con.execute("PRAGMA quick_check").fetchall()
+            result['quick_check'] = "; ".join(row[0] for row in rows[:10])
+        step('quick_check', quick_check)
+        
+        step('checkpoint', lambda: con.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall())
+        
+        result.setdefault('quick_check', "")
+        result['freelist_after'] = con.execute("PRAGMA freelist_count").fetchone()[0]
+        result['size_after'] = _database_size()
+        result['duration_ms'] = round(sum(result['steps'].values()), 1)
+        
+        con.execute("""
+            INSERT INTO maintenance_log (
+                started_at, duration_ms, size_before, size_after,
+                freelist_before, freelist_after, quick_check, steps, errors
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (result['started_at'], result['duration_ms'], result['size_before'], result['size_after'],
+              result['freelist_before'], result['freelist_after'], result['quick_check'],
+              json.dumps(result['steps']), json.dumps(result.get('errors', {}))))
+        con.commit()
+    finally:
+        with _connections_lock:
+            if con in _open_connections:
+                _open_connections.remove(con)
+        con.close()
+    return result
+
+
+def incremental_vacuum_enabled() -> bool:
+    """Check whether the database uses incremental auto-vacuum"""
+    return get_connection().execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+
+
+def enable_incremental_vacuum():
+    """
+    Switch an older database to incremental auto-vacuum (one full VACUUM).
+    Holds the write lock for the whole rebuild; run it while no one else works.
+    """
+    if incremental_vacuum_enabled():
+        return True, "Базата вече използва инкрементално компактиране."
+    con = get_connection()
+    try:
+        size_before = _database_size()
+        con.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        con.execute("VACUUM")
+        con.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+        return True, f"Базата е компактирана: {size_before / 1e6:.1f} → {_database_size() / 1e6:.1f} MB."
+    except sqlite3.Error as e:
+        return False, f"Грешка при компактиране: {str(e)}"
+
+
+def get_last_maintenance() -> Optional[Dict[str, Any]]:
+    """Most recent maintenance_log entry as a dict, or None"""
+    con = get_connection()
+    cur = con.cursor()
+    cur.execute("""
+        SELECT started_at, duration_ms, size_before, size_after,
+               freelist_before, freelist_after, quick_check, steps, errors
+        FROM maintenance_log ORDER BY id DESC LIMIT 1
+    """)
+    row = cur.fetchone()
+    if not row:
+        return None
+    keys = ('started_at', 'duration_ms', 'size_before', 'size_after',
+            'freelist_before', 'freelist_after', 'quick_check')
+    last = dict(zip(keys, row))
+    last['steps'] = json.loads(row[7] or "{}")
+    last['errors'] = json.loads(row[8] or "{}")
+    return last
+
+
+def maintenance_due(interval_hours: float = MAINTENANCE_INTERVAL_HOURS) -> bool:
+    """True when no maintenance ran in the last interval_hours"""
+    last = get_last_maintenance()
+    if last is None:
+        return True
+    started = datetime.strptime(last['started_at'], "%Y-%m-%d %H:%M:%S")
+    return datetime.now() - started >= timedelta(hours=interval_hours)
+
+# ============= DEVICE INDEX =============
+
+# The resident index keeps every expression a filter can be evaluated on
+# (see SEARCH_FILTERS), one UTF-8 buffer per expression, values separated
+# by NUL. A filter term is found with bytes.find() over the whole column
+# and each hit is mapped back to its row through the value start offsets.
+DEVICE_INDEX_COLUMNS = list(dict.fromkeys(
+    sql for _, columns in list(SEARCH_FILTERS.values()) + [PHONE_TEXT_FILTER] for _, sql, _ in columns
+))
+DEVICE_INDEX_SEPARATOR = b"\x00"
+# Later filter terms check the remaining candidates directly below this many
+DEVICE_INDEX_CHECK_LIMIT = 2000
+# Changed rows are kept aside until there are this many (or 10% of the rows), then the index is rebuilt
+DEVICE_INDEX_MAX_OVERLAY = 1000
+
+_device_index_enabled = False
+_device_index: Optional['DeviceIndex'] = None
+_device_index_lock = threading.Lock()
+
+
+class DeviceIndex:
+    """Resident column-wise snapshot of the searchable device/client fields.
+
+    Holds only device ids, the euro flags and the normalized search
+    columns, far less than the main-table rows. Writes are picked up from
+    change_log on every search: changed rows go to a small overlay and
+    their snapshot rows are masked, until the overlay is big enough to
+    rebuild.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._build()
+
+    def _select(self, where: str = "") -> str:
+        values = ", ".join(f"COALESCE({sql}, '')" for sql in DEVICE_INDEX_COLUMNS)
+        return f"""
+            SELECT d.id, d.euro_done, {values}
+            FROM devices d
+            JOIN clients c ON c.id = d.client_id
+            {where}
+        """
+
+    def _build(self):
+        # Everything is built in locals and swapped in at the end: an
+        # interrupted fetch (DeviceLoadTask.cancel) keeps the previous state
+        con = get_connection()
+        # Read the change position first: changes made during the build are applied again
+        last_seq = get_change_seq()
+        rows = con.execute(self._select()).fetchall()
+        
+        columns = {}
+        starts = {}
+        for offset, sql in enumerate(DEVICE_INDEX_COLUMNS, start=2):
+            values = [row[offset].encode('utf-8') for row in rows]
+            columns[sql] = DEVICE_INDEX_SEPARATOR.join(values)
+            starts[sql] = array('q', itertools.accumulate((len(v) + 1 for v in values[:-1]), initial=0))
+        
+        self._ids = array('q', (row[0] for row in rows))
+        self._euro = bytes(1 if row[1] else 0 for row in rows)
+        self._columns = columns
+        self._starts = starts
+        self._overlay = {}  # device id -> (euro, {sql: value}) of rows changed since the build
+        self._stale = set()  # device ids whose snapshot row is outdated or deleted
+        self.last_seq = last_seq
+
+    def __len__(self) -> int:
+        return len(self._ids) - len(self._stale) + len(self._overlay)
+
+    @property
+    def nbytes(self) -> int:
+        """Approximate memory held by the snapshot"""
+        size = sys.getsizeof(self._ids) + sys.getsizeof(self._euro)
+        for sql in DEVICE_INDEX_COLUMNS:
+            size += sys.getsizeof(self._columns[sql]) + sys.getsizeof(self._starts[sql])
+        return size
+
+    def refresh(self):
+        """Apply the writes logged in change_log since the last refresh"""
+        with self._lock:
+            self._refresh()
+
+    def _refresh(self):
+        last_seq = get_change_seq()
+        if last_seq == self.last_seq:
+            return
+        if last_seq < self.last_seq:
+            # change_log was emptied (pruned): the position is meaningless now
+            self._build()
+            return
+        
+        # Work on copies (both stay small, see the rebuild below) and swap
+        # them in only once every chunk is fetched, like _build()
+        last_seq, changed, deleted = get_device_changes(self.last_seq)
+        stale = self._stale | set(deleted) | set(changed)
+        limit = max(DEVICE_INDEX_MAX_OVERLAY, len(self._ids) // 10)
+        if len(stale) > limit:
+            # Every overlay row is also stale: no need to fetch them first
+            self._build()
+            return
+        overlay = {device_id: entry for device_id, entry in self._overlay.items() if device_id not in stale}
+        
+        con = get_connection()
+        for start in range(0, len(changed), 500):
+            chunk = changed[start:start + 500]
+            placeholders = ", ".join("?" * len(chunk))
+            for row in con.execute(self._select(f"WHERE d.id IN ({placeholders})"), chunk):
+                overlay[row[0]] = (bool(row[1]), dict(zip(DEVICE_INDEX_COLUMNS, row[2:])))
+        
+        if len(overlay) + len(stale) > limit:
+            self._build()
+            return
+        self._stale = stale
+        self._overlay = overlay
+        self.last_seq = last_seq
+
+    def _value(self, sql: str, position: int) -> bytes:
+        starts = self._starts[sql]
+        end = starts[position + 1] - 1 if position + 1 < len(starts) else len(self._columns[sql])
+        return self._columns[sql][starts[position]:end]
+
+    def _scan(self, sql: str, term: bytes) -> set:
+        """Snapshot positions whose value of column sql contains term"""
+        text = self._columns[sql]
+        starts = self._starts[sql]
+        last = len(starts) - 1
+        hits = set()
+        pos = text.find(term)
+        while pos >= 0:
+            row = bisect.bisect_right(starts, pos) - 1
+            hits.add(row)
+            if row >= last:
+                break
+            pos = text.find(term, starts[row + 1])
+        return hits
+
+    def search(self, filters: Dict[str, Any]) -> List[int]:
+        """Ids of the devices matching the filters (search_devices() semantics)"""
+        with self._lock:
+            self._refresh()
+            return self._search(filters)
+
+    def search_current(self, filters: Dict[str, Any]) -> Optional[List[int]]:
+        """Like search(), but never waits or refreshes (UI thread).
+
+        None while another thread builds or refreshes the index, or when
+        the database has changes the index has not picked up yet.
+        """
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            if get_change_seq() != self.last_seq:
+                return None
+            return self._search(filters)
+        finally:
+            self._lock.release()
+
+    def _search(self, filters: Dict[str, Any]) -> List[int]:
+        terms = _filter_terms(filters)
+        euro = bool(filters.get('euro'))
+        
+        positions = None
+        for term, _, columns in terms:
+            encoded = term.encode('utf-8')
+            if positions is not None and len(positions) < DEVICE_INDEX_CHECK_LIMIT:
+                # Few candidates left: check their values instead of scanning whole columns
+                positions = {p for p in positions
+                             if any(encoded in self._value(sql, p) for _, sql, _ in columns)}
+                continue
+            hits = set()
+            for _, sql, _ in columns:
+                hits |= self._scan(sql, encoded)
+            positions = hits if positions is None else positions & hits
+            if not positions:
+                break
+        if positions is None:
+            positions = range(len(self._ids))
+        
+        flags = self._euro
+        stale = self._stale
+        ids = [self._ids[p] for p in sorted(positions) if not euro or flags[p]]
+        if stale:
+            ids = [device_id for device_id in ids if device_id not in stale]
+        
+        for device_id, (euro_done, values) in self._overlay.items():
+            if euro and not euro_done:
+                continue
+            if all(any(term in values[sql] for _, sql, _ in columns) for term, _, columns in terms):
+                ids.append(device_id)
+        return ids
+
+
+def enable_device_index():
+    """Serve search_devices() from the resident DeviceIndex (built on first use)"""
+    global _device_index_enabled
+    _device_index_enabled = True
+
+
+def get_device_index(build: bool = True) -> Optional[DeviceIndex]:
+    """The resident DeviceIndex; None if not enabled, or not built yet and build is False"""
+    global _device_index
+    if not _device_index_enabled:
+        return None
+    if _device_index is None and build:
+        with _device_index_lock:
+            if _device_index is None:
+                _device_index = DeviceIndex()
+    return _device_index
+
+# Functions that stay unwrapped: connection plumbing, per-row helpers and
+# the diagnostics API itself
+_UNTIMED = {
+    'get_connection', 'transaction', 'cached_query', 'row_matches_filters',
+    'filter_matcher', 'is_narrower_filter', 'device_row_key', 'search_row_key',
+    'normalize_date', 'date_day', 'fold_text', 'fold_eik', 'digits_only',
+    'enable_diagnostics', 'disable_diagnostics', 'is_diagnostics_enabled',
+    'get_slow_query_threshold', 'get_slow_query_log_path', 'get_query_stats', 'get_statement_stats',
+    'reset_query_stats', 'load_diagnostics_config', 'save_diagnostics_config',
+    'get_query_cache_stats', 'clear_query_cache', 'retry_on_busy', 'enable_device_index',
+}
+
+
+def _instrument_public_functions():
+    """Replace every public function of this module with its _timed() wrapper"""
+    module_globals = globals()
+    for name, obj in list(module_globals.items()):
+        if (inspect.isfunction(obj) and obj.__module__ == __name__
+                and not name.startswith('_') and name not in _UNTIMED):
+            module_globals[name] = _timed(obj)
+
+
+# Keep at the end of the module, after every public function is defined
+_instrument_public_functions()
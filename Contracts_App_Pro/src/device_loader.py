@@ -0,0 +1,130 @@
+"""
+Background loading of the main device table.
+
+DeviceLoadTask runs on a QThreadPool worker with that thread's own
+database connection and hands the rows to the UI thread in batches
+(DeviceLoadSignals.batch), so the window stays responsive while a large
+table or search result comes in. A task that is no longer wanted is
+cancelled with cancel(): the running query is stopped through
+sqlite3.Connection.interrupt() and no further batches are sent.
+
+DeviceIndexTask builds or refreshes the resident DeviceIndex the same way,
+so neither the build nor its errors reach the UI thread directly.
+"""
+import sqlite3
+import threading
+
+from PyQt6.QtCore import QObject, QRunnable, pyqtSignal
+
+from database import (
+    get_connection, get_devices_page, get_device_count, search_devices, get_device_index, DEVICE_PAGE_SIZE
+)
+
+# The first batch is one page, so the table fills quickly; later ones are larger
+LOAD_BATCH_SIZE = 2000
+
+
+class DeviceLoadSignals(QObject):
+    """Signals of a DeviceLoadTask; every one carries the task's token"""
+    batch = pyqtSignal(int, list, int, int)  # token, rows, rows sent so far, total (-1 if unknown)
+    finished = pyqtSignal(int, int)  # token, row count
+    failed = pyqtSignal(int, str)  # token, error message
+
+
+class DeviceLoadTask(QRunnable):
+    """Load all devices (filters=None) or the search_devices() result in batches"""
+
+    def __init__(self, token, filters=None, include_archive=False):
+        super().__init__()
+        self.token = token
+        self.filters = filters
+        self.include_archive = include_archive
+        self.signals = DeviceLoadSignals()
+        self._cancelled = False
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        """Stop the task; safe to call from the UI thread at any time"""
+        with self._lock:
+            self._cancelled = True
+            # Only while run() uses the connection: the pool thread may reuse it for the next task
+            if self._connection is not None:
+                self._connection.interrupt()
+
+    def run(self):
+        with self._lock:
+            if self._cancelled:
+                return
+            self._connection = get_connection()
+        try:
+            if self.filters is None:
+                loaded = self._load_all()
+            else:
+                loaded = self._load_search()
+            if not self._cancelled:
+                self.signals.finished.emit(self.token, loaded)
+        except sqlite3.OperationalError as e:
+            if not self._cancelled:  # "interrupted" is expected after cancel()
+                self.signals.failed.emit(self.token, str(e))
+        except Exception as e:
+            self.signals.failed.emit(self.token, str(e))
+        finally:
+            with self._lock:
+                self._connection = None
+
+    def _send(self, rows, loaded, total):
+        if self._cancelled:
+            return False
+        self.signals.batch.emit(self.token, rows, loaded, total)
+        return True
+
+    def _load_all(self):
+        total = get_device_count()
+        size = DEVICE_PAGE_SIZE
+        page = get_devices_page(limit=size)
+        loaded = 0
+        while True:
+            loaded += len(page)
+            if not self._send(page, loaded, total) or len(page) < size:
+                return loaded
+            size = LOAD_BATCH_SIZE
+            page = get_devices_page(after=page[-1], limit=size)
+
+    def _load_search(self):
+        rows = search_devices(self.filters, include_archive=self.include_archive)
+        total = len(rows)
+        size = DEVICE_PAGE_SIZE
+        start = 0
+        # Always at least one batch, even for an empty result, so the table gets replaced
+        while True:
+            batch = rows[start:start + size]
+            start += len(batch)
+            if not self._send(batch, start, total) or start >= total:
+                return total
+            size = LOAD_BATCH_SIZE
+
+
+class DeviceIndexSignals(QObject):
+    """Signals of a DeviceIndexTask"""
+    finished = pyqtSignal()
+    failed = pyqtSignal(str)  # error message
+
+
+class DeviceIndexTask(QRunnable):
+    """Build the DeviceIndex (first run) or apply the changes logged since its last refresh"""
+
+    def __init__(self):
+        super().__init__()
+        self.signals = DeviceIndexSignals()
+
+    def run(self):
+        try:
+            index = get_device_index()
+            if index is not None:
+                index.refresh()
+        except Exception as e:
+            # e.g. database locked by another workstation; the next search builds it instead
+            self.signals.failed.emit(str(e))
+            return
+        self.signals.finished.emit()
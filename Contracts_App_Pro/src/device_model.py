@@ -0,0 +1,281 @@
+"""
+Table model for the main device table.
+
+Rows are kept as the tuples returned by the database module (layout of
+DEVICE_ROW_COLUMNS, or the 7 columns of get_expiring_contracts in the
+expiring view). Cell text is formatted only when the view asks for it,
+i.e. for the cells that are actually painted.
+"""
+import math
+
+from PyQt6.QtCore import Qt, QAbstractTableModel, QModelIndex
+from PyQt6.QtGui import QColor
+
+from date_utils import format_date_bg
+
+DEVICE_HEADERS = [
+    "ID", "№ Договор", "Статус", "Фирма", "ЕИК", "ДДС", "МОЛ", "Град", "ПК", "Адрес",
+    "Тел. 1", "Тел. 2", "Начална дата", "Крайна дата", "Име на обект", "Адрес на обект", "Тел. Обект",
+    "Модел", "Сериен №", "FDRID", "Номер на ФП", "№ Свидетелство", "Валидност БИМ", "Евро", "НАП Отчет"
+]
+EXPIRING_HEADERS = ["№ Договор", "Фирма", "Модел", "Сериен №", "Изтичане", "ЕИК", "Телефон"]
+
+# Column roles per view mode
+CHECK_COLUMNS = {23, 24}             # Euro, NRA report: ✓
+DATE_COLUMNS = {12, 13, 22}          # Contract start/expiry, certificate expiry
+FLOAT_CLEANUP_COLUMNS = {8, 19, 20, 21}  # PK, FDRID, FM, cert number: imported as floats
+EXPIRING_DATE_COLUMNS = {4}
+STATUS_COLUMN = 2
+
+# Rows from the archive databases carry their archive year after the last column
+ARCHIVE_YEAR_COLUMN = len(DEVICE_HEADERS)
+ARCHIVED_COLOR = QColor("#808080")
+
+# The id lookup is rebuilt after max(MIN_PENDING_SHIFTS, √rows) row
+# inserts/removals; until then a lookup replays the pending shifts, so a
+# change never renumbers all the rows below it
+MIN_PENDING_SHIFTS = 64
+
+# Proxy sort role: display text, except dates which sort by their ISO value
+SORT_ROLE = Qt.ItemDataRole.UserRole + 1
+
+
+def clean_float_str(value):
+    """Drop the ".0" of integer fields imported from Excel as floats"""
+    text = str(value) if value is not None else ""
+    if text.endswith(".0"):
+        return text[:-2]
+    return text
+
+
+class DeviceTableModel(QAbstractTableModel):
+    """Read-only model over device row tuples, addressable by device id"""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._rows = []
+        self._row_of_id = {}  # device id -> (row, shifts already applied); live rows of the normal view only
+        self._shifts = []  # (first row, delta) of the inserts/removals since the lookup was built
+        self.expiring_mode = False
+
+    # ---- Qt model interface ----
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(EXPIRING_HEADERS if self.expiring_mode else DEVICE_HEADERS)
+
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if role == Qt.ItemDataRole.DisplayRole and orientation == Qt.Orientation.Horizontal:
+            headers = EXPIRING_HEADERS if self.expiring_mode else DEVICE_HEADERS
+            if 0 <= section < len(headers):
+                return headers[section]
+        return super().headerData(section, orientation, role)
+
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.ItemFlag.NoItemFlags
+        return Qt.ItemFlag.ItemIsEnabled | Qt.ItemFlag.ItemIsSelectable
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        value = self._rows[index.row()][index.column()]
+
+        if role == Qt.ItemDataRole.DisplayRole:
+            text = self.format_value(index.column(), value)
+            if index.column() == STATUS_COLUMN and self.archive_year(index.row()) is not None:
+                return f"{text} (архив)"
+            return text
+        if role == Qt.ItemDataRole.UserRole:
+            return value
+        if role == SORT_ROLE:
+            if index.column() in (EXPIRING_DATE_COLUMNS if self.expiring_mode else DATE_COLUMNS):
+                return value or ""
+            return self.format_value(index.column(), value)
+        if role in (Qt.ItemDataRole.ForegroundRole, Qt.ItemDataRole.ToolTipRole):
+            year = self.archive_year(index.row())
+            if year is None:
+                return None
+            if role == Qt.ItemDataRole.ForegroundRole:
+                return ARCHIVED_COLOR
+            return f"Архив {year} - само за преглед"
+        return None
+
+    def format_value(self, col, value):
+        """Cell text of a raw value in the current view mode"""
+        if self.expiring_mode:
+            if col in EXPIRING_DATE_COLUMNS:
+                return format_date_bg(value)
+        elif col in CHECK_COLUMNS:
+            return "✓" if value else ""
+        elif col in DATE_COLUMNS:
+            return format_date_bg(value)
+        elif col in FLOAT_CLEANUP_COLUMNS:
+            return clean_float_str(value)
+        return str(value) if value is not None else ""
+
+    # ---- Row access ----
+
+    def rows(self):
+        """All loaded rows in model (load) order"""
+        return self._rows
+
+    def row_data(self, row):
+        """Raw tuple of a model row"""
+        return self._rows[row]
+
+    def device_id(self, row):
+        """Device id of a live model row (None in the expiring view and for archived rows)"""
+        if self.expiring_mode or self.archive_year(row) is not None:
+            return None
+        return self._rows[row][0]
+
+    def archive_year(self, row):
+        """Archive year of a row from the archive databases, None for live rows"""
+        row_data = self._rows[row]
+        if self.expiring_mode or len(row_data) <= ARCHIVE_YEAR_COLUMN:
+            return None
+        return row_data[ARCHIVE_YEAR_COLUMN]
+
+    def row_of(self, device_id):
+        """Model row of a device id, or None if it is not loaded"""
+        entry = self._row_of_id.get(device_id)
+        if entry is None:
+            return None
+        row, applied = entry
+        for first, delta in self._shifts[applied:]:
+            if row >= first:
+                row += delta
+        return row
+
+    # ---- Updates ----
+
+    def set_rows(self, rows, expiring_mode=False):
+        """Replace the contents (and the column layout, if the mode changes)"""
+        if expiring_mode != self.expiring_mode:
+            # Only a reset can change the columns; it also resets the header sections
+            self.beginResetModel()
+            self.expiring_mode = expiring_mode
+            self._rows = list(rows)
+            self._reindex()
+            self.endResetModel()
+            return
+
+        # Same columns: remove + insert keeps column widths and hidden columns
+        if self._rows:
+            self.beginRemoveRows(QModelIndex(), 0, len(self._rows) - 1)
+            self._rows = []
+            self._reindex()
+            self.endRemoveRows()
+        self.append_rows(list(rows))
+
+    def append_rows(self, rows):
+        """Append rows at the end"""
+        if not rows:
+            return
+        first = len(self._rows)
+        self.beginInsertRows(QModelIndex(), first, first + len(rows) - 1)
+        self._rows.extend(rows)
+        for offset, row_data in enumerate(rows):
+            self._store(row_data, first + offset)
+        self.endInsertRows()
+
+    def insert_row(self, row_data, key):
+        """Insert a row at its place among the loaded rows, which are in key order"""
+        row = self._position(key(row_data), key)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self._rows.insert(row, row_data)
+        self._shift(row, 1)
+        self._store(row_data, row)
+        self.endInsertRows()
+        self._compact()
+
+    def update_row(self, row_data, key=None):
+        """Replace the loaded row with the same device id; False if that device is not loaded.
+
+        With key, a row whose key changed (e.g. a new contract number) is
+        moved to its place in key order.
+        """
+        row = self.row_of(row_data[0])
+        if row is None:
+            return False
+        self._rows[row] = row_data
+        self.dataChanged.emit(self.index(row, 0), self.index(row, self.columnCount() - 1))
+        if key is not None:
+            self._keep_in_order(row, key)
+        return True
+
+    def _position(self, value, key, lo=0, hi=None):
+        """Index at which a row with key value belongs (after equal keys), by binary search"""
+        hi = len(self._rows) if hi is None else hi
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if value < key(self._rows[mid]):
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
+    def _keep_in_order(self, row, key):
+        value = key(self._rows[row])
+        if row > 0 and value < key(self._rows[row - 1]):
+            target = self._position(value, key, 0, row)
+            destination = target
+        elif row + 1 < len(self._rows) and key(self._rows[row + 1]) < value:
+            target = self._position(value, key, row + 1) - 1
+            destination = target + 1  # Qt counts the destination before the row is taken out
+        else:
+            return
+        # A move (not remove + insert) keeps the selection on the row
+        self.beginMoveRows(QModelIndex(), row, row, QModelIndex(), destination)
+        self._rows.insert(target, self._rows.pop(row))
+        self._shift(row + 1, -1)
+        self._shift(target, 1)
+        self._store(self._rows[target], target)
+        self.endMoveRows()
+        self._compact()
+
+    def remove_devices(self, device_ids):
+        """Remove the rows of the given device ids (ids that are not loaded are ignored)"""
+        rows = sorted({row for row in map(self.row_of, device_ids) if row is not None}, reverse=True)
+        # One removal per block of adjacent rows, bottom-up so the rows above keep their numbers
+        i = 0
+        while i < len(rows):
+            last = first = rows[i]
+            i += 1
+            while i < len(rows) and rows[i] == first - 1:
+                first = rows[i]
+                i += 1
+            self.beginRemoveRows(QModelIndex(), first, last)
+            for row_data in self._rows[first:last + 1]:
+                del self._row_of_id[row_data[0]]
+            del self._rows[first:last + 1]
+            self._shift(last + 1, first - last - 1)
+            self.endRemoveRows()
+        self._compact()
+
+    def _store(self, row_data, row):
+        # Archived rows are never patched (and their ids may be reused by live devices)
+        if not self.expiring_mode and len(row_data) <= ARCHIVE_YEAR_COLUMN:
+            self._row_of_id[row_data[0]] = (row, len(self._shifts))
+
+    def _shift(self, first, delta):
+        """Record that the rows from first on moved by delta"""
+        self._shifts.append((first, delta))
+
+    def _compact(self):
+        if len(self._shifts) > max(MIN_PENDING_SHIFTS, math.isqrt(len(self._rows))):
+            self._reindex()
+
+    def _reindex(self):
+        """Rebuild the id lookup from the current rows"""
+        self._shifts = []
+        if self.expiring_mode:
+            self._row_of_id = {}
+            return
+        self._row_of_id = {row_data[0]: (row, 0) for row, row_data in enumerate(self._rows)
+                           if len(row_data) <= ARCHIVE_YEAR_COLUMN}
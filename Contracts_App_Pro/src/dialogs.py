@@ -2,15 +2,15 @@ from PyQt6.QtWidgets import (
     QDialog, QFormLayout, QLineEdit, QPushButton, QVBoxLayout, QHBoxLayout,
     QComboBox, QMessageBox, QDateEdit, QCheckBox, QLabel, QTabWidget, QWidget,
     QFileDialog, QSpinBox, QCompleter, QTableWidget, QTableWidgetItem,
-    QHeaderView, QAbstractItemView, QTextEdit
+    QHeaderView, QAbstractItemView, QTextEdit, QApplication
 )
 from PyQt6.QtCore import QDate, Qt, QUrl
 from PyQt6.QtGui import QDesktopServices
 from vat_check import check_vat
 from database import (
     get_all_certificates, add_client, add_device, get_client_by_contract,
-    get_all_contract_numbers, update_device, get_device_full,
-    get_next_contract_number, get_devices_for_nra_report, add_repair_record,
+    get_all_contract_numbers, update_device, get_device_full, UpdateConflict, get_client_device_ids,
+    get_next_contract_number, allocate_contract_number, get_devices_for_nra_report, add_repair_record,
     add_product, update_product, delete_product, get_all_products
 )
 from export_excel import export_to_excel
@@ -30,6 +30,7 @@ class AddDeviceDialog(QDialog):
         super().__init__(parent)
         self.setWindowTitle("Добавяне на ново устройство")
         self.setMinimumWidth(700)
+        self.device_ids = []  # Devices written on save (the caller patches these rows)
         
         # Create tabs for better organization
         tabs = QTabWidget()
@@ -39,7 +40,8 @@ class AddDeviceDialog(QDialog):
         client_layout = QFormLayout()
         
         self.contract_number = QLineEdit()
-        self.contract_number.setText(get_next_contract_number())
+        self.suggested_contract_number = get_next_contract_number()
+        self.contract_number.setText(self.suggested_contract_number)
         self.status = QComboBox()
         self.status.addItems(["", "активен", "бракувана", "прекратен"])
         self.status.setEditable(True)
@@ -379,6 +381,11 @@ class AddDeviceDialog(QDialog):
             return
         
         try:
+            # Reserve the suggested number now: another user may have taken
+            # it since the dialog was opened
+            if self.contract_number.text().strip() == self.suggested_contract_number:
+                self.contract_number.setText(allocate_contract_number())
+            
             # Prepare client data
             client_data = {
                 'contract_number': self.contract_number.text().strip(),
@@ -437,7 +444,7 @@ class AddDeviceDialog(QDialog):
             
             # Add to database
             client_id = add_client(client_data)
-            add_device(client_id, device_data)
+            self.device_ids = [add_device(client_id, device_data)]
             
             QMessageBox.information(self, "Успех", "Устройството е добавено успешно!")
             self.accept()
@@ -453,6 +460,7 @@ class AddToExistingContractDialog(QDialog):
         super().__init__(parent)
         self.setWindowTitle("Добавяне на устройство към съществуващ договор")
         self.setMinimumWidth(600)
+        self.device_ids = []  # Devices written on save (the caller patches these rows)
         
         layout = QVBoxLayout()
         
@@ -628,7 +636,7 @@ class AddToExistingContractDialog(QDialog):
                 'bim_date': self.bim_date.date().toString('yyyy-MM-dd')
             }
             
-            add_device(self.current_client_id, device_data)
+            self.device_ids = [add_device(self.current_client_id, device_data)]
             
             QMessageBox.information(self, "Успех", "Устройството е добавено успешно!")
             self.accept()
@@ -657,6 +665,7 @@ class EditDeviceDialog(QDialog):
     def __init__(self, device_id: int, parent=None):
         super().__init__(parent)
         self.device_id = device_id
+        self.device_ids = []  # Devices changed on save: every device of the edited client
         self.setWindowTitle("Редактиране на устройство")
         self.setMinimumWidth(700)
         
@@ -666,6 +675,10 @@ class EditDeviceDialog(QDialog):
             QMessageBox.critical(self, "Грешка", "Устройството не е намерено!")
             self.reject()
             return
+        # Versions the save is checked against (another user may edit meanwhile)
+        self.client_version = device_data['client_version']
+        self.device_version = device_data['device_version']
+        self.client_id = device_data['client_id']
         
         # Create tabs
         tabs = QTabWidget()
@@ -999,12 +1012,17 @@ class EditDeviceDialog(QDialog):
                 'maintenance_price': self.maintenance_price.value()
             }
             
-            if update_device(self.device_id, client_data, device_data):
+            if update_device(self.device_id, client_data, device_data,
+                             self.client_version, self.device_version):
+                # The client columns are shown on every device row of the contract
+                self.device_ids = get_client_device_ids(self.client_id)
                 QMessageBox.information(self, "Успех", "Промените са запазени успешно!")
                 self.accept()
             else:
                 QMessageBox.critical(self, "Грешка", "Грешка при запазване на промените!")
                 
+        except UpdateConflict as e:
+            QMessageBox.warning(self, "Конфликт", str(e))
         except Exception as e:
             QMessageBox.critical(self, "Грешка", f"Грешка при запазване: {str(e)}")
 
@@ -1968,6 +1986,27 @@ class SettingsDialog(QDialog):
         main_layout.addWidget(restore_group)
         main_layout.addSpacing(20)
         
+        # One-time switch to incremental vacuum (databases from older versions)
+        from database import incremental_vacuum_enabled
+        if self.user and self.user.get('role') == 'admin' and not incremental_vacuum_enabled():
+            vacuum_group = QWidget()
+            vacuum_layout = QVBoxLayout()
+            vacuum_group.setLayout(vacuum_layout)
+            
+            vacuum_layout.addWidget(QLabel("<b>Компактиране на базата</b>"))
+            txt_vacuum = QLabel("Еднократно преструктуриране, след което автоматичната поддръжка освобождава "
+                                "неизползваното място. Базата е заключена докато трае - затворете програмата "
+                                "на другите работни станции.")
+            txt_vacuum.setWordWrap(True)
+            vacuum_layout.addWidget(txt_vacuum)
+            
+            btn_vacuum = QPushButton("🗜️ Компактирай базата")
+            btn_vacuum.clicked.connect(self.run_enable_vacuum)
+            vacuum_layout.addWidget(btn_vacuum)
+            
+            main_layout.addWidget(vacuum_group)
+            main_layout.addSpacing(20)
+        
         # Reset Section (Super Admin only)
         if self.user and self.user.get('username') == 'vladpos':
             reset_group = QWidget()
@@ -2036,6 +2075,27 @@ class SettingsDialog(QDialog):
             else:
                 QMessageBox.critical(self, "Грешка", message)
 
+    def run_enable_vacuum(self):
+        """Switch the database to incremental vacuum (full VACUUM)"""
+        confirm = QMessageBox.question(
+            self, "Потвърждение",
+            "Компактирането може да отнеме няколко минути при голяма база.\nПродължаване?",
+            QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No
+        )
+        if confirm != QMessageBox.StandardButton.Yes:
+            return
+        
+        from database import enable_incremental_vacuum
+        QApplication.setOverrideCursor(Qt.CursorShape.WaitCursor)
+        try:
+            success, message = enable_incremental_vacuum()
+        finally:
+            QApplication.restoreOverrideCursor()
+        if success:
+            QMessageBox.information(self, "Успех", message)
+        else:
+            QMessageBox.critical(self, "Грешка", message)
+
     def run_reset(self):
         """Clear the database"""
         if not self.confirm_reset_check.isChecked():
@@ -2106,7 +2166,8 @@ class NraReportDialog(QDialog):
         self.load_data()
 
     def load_data(self):
-        devices = get_devices_for_nra_report()
+        devices = get_devices_for_nra_report(columns=(
+            'contract_number', 'company_name', 'model', 'serial_number', 'nra_report_month', 'nra_td'))
         self.table.setRowCount(len(devices))
         
         for i, d in enumerate(devices):
@@ -2182,10 +2243,10 @@ class AuditLogDialog(QDialog):
     
     def load_logs(self):
         """Load audit logs from database with optional filtering"""
-        from database import DB_PATH
-        import sqlite3
+        from database import get_connection, flush_audit_log
         
-        conn = sqlite3.connect(DB_PATH)
+        flush_audit_log()
+        conn = get_connection()
         cursor = conn.cursor()
         
         query = "SELECT id, timestamp, username, action, details FROM audit_logs WHERE 1=1"
@@ -2206,7 +2267,6 @@ class AuditLogDialog(QDialog):
         
         cursor.execute(query, params)
         rows = cursor.fetchall()
-        conn.close()
         
         self.table.setRowCount(0)
         for row in rows:
@@ -2220,6 +2280,139 @@ class AuditLogDialog(QDialog):
             self.table.setItem(row_pos, 3, QTableWidgetItem(row[4] or ""))  # details
 
 
+class DiagnosticsDialog(QDialog):
+    """Dialog with database call timings and slow-query log settings (admin only)"""
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Диагностика на базата данни")
+        self.resize(900, 600)
+        
+        self.init_ui()
+        self.load_stats()
+        
+    def init_ui(self):
+        from database import is_diagnostics_enabled, get_slow_query_threshold
+        
+        layout = QVBoxLayout()
+        
+        # Settings section
+        settings_layout = QHBoxLayout()
+        self.chk_enabled = QCheckBox("Измерване на заявките")
+        self.chk_enabled.setChecked(is_diagnostics_enabled())
+        settings_layout.addWidget(self.chk_enabled)
+        
+        settings_layout.addWidget(QLabel("Праг за бавни заявки (ms):"))
+        self.spin_threshold = QSpinBox()
+        self.spin_threshold.setRange(1, 60000)
+        self.spin_threshold.setValue(int(get_slow_query_threshold()))
+        settings_layout.addWidget(self.spin_threshold)
+        
+        btn_apply = QPushButton("Приложи")
+        btn_apply.clicked.connect(self.apply_settings)
+        settings_layout.addWidget(btn_apply)
+        settings_layout.addStretch()
+        
+        layout.addLayout(settings_layout)
+        
+        # Tables: per database function and per SQL statement
+        self.table = self.create_stats_table("Функция")
+        self.statement_table = self.create_stats_table("SQL заявка")
+        tabs = QTabWidget()
+        tabs.addTab(self.table, "Функции")
+        tabs.addTab(self.statement_table, "SQL заявки")
+        layout.addWidget(tabs)
+        
+        self.lbl_cache = QLabel()
+        layout.addWidget(self.lbl_cache)
+        
+        self.lbl_maintenance = QLabel()
+        layout.addWidget(self.lbl_maintenance)
+        
+        # Buttons
+        btn_layout = QHBoxLayout()
+        btn_refresh = QPushButton("Обнови")
+        btn_refresh.clicked.connect(self.load_stats)
+        btn_layout.addWidget(btn_refresh)
+        
+        btn_reset = QPushButton("Нулирай")
+        btn_reset.clicked.connect(self.reset_stats)
+        btn_layout.addWidget(btn_reset)
+        
+        btn_log = QPushButton("Отвори лога")
+        btn_log.clicked.connect(self.open_log)
+        btn_layout.addWidget(btn_log)
+        
+        btn_close = QPushButton("Затвори")
+        btn_close.clicked.connect(self.accept)
+        btn_layout.addWidget(btn_close)
+        
+        layout.addLayout(btn_layout)
+        
+        self.setLayout(layout)
+    
+    def create_stats_table(self, name_header):
+        table = QTableWidget()
+        table.setColumnCount(6)
+        table.setHorizontalHeaderLabels([name_header, "Брой", "Общо (ms)", "Средно (ms)", "p95 (ms)", "Макс (ms)"])
+        table.setSelectionBehavior(QTableWidget.SelectionBehavior.SelectRows)
+        table.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        table.horizontalHeader().setSectionResizeMode(0, QHeaderView.ResizeMode.Stretch)
+        return table
+    
+    def fill_stats_table(self, table, stats):
+        table.setRowCount(len(stats))
+        for row_pos, entry in enumerate(stats):
+            name_item = QTableWidgetItem(entry['name'])
+            name_item.setToolTip(entry['name'])
+            table.setItem(row_pos, 0, name_item)
+            values = [entry['count'], entry['total_ms'], entry['avg_ms'], entry['p95_ms'], entry['max_ms']]
+            for col, value in enumerate(values, start=1):
+                text = str(value) if col == 1 else f"{value:.2f}"
+                item = QTableWidgetItem(text)
+                item.setTextAlignment(Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter)
+                table.setItem(row_pos, col, item)
+    
+    def load_stats(self):
+        """Fill the tables with the slowest database functions and statements first"""
+        from database import get_query_stats, get_statement_stats, get_query_cache_stats, get_last_maintenance
+        
+        self.fill_stats_table(self.table, get_query_stats())
+        self.fill_stats_table(self.statement_table, get_statement_stats())
+        
+        cache = get_query_cache_stats()
+        self.lbl_cache.setText(
+            f"Кеш на заявките: {cache.get('hits', 0)} попадения, {cache.get('misses', 0)} пропуска"
+        )
+        
+        last = get_last_maintenance()
+        if last is None:
+            self.lbl_maintenance.setText("Поддръжка на базата: все още не е изпълнявана")
+        else:
+            self.lbl_maintenance.setText(
+                f"Последна поддръжка: {last['started_at']}, "
+                f"{last['size_before'] / 1e6:.1f} → {last['size_after'] / 1e6:.1f} MB, "
+                f"{last['duration_ms']:.0f} ms, проверка: {last['quick_check']}"
+            )
+    
+    def apply_settings(self):
+        from database import save_diagnostics_config
+        save_diagnostics_config(self.chk_enabled.isChecked(), self.spin_threshold.value())
+        QMessageBox.information(self, "Диагностика", "Настройките са запазени.")
+    
+    def reset_stats(self):
+        from database import reset_query_stats
+        reset_query_stats()
+        self.load_stats()
+    
+    def open_log(self):
+        from database import get_slow_query_log_path
+        path = get_slow_query_log_path()
+        if not os.path.exists(path):
+            QMessageBox.information(self, "Диагностика", "Все още няма записани бавни заявки.")
+            return
+        QDesktopServices.openUrl(QUrl.fromLocalFile(os.path.abspath(path)))
+
+
 class DeviceHistoryDialog(QDialog):
     """Dialog to view history/dossier for a specific device or contract (admin only)"""
     def __init__(self, device_id=None, contract_number=None, parent=None):
@@ -2508,7 +2701,7 @@ class ProductDialog(QDialog):
         
         try:
             if self.is_edit:
-                if update_product(self.product_data['id'], data):
+                if update_product(self.product_data['id'], data, self.product_data.get('row_version')):
                     self.accept()
                 else:
                     QMessageBox.warning(self, "Грешка", "Не бе извършена промяна.")
@@ -2517,6 +2710,8 @@ class ProductDialog(QDialog):
                     self.accept()
                 else:
                     QMessageBox.warning(self, "Грешка", "Грешка при запис.")
+        except UpdateConflict as e:
+            QMessageBox.warning(self, "Конфликт", str(e))
         except Exception as e:
             QMessageBox.critical(self, "Грешка", f"Грешка при базата данни: {str(e)}")
 
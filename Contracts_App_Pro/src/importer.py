@@ -1,6 +1,6 @@
 import pandas as pd
-from database import get_connection, add_client, add_device
-from typing import Dict, Any
+from typing import Optional
+from database import transaction, add_clients_bulk, add_devices_bulk, normalize_date
 
 
 def safe_str(value) -> str:
@@ -13,34 +13,43 @@ def safe_str(value) -> str:
     return str(value).strip()
 
 
-def safe_date(value) -> str:
-    """Convert value to date string, handling NaN"""
+# Unrecognised dates listed in the import message (the rest are only counted)
+MAX_LISTED_WARNINGS = 10
+
+
+def safe_date(value, warnings: Optional[list] = None, cell: str = "") -> str:
+    """Convert value to an ISO date string, handling NaN.
+
+    Cells that are not a recognisable date are left empty and, if a
+    warnings list is given, reported there with their cell reference.
+    """
     if pd.isna(value):
         return ""
-    if isinstance(value, str):
-        return value
-    # If it's a datetime object
     try:
-        return value.strftime('%Y-%m-%d')
-    except:
-        return str(value)
+        return normalize_date(value) or ""
+    except ValueError:
+        if warnings is not None:
+            warnings.append(f"{cell}: {str(value).strip()}")
+        return ""
 
 
-def import_from_excel(excel_path: str) -> tuple[int, int]:
+def import_from_excel(excel_path: str) -> tuple[int, int, list]:
     """
     Import contracts and devices from Excel file.
-    Returns (clients_count, devices_count)
+    Returns (clients_count, devices_count, warnings); warnings name the
+    cells (e.g. "D12") whose dates were not recognised and left empty.
     """
     df = pd.read_excel(excel_path, header=None)
     
-    clients_added = 0
-    devices_added = 0
-    
     # Group by contract number to handle multiple devices per contract
-    contract_groups = {}
+    contract_groups = {}  # contract_num -> index into clients
+    clients = []
+    devices = []  # (client index, device_data)
+    warnings = []
     
     for idx, row in df.iterrows():
         contract_num = safe_str(row[0])  # Column A
+        sheet_row = idx + 1
         
         if not contract_num:
             continue
@@ -49,8 +58,8 @@ def import_from_excel(excel_path: str) -> tuple[int, int]:
         client_data = {
             'contract_number': contract_num,
             'status': safe_str(row[1]),  # B
-            'contract_start': safe_date(row[2]),  # C
-            'contract_expiry': safe_date(row[3]),  # D
+            'contract_start': safe_date(row[2], warnings, f"C{sheet_row}"),  # C
+            'contract_expiry': safe_date(row[3], warnings, f"D{sheet_row}"),  # D
             'company_name': safe_str(row[4]),  # E
             'city': safe_str(row[5]),  # F
             'postal_code': safe_str(row[6]),  # G
@@ -71,7 +80,7 @@ def import_from_excel(excel_path: str) -> tuple[int, int]:
             'object_phone': safe_str(row[20]),  # U
             'model': safe_str(row[21]),  # V
             'certificate_number': safe_str(row[22]),  # W
-            'certificate_expiry': safe_date(row[23]),  # X
+            'certificate_expiry': safe_date(row[23], warnings, f"X{sheet_row}"),  # X
             'serial_number': safe_str(row[24]),  # Y
             'fiscal_memory': safe_str(row[25])  # Z
         }
@@ -79,18 +88,17 @@ def import_from_excel(excel_path: str) -> tuple[int, int]:
         # Check if we already have this contract
         if contract_num not in contract_groups:
             # New contract - add client
-            client_id = add_client(client_data)
-            contract_groups[contract_num] = client_id
-            clients_added += 1
-        else:
-            # Existing contract - use existing client_id
-            client_id = contract_groups[contract_num]
+            contract_groups[contract_num] = len(clients)
+            clients.append(client_data)
         
-        # Add device
-        add_device(client_id, device_data)
-        devices_added += 1
+        devices.append((contract_groups[contract_num], device_data))
+    
+    # Write everything in one transaction: all rows are committed or none
+    with transaction():
+        client_ids = add_clients_bulk(clients)
+        add_devices_bulk([(client_ids[idx], data) for idx, data in devices])
     
-    return clients_added, devices_added
+    return len(clients), len(devices), warnings
 
 
 def import_contracts_simple(excel_path: str) -> str:
@@ -99,7 +107,13 @@ def import_contracts_simple(excel_path: str) -> str:
     Returns status message.
     """
     try:
-        clients, devices = import_from_excel(excel_path)
-        return f"Успешно импортирани:\n{clients} договора\n{devices} устройства"
+        clients, devices, warnings = import_from_excel(excel_path)
+        message = f"Успешно импортирани:\n{clients} договора\n{devices} устройства"
+        if warnings:
+            message += f"\n\nНеразпознати дати, оставени празни ({len(warnings)}):\n"
+            message += "\n".join(warnings[:MAX_LISTED_WARNINGS])
+            if len(warnings) > MAX_LISTED_WARNINGS:
+                message += "\n..."
+        return message
     except Exception as e:
         return f"Грешка при импорт: {str(e)}"
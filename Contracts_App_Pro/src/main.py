@@ -1,21 +1,27 @@
 import sys
 import os
+import time
+import threading
 from datetime import datetime
 
 from PyQt6.QtWidgets import (
-    QApplication, QMainWindow, QTableWidget, QTableWidgetItem,
+    QApplication, QMainWindow, QTableWidget, QTableWidgetItem, QTableView,
     QPushButton, QVBoxLayout, QWidget, QHBoxLayout, QLineEdit,
     QCheckBox, QMessageBox, QFileDialog, QStatusBar, QMenu, QToolBar,
     QSplashScreen, QProgressBar, QLabel, QToolButton, QDialog, QComboBox,
-    QTabWidget
+    QTabWidget, QInputDialog
 )
-from PyQt6.QtCore import Qt, QTimer, QSize, QUrl
+from PyQt6.QtCore import Qt, QTimer, QSize, QUrl, QEvent, pyqtSignal, QSortFilterProxyModel, QThreadPool
 from PyQt6.QtGui import QAction, QIcon, QPixmap, QDesktopServices
 
 from database import (
-    init_db, get_all_devices, search_devices, delete_device,
+    init_db, delete_device, row_matches_filters, filter_matcher, is_narrower_filter,
+    ChangeWatcher, get_device_rows, device_row_key, search_row_key, CHANGE_POLL_INTERVAL_MS,
+    run_maintenance, maintenance_due,
     get_client_by_contract, get_devices_by_contract,
-    get_all_products, search_products, delete_product, get_db_stats
+    get_all_products, search_products, delete_product, get_db_stats,
+    load_diagnostics_config, enable_diagnostics,
+    enable_device_index, get_device_index
 )
 from contract_generator import generate_service_contract, generate_nap_xml
 from dialogs import (
@@ -25,7 +31,8 @@ from dialogs import (
 )
 from importer import import_contracts_simple
 from bim_loader import load_certificates_safe
-from date_utils import format_date_bg
+from device_model import DeviceTableModel, SORT_ROLE
+from device_loader import DeviceLoadTask, DeviceIndexTask
 from path_utils import get_resource_path
 from database import log_action
 
@@ -63,11 +70,14 @@ class SplashScreen(QSplashScreen):
 def backup_database():
     """Backup database to backups/ folder (zipped)"""
     try:
-        from database import DB_PATH
+        from database import DB_PATH, checkpoint_database
         import zipfile
         
         if not os.path.exists(DB_PATH):
             return
+        
+        # Recent commits may still sit in contracts.db-wal
+        checkpoint_database()
 
         backup_dir = os.path.join(os.path.dirname(DB_PATH), "..", "backups")
         os.makedirs(backup_dir, exist_ok=True)
@@ -153,7 +163,25 @@ class SplashScreen(QSplashScreen):
         QApplication.processEvents()
 
 
+# Filter boxes re-search this long after the last keystroke
+FILTER_DEBOUNCE_MS = 250
+# Without the device index, narrowing is done in memory only up to this many
+# loaded rows (~one frame); larger results are searched again on the load worker
+NARROW_IN_MEMORY_MAX_ROWS = 5000
+
+# Database maintenance starts after this long without keyboard/mouse input
+MAINTENANCE_IDLE_SECONDS = 300
+MAINTENANCE_CHECK_INTERVAL_MS = 60_000
+
+INPUT_EVENTS = (
+    QEvent.Type.KeyPress, QEvent.Type.MouseButtonPress,
+    QEvent.Type.MouseMove, QEvent.Type.Wheel,
+)
+
+
 class MainWindow(QMainWindow):
+    maintenance_finished = pyqtSignal(dict)
+    
     def __init__(self):
         super().__init__()
         self.setWindowTitle("Регистър на фискални устройства")
@@ -188,10 +216,39 @@ class MainWindow(QMainWindow):
         self.setStatusBar(self.statusBar)
         self.statusBar.showMessage("Готов")
         
+        # Table loads run on their own pool threads (each keeps its database connection)
+        self.load_pool = QThreadPool(self)
+        self.load_pool.setMaxThreadCount(2)
+        self.load_pool.setExpiryTimeout(-1)
+        self.load_task = None
+        # Build the resident device index (see enable_device_index) off the UI thread
+        self.index_task = None
+        self.update_device_index()
+        self._load_token = 0
+        self.pages_pending = False
+        self.current_filters = None
+        self.current_archive = False
+        self.row_order_key = device_row_key  # order of the loaded rows, for patching
+        
         # Initial status
+        self.change_watcher = ChangeWatcher()
         self.refresh_table()
         self.refresh_products()
         
+        # Pick up rows changed by other workstations using the same database
+        self.change_timer = QTimer(self)
+        self.change_timer.timeout.connect(self.check_external_changes)
+        self.change_timer.start(CHANGE_POLL_INTERVAL_MS)
+        
+        # Database maintenance runs in a worker thread when the user is idle
+        self.last_activity = time.monotonic()
+        self.maintenance_running = False
+        self.maintenance_finished.connect(self.on_maintenance_finished)
+        QApplication.instance().installEventFilter(self)
+        self.maintenance_timer = QTimer(self)
+        self.maintenance_timer.timeout.connect(self.maybe_run_maintenance)
+        self.maintenance_timer.start(MAINTENANCE_CHECK_INTERVAL_MS)
+        
         self.current_user = None
 
     def setup_device_tab(self):
@@ -202,23 +259,19 @@ class MainWindow(QMainWindow):
         filter_panel = self.create_filter_panel()
         layout.addLayout(filter_panel)
         
-        # Create table
-        self.table = QTableWidget()
-        self.table.setColumnCount(25)
-        self.table.setHorizontalHeaderLabels([
-            "ID", "№ Договор", "Статус", "Фирма", "ЕИК", "ДДС", "МОЛ", "Град", "ПК", "Адрес", 
-            "Тел. 1", "Тел. 2", "Старт Договор", "Край Договор", "Име Обект", "Адрес Обект", "Тел. Обект",
-            "Модел", "Сериен №", "ИН на ФУ", "Фис. Памет", "№ Свид. БИМ", "Валидност БИМ", "Евро", "НАП Отчет"
-        ])
+        # Create table: a model over the raw rows, sorted through a proxy
+        self.device_model = DeviceTableModel(self)
+        self.device_proxy = QSortFilterProxyModel(self)
+        self.device_proxy.setSourceModel(self.device_model)
+        self.device_proxy.setSortRole(SORT_ROLE)
         
-        # Hide ID column
-        self.table.setColumnHidden(0, True)
+        self.table = QTableView()
+        self.table.setModel(self.device_proxy)
+        # Keep the database order (contract number) until a header is clicked
+        self.table.horizontalHeader().setSortIndicator(-1, Qt.SortOrder.AscendingOrder)
         self.table.setSortingEnabled(True)
-        
-        # Set column widths
-        widths = [0, 80, 80, 200, 90, 50, 120, 80, 50, 200, 90, 90, 90, 90, 120, 200, 90, 120, 100, 100, 100, 80, 90, 50, 60]
-        for i, w in enumerate(widths):
-            self.table.setColumnWidth(i, w)
+        self.expiring_mode = False
+        self.set_device_columns()
             
         self.table.doubleClicked.connect(self.edit_selected_device)
         self.table.setContextMenuPolicy(Qt.ContextMenuPolicy.CustomContextMenu)
@@ -226,6 +279,39 @@ class MainWindow(QMainWindow):
         
         layout.addWidget(self.table)
 
+    def set_device_columns(self):
+        """Column widths and the hidden ID column of the device view"""
+        # Hide ID column
+        self.table.setColumnHidden(0, not self.expiring_mode)
+        if self.expiring_mode:
+            return
+        
+        # Set column widths
+        widths = [0, 80, 80, 200, 90, 50, 120, 80, 50, 200, 90, 90, 90, 90, 120, 200, 90, 120, 100, 100, 100, 80, 90, 50, 60]
+        for i, w in enumerate(widths):
+            self.table.setColumnWidth(i, w)
+    
+    def device_id_at(self, row):
+        """Device id of a row of the (sorted) device view, None in the expiring view"""
+        source = self.device_proxy.mapToSource(self.device_proxy.index(row, 0))
+        return self.device_model.device_id(source.row())
+    
+    def is_archived_at(self, row):
+        """Whether a row of the (sorted) device view comes from the archive databases"""
+        source = self.device_proxy.mapToSource(self.device_proxy.index(row, 0))
+        return self.device_model.archive_year(source.row()) is not None
+    
+    def warn_if_archived(self, row):
+        """Tell the user an archived row is read-only; True if it is archived"""
+        if not self.is_archived_at(row):
+            return False
+        QMessageBox.information(self, "Архив", "Устройството е от архива и е само за преглед.")
+        return True
+    
+    def cell_text(self, row, col):
+        """Displayed text of a cell of the (sorted) device view"""
+        return self.device_proxy.index(row, col).data() or ""
+    
     def setup_product_tab(self):
         layout = QVBoxLayout()
         self.product_tab.setLayout(layout)
@@ -383,6 +469,7 @@ class MainWindow(QMainWindow):
             
             # Helper for ID
             item_id = QTableWidgetItem(str(p['id']))
+            item_id.setData(Qt.ItemDataRole.UserRole, p['row_version'])
             self.product_table.setItem(row, 0, item_id)
             
             self.product_table.setItem(row, 1, QTableWidgetItem(p['name']))
@@ -436,7 +523,8 @@ class MainWindow(QMainWindow):
             'category': self.product_table.item(row, 2).text(),
             'price': float(self.product_table.item(row, 3).text()),
             'currency': self.product_table.item(row, 4).text(),
-            'description': self.product_table.item(row, 6).text()
+            'description': self.product_table.item(row, 6).text(),
+            'row_version': self.product_table.item(row, 0).data(Qt.ItemDataRole.UserRole)
         }
         
         dialog = ProductDialog(product_data=data, parent=self)
@@ -617,6 +705,14 @@ class MainWindow(QMainWindow):
         action_audit.triggered.connect(self.show_audit_log)
         toolbar.addAction(action_audit)
         
+        action_diagnostics = QAction("🩺 Диагностика", self)
+        action_diagnostics.triggered.connect(self.show_diagnostics)
+        toolbar.addAction(action_diagnostics)
+        
+        action_archive = QAction("🗄 Архивиране", self)
+        action_archive.triggered.connect(self.archive_old_contracts)
+        toolbar.addAction(action_archive)
+        
         toolbar.addSeparator()
         
         # Standalone: Обнови
@@ -662,17 +758,17 @@ class MainWindow(QMainWindow):
         
         self.f_company = QLineEdit()
         self.f_company.setPlaceholderText("Фирма...")
-        self.f_company.textChanged.connect(self.apply_filters)
+        self.f_company.textChanged.connect(self.schedule_filters)
         row1.addWidget(self.f_company)
         
         self.f_eik = QLineEdit()
         self.f_eik.setPlaceholderText("ЕИК...")
-        self.f_eik.textChanged.connect(self.apply_filters)
+        self.f_eik.textChanged.connect(self.schedule_filters)
         row1.addWidget(self.f_eik)
         
         self.f_contract = QLineEdit()
         self.f_contract.setPlaceholderText("№ Договор...")
-        self.f_contract.textChanged.connect(self.apply_filters)
+        self.f_contract.textChanged.connect(self.schedule_filters)
         row1.addWidget(self.f_contract)
         
         layout.addLayout(row1)
@@ -682,30 +778,41 @@ class MainWindow(QMainWindow):
         
         self.f_phone = QLineEdit()
         self.f_phone.setPlaceholderText("Телефон...")
-        self.f_phone.textChanged.connect(self.apply_filters)
+        self.f_phone.textChanged.connect(self.schedule_filters)
         row2.addWidget(self.f_phone)
         
         self.f_address = QLineEdit()
         self.f_address.setPlaceholderText("Адрес...")
-        self.f_address.textChanged.connect(self.apply_filters)
+        self.f_address.textChanged.connect(self.schedule_filters)
         row2.addWidget(self.f_address)
         
         self.f_serial = QLineEdit()
         self.f_serial.setPlaceholderText("Сериен номер...")
-        self.f_serial.textChanged.connect(self.apply_filters)
+        self.f_serial.textChanged.connect(self.schedule_filters)
         row2.addWidget(self.f_serial)
         
         self.f_euro = QCheckBox("Само с направено ЕВРО")
-        self.f_euro.stateChanged.connect(self.apply_filters)
+        self.f_euro.stateChanged.connect(lambda: self.apply_filters())
         row2.addWidget(self.f_euro)
         
+        self.f_archive = QCheckBox("Включи архива")
+        self.f_archive.setToolTip("Търси и в архивираните стари договори")
+        self.f_archive.stateChanged.connect(lambda: self.apply_filters())
+        row2.addWidget(self.f_archive)
+        
         layout.addLayout(row2)
         
         # Row 3: Action buttons
         row3 = QHBoxLayout()
         
+        # Typing re-filters once the user pauses
+        self.filter_timer = QTimer(self)
+        self.filter_timer.setSingleShot(True)
+        self.filter_timer.setInterval(FILTER_DEBOUNCE_MS)
+        self.filter_timer.timeout.connect(self.apply_filters)
+        
         btn_search = QPushButton("🔍 Търси")
-        btn_search.clicked.connect(self.apply_filters)
+        btn_search.clicked.connect(lambda: self.apply_filters(narrow=False))
         row3.addWidget(btn_search)
         
         btn_clear = QPushButton("🔄 Изчисти филтри")
@@ -719,76 +826,198 @@ class MainWindow(QMainWindow):
         return layout
     
     def refresh_table(self):
-        """Reload all devices into table"""
+        """Reload all devices into table in the background, first page first"""
         self.statusBar.showMessage("Зареждане на данни...")
-        data = get_all_devices()
-        self.load_table(data)
-        self.statusBar.showMessage(f"Заредени {len(data)} записа")
+        self.start_load()
+    
+    def start_load(self, filters=None, include_archive=False):
+        """Load all devices (filters=None) or a search result on a worker thread"""
+        self.cancel_load()
+        self.current_filters = filters
+        self.current_archive = include_archive
+        self.row_order_key = device_row_key if filters is None else search_row_key
+        self.pages_pending = True
+        self.change_watcher.reset()
+        
+        task = DeviceLoadTask(self._load_token, filters, include_archive)
+        task.signals.batch.connect(self.on_load_batch)
+        task.signals.finished.connect(self.on_load_finished)
+        task.signals.failed.connect(self.on_load_failed)
+        self.load_task = task
+        self.load_pool.start(task)
+    
+    def cancel_load(self):
+        """Stop the running load; batches it already sent are ignored (token check)"""
+        self._load_token += 1
+        self.pages_pending = False
+        if self.load_task is not None:
+            self.load_task.cancel()
+            self.load_task = None
+    
+    def on_load_batch(self, token, rows, loaded, total):
+        """Show a batch of the running load: the first one replaces the table"""
+        if token != self._load_token:
+            return
+        if loaded == len(rows):
+            self.show_rows(rows)
+        else:
+            self.append_rows(rows)
+        
+        verb = "Заредени" if self.current_filters is None else "Намерени"
+        if loaded < total:
+            self.statusBar.showMessage(f"{verb} {loaded} от {total} записа...")
+    
+    def on_load_finished(self, token, count):
+        if token != self._load_token:
+            return
+        self.load_task = None
+        self.pages_pending = False
+        verb = "Заредени" if self.current_filters is None else "Намерени"
+        self.statusBar.showMessage(f"{verb} {count} записа")
+    
+    def on_load_failed(self, token, message):
+        if token != self._load_token:
+            return
+        self.load_task = None
+        self.pages_pending = False
+        self.statusBar.showMessage(f"Грешка при зареждане: {message}", 10000)
+    
+    def update_device_index(self):
+        """Build or refresh the resident device index on a pool thread (one task at a time)"""
+        if self.index_task is not None:
+            return
+        self.index_task = DeviceIndexTask()
+        self.index_task.signals.finished.connect(self.on_index_updated)
+        self.index_task.signals.failed.connect(self.on_index_failed)
+        self.load_pool.start(self.index_task)
+    
+    def on_index_updated(self):
+        self.index_task = None
+    
+    def on_index_failed(self, message):
+        self.index_task = None
+        self.statusBar.showMessage(f"Индексът за търсене не е зареден: {message}", 10000)
     
     def load_table(self, data, expiring_mode=False):
         """Load data into table"""
-        self.table.setSortingEnabled(False)
-        self.table.setRowCount(0)
-        
-        # Adjust columns for expiring mode
-        if expiring_mode:
-            self.table.setColumnCount(7)
-            self.table.setHorizontalHeaderLabels([
-                "№ Договор", "Фирма", "Модел", "Сериен №", "Изтичане", "ЕИК", "Телефон"
-            ])
-        else:
-            self.table.setColumnCount(25)
-            self.table.setHorizontalHeaderLabels([
-                "ID", "№ Договор", "Статус", "Фирма", "ЕИК", "ДДС", "МОЛ", "Град", "ПК", "Адрес", 
-                "Тел. 1", "Тел. 2", "Начална дата", "Крайна дата", "Име на обект", "Адрес на обект", "Тел. Обект",
-                "Модел", "Сериен №", "FDRID", "Номер на ФП", "№ Свидетелство", "Валидност БИМ", "Евро", "НАП Отчет"
-            ])
-            self.table.setColumnHidden(0, True)
-        
-        for row_data in data:
-            row = self.table.rowCount()
-            self.table.insertRow(row)
-            
-            for col, value in enumerate(row_data):
-                display_value = ""
-                
-                # Helper to clean ".0" from likely integer fields imported as floats
-                def clean_float_str(val):
-                    s = str(val) if val is not None else ""
-                    if s.endswith(".0"):
-                        return s[:-2]
-                    return s
-
-                # Euro column (23) and NRA (24)
-                if not expiring_mode and (col == 23 or col == 24):
-                    display_value = "✓" if value else ""
-                
-                # Date columns: Contract Start (12), Contract Expiry (13), Cert Expiry (22)
-                elif (not expiring_mode and col in [12, 13, 22]) or (expiring_mode and col == 4):
-                    display_value = format_date_bg(value)
-                
-                # Columns that need ".0" cleanup: 
-                # PK (8), FDRID (19), FM (20), Cert Num (21)
-                elif not expiring_mode and col in [8, 19, 20, 21]:
-                    display_value = clean_float_str(value)
-                
-                else:
-                    display_value = str(value) if value is not None else ""
-                
-                item = QTableWidgetItem(display_value)
-                item.setFlags(item.flags() ^ Qt.ItemFlag.ItemIsEditable) # Make items non-editable by default
-                
-                # Make ID column data accessible but hidden
-                if not expiring_mode and col == 0:
-                    item.setData(Qt.ItemDataRole.UserRole, value)
-                
-                self.table.setItem(row, col, item)
+        # A load still running belongs to the previous contents
+        self.cancel_load()
+        self.current_filters = None
+        self.show_rows(data, expiring_mode)
+    
+    def show_rows(self, data, expiring_mode=False):
+        """Replace the table contents, switching the column layout if needed"""
+        mode_changed = expiring_mode != self.expiring_mode
+        self.expiring_mode = expiring_mode
+        self.device_model.set_rows(data, expiring_mode)
+        if mode_changed:
+            self.set_device_columns()
+    
+    def append_rows(self, data):
+        """Append rows to the table in the current column mode"""
+        self.device_model.append_rows(data)
+    
+    def check_external_changes(self):
+        """Patch rows changed by other workstations into the open table"""
+        # Expiring view has its own columns; a table still paging in will be complete anyway
+        if self.expiring_mode or self.pages_pending:
+            return
         
-        self.table.setSortingEnabled(True)
+        changes = self.change_watcher.poll()
+        if not changes:
+            return
+        patched = self.patch_devices(*changes)
+        if patched:
+            self.statusBar.showMessage(f"Обновени {patched} записа от друга работна станция", 5000)
     
-    def apply_filters(self):
-        """Apply search filters"""
-        self.statusBar.showMessage("Търсене...")
+    def apply_own_changes(self, changed_ids, deleted_ids=()):
+        """Patch the rows of devices this window just added, edited or deleted"""
+        if self.expiring_mode or self.pages_pending:
+            self.refresh_table()
+            return
+        
+        # Move the watcher past our own write, or a later poll would report it as
+        # someone else's; changes from other workstations logged meanwhile come along
+        logged_changed, logged_deleted = self.change_watcher.advance()
+        changed_ids = list(changed_ids) + logged_changed
+        deleted_ids = list(deleted_ids) + logged_deleted
+        self.patch_devices(list(dict.fromkeys(changed_ids)), list(dict.fromkeys(deleted_ids)))
+    
+    def patch_devices(self, changed_ids, deleted_ids):
+        """Re-read the changed devices and patch them into the table; returns the rows touched (0 on reload)"""
+        # A large batch (e.g. an Excel import elsewhere) is cheaper to reload
+        if len(changed_ids) + len(deleted_ids) > 2000:
+            if self.current_filters is None:
+                self.refresh_table()
+            else:
+                self.apply_filters(narrow=False)
+            return 0
+        
+        rows = get_device_rows(changed_ids)
+        found = {row_data[0] for row_data in rows}
+        removed = list(deleted_ids) + [device_id for device_id in changed_ids if device_id not in found]
+        self.patch_rows(rows, removed)
+        return len(rows) + len(removed)
+    
+    def eventFilter(self, obj, event):
+        """Remember the time of the last user input (for idle maintenance)"""
+        if event.type() in INPUT_EVENTS:
+            self.last_activity = time.monotonic()
+        return super().eventFilter(obj, event)
+    
+    def maybe_run_maintenance(self):
+        """Start database maintenance in the background if the user is idle and it is due"""
+        if self.maintenance_running:
+            return
+        if time.monotonic() - self.last_activity < MAINTENANCE_IDLE_SECONDS:
+            return
+        if not maintenance_due():
+            return
+        
+        self.maintenance_running = True
+        self.statusBar.showMessage("Поддръжка на базата данни...")
+        threading.Thread(target=self.maintenance_worker, daemon=True).start()
+    
+    def maintenance_worker(self):
+        """Worker thread: run maintenance and hand the result back to the UI thread"""
+        try:
+            result = run_maintenance()
+        except Exception as e:
+            result = {'errors': {'maintenance': str(e)}}
+        self.maintenance_finished.emit(result)
+    
+    def on_maintenance_finished(self, result):
+        self.maintenance_running = False
+        if 'size_after' not in result:
+            self.statusBar.showMessage(f"Поддръжката на базата не успя: {result['errors']}", 10000)
+            return
+        self.statusBar.showMessage(
+            f"Поддръжка на базата: {result['size_before'] / 1e6:.1f} → {result['size_after'] / 1e6:.1f} MB "
+            f"за {result['duration_ms'] / 1000:.1f} s, проверка: {result['quick_check']}", 10000
+        )
+    
+    def patch_rows(self, rows, removed_ids):
+        """Update, insert or remove only the given rows of the device table"""
+        hidden = list(removed_ids)
+        
+        for row_data in rows:
+            visible = self.current_filters is None or row_matches_filters(row_data, self.current_filters)
+            if not visible:
+                hidden.append(row_data[0])
+            elif not self.device_model.update_row(row_data, self.row_order_key):
+                # New rows go to their place in load order (what the unsorted view shows)
+                self.device_model.insert_row(row_data, self.row_order_key)
+        
+        # A sorted proxy re-sorts patched rows; either way the selection stays on them
+        self.device_model.remove_devices(hidden)
+    
+    def schedule_filters(self):
+        """Re-filter FILTER_DEBOUNCE_MS after the last keystroke"""
+        self.filter_timer.start()
+    
+    def apply_filters(self, narrow=True):
+        """Apply search filters; narrow=False always searches the database"""
+        self.filter_timer.stop()
         
         filters = {
             'company': self.f_company.text().strip(),
@@ -800,9 +1029,41 @@ class MainWindow(QMainWindow):
             'euro': self.f_euro.isChecked()
         }
         
-        data = search_devices(filters)
-        self.load_table(data)
-        self.statusBar.showMessage(f"Намерени {len(data)} записа")
+        include_archive = self.f_archive.isChecked()
+        if narrow and self.narrow_loaded_rows(filters, include_archive):
+            return
+        self.statusBar.showMessage("Търсене...")
+        self.start_load(filters, include_archive=include_archive)
+    
+    def narrow_loaded_rows(self, filters, include_archive):
+        """Filter the loaded rows in memory if the new filters only narrow the current result.
+
+        True if done; otherwise the search has to go to the database.
+        """
+        if self.pages_pending or self.expiring_mode or include_archive != self.current_archive:
+            return False
+        if not is_narrower_filter(self.current_filters or {}, filters):
+            return False
+        
+        rows = self.device_model.rows()
+        index = get_device_index(build=False)
+        # Only an idle, up-to-date index: a refresh or rebuild must not run (or be waited for) here
+        matched = index.search_current(filters) if index is not None and not include_archive else None
+        if index is not None and matched is None:
+            self.update_device_index()
+        if matched is not None:
+            # Column scans on the index, then a set lookup per loaded row
+            keep = set(matched)
+            narrowed = [row for row in rows if row[0] in keep]
+        elif len(rows) <= NARROW_IN_MEMORY_MAX_ROWS:
+            matches = filter_matcher(filters)
+            narrowed = [row for row in rows if matches(row)]
+        else:
+            return False
+        self.show_rows(narrowed)
+        self.current_filters = filters
+        self.statusBar.showMessage(f"Намерени {len(narrowed)} записа")
+        return True
     
     def clear_filters(self):
         """Clear all filters and reload"""
@@ -813,24 +1074,24 @@ class MainWindow(QMainWindow):
         self.f_address.clear()
         self.f_serial.clear()
         self.f_euro.setChecked(False)
+        self.f_archive.setChecked(False)
+        self.filter_timer.stop()
         self.refresh_table()
     
     def add_device(self):
         """Open add device dialog"""
         dialog = AddDeviceDialog(self)
         if dialog.exec():
-            self.refresh_table()
+            self.apply_own_changes(dialog.device_ids)
             if self.current_user:
-                # We need to capture the new device ID and contract number for better logging. 
-                # Ideally AddDeviceDialog would return them, but for now we log generic.
-                # Or we can improve AddDeviceDialog later. 
-                log_action(self.current_user['id'], self.current_user['username'], "ADD_DEVICE", "Added new device")
+                device_id = dialog.device_ids[0] if dialog.device_ids else None
+                log_action(self.current_user['id'], self.current_user['username'], "ADD_DEVICE", f"Added new device ID {device_id}", device_id=device_id)
     
     def add_to_existing_contract(self):
         """Open add to existing contract dialog"""
         dialog = AddToExistingContractDialog(self)
         if dialog.exec():
-            self.refresh_table()
+            self.apply_own_changes(dialog.device_ids)
     
     def edit_selected_device(self):
         """Edit the selected device"""
@@ -842,14 +1103,18 @@ class MainWindow(QMainWindow):
         
         # Get device ID from first column (hidden)
         row = selected_rows[0].row()
-        device_id = int(self.table.item(row, 0).text())
+        if self.warn_if_archived(row):
+            return
+        device_id = self.device_id_at(row)
+        if device_id is None:
+            return
+        # Contract number for logging, read before the row is patched
+        contract_num = self.cell_text(row, 1)
         
         dialog = EditDeviceDialog(device_id, self)
         if dialog.exec():
-            self.refresh_table()
+            self.apply_own_changes(dialog.device_ids or [device_id])
             if self.current_user:
-                # Retrieve contract number for logging
-                contract_num = self.table.item(row, 3).text()
                 log_action(self.current_user['id'], self.current_user['username'], "EDIT_DEVICE", f"Edited device ID {device_id}", contract_number=contract_num, device_id=device_id)
     
     def delete_selected_device(self):
@@ -859,6 +1124,8 @@ class MainWindow(QMainWindow):
         if not selected_rows:
             QMessageBox.warning(self, "Внимание", "Моля, изберете устройство за изтриване!")
             return
+        if self.warn_if_archived(selected_rows[0].row()):
+            return
         
         # Confirm deletion
         reply = QMessageBox.question(
@@ -870,13 +1137,15 @@ class MainWindow(QMainWindow):
         
         if reply == QMessageBox.StandardButton.Yes:
             row = selected_rows[0].row()
-            device_id = int(self.table.item(row, 0).text())
+            device_id = self.device_id_at(row)
+            if device_id is None:
+                return
+            contract_num = self.cell_text(row, 1)
             
             if delete_device(device_id):
                 QMessageBox.information(self, "Успех", "Устройството е изтрито!")
-                self.refresh_table()
+                self.apply_own_changes([], [device_id])
                 if self.current_user:
-                    contract_num = self.table.item(row, 3).text()
                     log_action(self.current_user['id'], self.current_user['username'], "DELETE_DEVICE", f"Deleted device ID {device_id}", contract_number=contract_num, device_id=device_id)
             else:
                 QMessageBox.critical(self, "Грешка", "Грешка при изтриване!")
@@ -913,6 +1182,13 @@ class MainWindow(QMainWindow):
             history_action = menu.addAction("📁 Електронно досие (История)")
             menu.addSeparator()
             
+        # Archived rows are read-only: only copying applies to them
+        if self.is_archived_at(index.row()):
+            for menu_action in menu.actions():
+                menu_action.setEnabled(False)
+            menu.addAction("🗄 Архивиран запис - само за преглед").setEnabled(False)
+            menu.addSeparator()
+        
         # New copy actions
         copy_cell_action = menu.addAction("📋 Копирай клетка")
         copy_row_action = menu.addAction("📄 Копирай ред")
@@ -945,8 +1221,8 @@ class MainWindow(QMainWindow):
     def show_device_history(self, index):
         """Show history for the device/contract at the given index"""
         row = index.row()
-        device_id = int(self.table.item(row, 0).text())
-        contract_num = self.table.item(row, 3).text()
+        device_id = self.device_id_at(row)
+        contract_num = self.cell_text(row, 1)
         
         from dialogs import DeviceHistoryDialog
         dialog = DeviceHistoryDialog(device_id=device_id, contract_number=contract_num, parent=self)
@@ -988,8 +1264,7 @@ class MainWindow(QMainWindow):
             return
             
         row = selected_rows[0].row()
-        item = self.table.item(row, 0)
-        device_id = item.data(Qt.ItemDataRole.UserRole)
+        device_id = self.device_id_at(row)
         
         from database import get_device_full
         from contract_generator import generate_registration_certificate
@@ -999,7 +1274,7 @@ class MainWindow(QMainWindow):
         
         # Map DB fields to what generator expects
         client_data = full_data 
-        device = full_data
+        device = full_data.as_dict()
         device['bim_number'] = full_data.get('certificate_number', '')
         
         try:
@@ -1017,7 +1292,7 @@ class MainWindow(QMainWindow):
 
     def generate_nap_file(self):
         """Generate NAP XML for selected device and service technician from settings"""
-        row = self.table.currentRow()
+        row = self.table.currentIndex().row()
         if row < 0:
             QMessageBox.warning(self, "Грешка", "Моля, изберете ред от таблицата.")
             return
@@ -1041,7 +1316,7 @@ class MainWindow(QMainWindow):
             return
 
         # Data from Table (ID is in column 0, hidden)
-        device_id = int(self.table.item(row, 0).text())
+        device_id = self.device_id_at(row)
         
         from database import get_device_full
         full_data = get_device_full(device_id)
@@ -1079,11 +1354,11 @@ class MainWindow(QMainWindow):
         
         if selected_rows:
             row = selected_rows[0].row()
-            item = self.table.item(row, 0)
-            device_id = item.data(Qt.ItemDataRole.UserRole)
+            device_id = self.device_id_at(row)
             from database import get_device_full
             device_data = get_device_full(device_id)
             if device_data:
+                device_data = device_data.as_dict()
                 device_data['bim_number'] = device_data.get('certificate_number', '')
 
         from dialogs import DeregistrationDialog
@@ -1159,19 +1434,16 @@ class MainWindow(QMainWindow):
 
     def copy_cell_to_clipboard(self, row, col):
         """Copy single cell text to clipboard"""
-        item = self.table.item(row, col)
-        if item:
-            QApplication.clipboard().setText(item.text())
-            self.statusBar.showMessage("Клетката е копирана", 3000)
+        QApplication.clipboard().setText(self.cell_text(row, col))
+        self.statusBar.showMessage("Клетката е копирана", 3000)
 
     def copy_row_to_clipboard(self, row):
         """Copy entire row text to clipboard (tab-separated)"""
         row_data = []
-        for col in range(self.table.columnCount()):
+        for col in range(self.device_proxy.columnCount()):
             if self.table.isColumnHidden(col):
                 continue
-            item = self.table.item(row, col)
-            row_data.append(item.text() if item else "")
+            row_data.append(self.cell_text(row, col))
         
         row_text = "\t".join(row_data)
         QApplication.clipboard().setText(row_text)
@@ -1237,6 +1509,55 @@ class MainWindow(QMainWindow):
         dialog = AuditLogDialog(self)
         dialog.exec()
 
+    def show_diagnostics(self):
+        """Show database timing statistics (admin only)"""
+        if not self.current_user or self.current_user.get('role') != 'admin':
+            QMessageBox.warning(self, "Грешка", "Само администраторът има достъп до диагностиката!")
+            return
+            
+        from dialogs import DiagnosticsDialog
+        dialog = DiagnosticsDialog(self)
+        dialog.exec()
+
+    def archive_old_contracts(self):
+        """Move long-expired contracts into the per-year archive databases (admin only)"""
+        if not self.current_user or self.current_user.get('role') != 'admin':
+            QMessageBox.warning(self, "Грешка", "Само администраторът може да архивира договори!")
+            return
+        
+        from database import archive_expired_contracts, ARCHIVE_AFTER_YEARS
+        years, ok = QInputDialog.getInt(
+            self, "Архивиране",
+            "Архивирай договори, изтекли преди повече от (години):",
+            ARCHIVE_AFTER_YEARS, 1, 50
+        )
+        if not ok:
+            return
+        
+        reply = QMessageBox.question(
+            self, "Потвърждение",
+            f"Договорите, изтекли преди повече от {years} г., ще бъдат преместени в архива "
+            "заедно с устройствата, ремонтите и одита им. Продължаване?",
+            QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No
+        )
+        if reply != QMessageBox.StandardButton.Yes:
+            return
+        
+        self.statusBar.showMessage("Архивиране...")
+        try:
+            moved = archive_expired_contracts(years)
+        except Exception as e:
+            QMessageBox.critical(self, "Грешка", f"Грешка при архивиране: {str(e)}")
+            return
+        
+        clients = sum(counts['clients'] for counts in moved.values())
+        devices = sum(counts['devices'] for counts in moved.values())
+        log_action(self.current_user['id'], self.current_user['username'], "ARCHIVE",
+                   f"Archived {clients} contracts / {devices} devices older than {years} years")
+        self.refresh_table()
+        QMessageBox.information(self, "Архивиране",
+                                f"Архивирани {clients} договора с {devices} устройства.")
+
 
     def generate_repair_protocol_action(self):
         """Open repair protocol dialog for selected device"""
@@ -1246,20 +1567,20 @@ class MainWindow(QMainWindow):
             return
             
         row = selected_rows[0].row()
-        device_id = int(self.table.item(row, 0).text())
+        device_id = self.device_id_at(row)
         
         dialog = RepairProtocolDialog(device_id, self)
         dialog.exec()
 
     def generate_selected_contract(self):
         """Generate service contract from template for selected device's contract"""
-        row = self.table.currentRow()
+        row = self.table.currentIndex().row()
         if row < 0:
             QMessageBox.warning(self, "Грешка", "Моля, изберете ред от таблицата.")
             return
 
         # Get contract number from column 1
-        contract_num = self.table.item(row, 1).text()
+        contract_num = self.cell_text(row, 0 if self.expiring_mode else 1)
         
         if not contract_num:
             QMessageBox.warning(self, "Грешка", "Липсва номер на договор за този ред.")
@@ -1312,8 +1633,7 @@ class MainWindow(QMainWindow):
             return
             
         row = selected_rows[0].row()
-        item = self.table.item(row, 0)
-        device_id = item.data(Qt.ItemDataRole.UserRole)
+        device_id = self.device_id_at(row)
         
         from database import get_device_full
         
@@ -1384,6 +1704,13 @@ def main():
     # Initialize database
     init_db()
     
+    diagnostics = load_diagnostics_config()
+    if diagnostics['enabled']:
+        enable_diagnostics(diagnostics['threshold_ms'])
+    
+    # Searches and filter narrowing run on the resident device index
+    enable_device_index()
+    
     # Run Backup BEFORE showing UI
     backup_database()
     
@@ -1404,6 +1731,9 @@ def main():
         window.set_user(login.user)
         window.show()
         
+        from database import close_connections
+        app.aboutToQuit.connect(close_connections)
+        
         sys.exit(app.exec())
     else:
         sys.exit(0)
@@ -0,0 +1,127 @@
+"""
+Benchmark for the database layer (Contracts_App_Pro/src/database.py).
+
+Builds a throw-away database with 50 000 devices and compares the cost of
+one lookup through a fresh sqlite3.connect() per call (the old behaviour)
+against the pooled long-lived connection. Also times a cold start
+(new connection + init_db) on the already-migrated database.
+
+Usage:
+    python bench_db.py [devices]
+"""
+import os
+import sys
+import time
+import random
+import sqlite3
+import tempfile
+
+# Add src to path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "Contracts_App_Pro", "src"))
+
+import database
+
+
+def build_database(path, device_count):
+    """Create schema and fill it with device_count devices (3 per contract)"""
+    database.set_db_path(path)
+    database.init_db()
+
+    con = database.get_connection()
+    client_rows = []
+    for n in range(1, device_count // 3 + 2):
+        client_rows.append((
+            str(n), "Активен", "2025-01-01", "2026-01-01",
+            f"Фирма {n} ЕООД", "София", "1000", f"ул. Тестова {n}",
+            str(200000000 + n), "Да", "Иван Иванов", f"0888/{n % 1000:03d}-{n % 997:03d}", ""
+        ))
+    with con:
+        con.executemany("""
+            INSERT INTO clients (
+                contract_number, status, contract_start, contract_expiry,
+                company_name, city, postal_code, address,
+                eik, vat_registered, mol, phone1, phone2
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, client_rows)
+        con.executemany("""
+            INSERT INTO devices (client_id, fdrid, model, serial_number, fiscal_memory, object_address)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, [
+            (i // 3 + 1, str(4000000 + i), "Tremol S25", f"ZK{i:06d}", str(50000000 + i), f"ул. Обект {i}")
+            for i in range(device_count)
+        ])
+    # Raw inserts above skip the normalized search columns the app fills on write
+    database.rebuild_normalized_columns()
+
+
+def time_calls(label, func, ids):
+    start = time.perf_counter()
+    for device_id in ids:
+        func(device_id)
+    elapsed = time.perf_counter() - start
+    per_call_us = elapsed / len(ids) * 1_000_000
+    print(f"{label:<40} {elapsed * 1000:9.1f} ms total  {per_call_us:8.1f} us/call")
+    return per_call_us
+
+
+def fresh_connection_lookup(device_id):
+    """Old pattern: open, query, close on every call"""
+    con = sqlite3.connect(database.DB_PATH)
+    cur = con.cursor()
+    cur.execute("""
+        SELECT d.id, c.contract_number, c.company_name, d.serial_number
+        FROM devices d JOIN clients c ON c.id = d.client_id
+        WHERE d.id = ?
+    """, (device_id,))
+    cur.fetchone()
+    con.close()
+
+
+def pooled_lookup(device_id):
+    cur = database.get_connection().cursor()
+    cur.execute("""
+        SELECT d.id, c.contract_number, c.company_name, d.serial_number
+        FROM devices d JOIN clients c ON c.id = d.client_id
+        WHERE d.id = ?
+    """, (device_id,))
+    cur.fetchone()
+
+
+def time_cold_start(path, runs=30):
+    """Median time of set_db_path + init_db on an up-to-date database"""
+    timings = []
+    for _ in range(runs):
+        database.set_db_path(path)
+        start = time.perf_counter()
+        database.init_db()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    print(f"{'cold start (connect + init_db)':<40} {timings[len(timings) // 2]:9.2f} ms median")
+
+
+def main():
+    device_count = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    calls = 2_000
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        print(f"Building database with {device_count} devices...")
+        build_database(path, device_count)
+
+        rnd = random.Random(42)
+        ids = [rnd.randint(1, device_count) for _ in range(calls)]
+
+        print(f"\n{calls} single-device lookups:")
+        old = time_calls("fresh connection per call", fresh_connection_lookup, ids)
+        new = time_calls("pooled connection", pooled_lookup, ids)
+        time_calls("get_device_full (pooled)", database.get_device_full, ids)
+        print(f"\nSaving per call: {old - new:.1f} us ({old / new:.1f}x faster)")
+
+        print()
+        time_cold_start(path)
+
+        database.close_connections()
+
+
+if __name__ == "__main__":
+    main()
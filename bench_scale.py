@@ -0,0 +1,225 @@
+"""
+Scale benchmark for Contracts_App_Pro.
+
+Generates synthetic datasets (see gen_dataset.py) at the requested sizes
+and times the operations that grow with the number of devices: the main
+table load, searches, dashboard statistics, the NRA report (fiskal.ser),
+the Excel import and the Excel/Word/PDF exporters. Results are written as
+JSON so runs can be compared with --compare.
+
+Benchmarks whose optional dependency (pandas, openpyxl, python-docx,
+reportlab) is not installed are recorded as skipped.
+
+Usage:
+    python bench_scale.py [sizes...] [--output results.json] [--keep DIR]
+                          [--repeat N] [--compare old.json]
+
+    sizes default to 10000 100000; add 1000000 for the full run.
+    --keep DIR stores the generated databases in DIR and reuses them.
+"""
+import os
+import sys
+import json
+import time
+import platform
+import sqlite3
+import tempfile
+import statistics
+from datetime import date, datetime
+
+# Add src to path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "Contracts_App_Pro", "src"))
+
+import database
+from gen_dataset import generate_dataset
+
+SEED = 42
+IMPORT_ROWS = 1000
+EXPORT_HEADERS = ["№ Договор", "Фирма", "Модел", "Сериен №", "Изтичане", "ЕИК", "Телефон"]
+SERVICE_DATA = {
+    "name": "Сервиз Тест ЕООД", "eik": "123456789", "city": "София", "address": "ул. Витоша 1",
+    "phone1": "0888123456", "tech_f": "Иван", "tech_l": "Иванов", "tech_egn": "0000000000",
+}
+
+
+def time_call(func, repeat, setup=None):
+    """Run func repeat times and return timing stats in milliseconds"""
+    timings = []
+    result = None
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        result = func()
+        timings.append((time.perf_counter() - start) * 1000)
+    stats = {
+        'median_ms': round(statistics.median(timings), 3),
+        'min_ms': round(min(timings), 3),
+        'max_ms': round(max(timings), 3),
+        'runs': repeat,
+    }
+    if isinstance(result, (list, tuple)):
+        stats['rows'] = len(result)
+    return stats
+
+
+def write_import_workbook(path, rows, first_contract):
+    """Excel file in the column layout import_from_excel expects (A..Z)"""
+    from openpyxl import Workbook
+    wb = Workbook()
+    ws = wb.active
+    for n in range(rows):
+        contract = first_contract + n // 2
+        ws.append([
+            str(contract), "Активен", "01.01.2025", "01.01.2026", f"Импорт {contract} ЕООД",  # A-E
+            "София", "1000", f"ул. Импортна {n}", "", "", "Иван Иванов", str(5_000_000 + n),  # F-L
+            "123456789", "Да", "э", "", "0888123456", "", f"Обект {n}", f"ул. Обектова {n}",  # M-T
+            "", "Tremol S25", "1234/2020", "31.12.2027", f"IM{n:06d}", str(70_000_000 + n),  # U-Z
+        ])
+    wb.save(path)
+
+
+def run_size(device_count, repeat, keep_dir, tmp):
+    data_dir = keep_dir or tmp
+    path = os.path.join(data_dir, f"contracts_{device_count}_{SEED}.db")
+    if keep_dir and os.path.exists(path):
+        print(f"Reusing {path}")
+        database.set_db_path(path)
+        database.init_db()
+        dataset = {'devices': device_count, 'reused': True, 'size_bytes': os.path.getsize(path)}
+    else:
+        print(f"Generating {device_count} devices...")
+        dataset = generate_dataset(path, device_count, SEED)
+
+    results = {}
+
+    def bench(name, func, setup=None, times=repeat):
+        try:
+            results[name] = time_call(func, times, setup)
+        except ImportError as e:
+            results[name] = {'skipped': str(e)}
+        print(f"  {name:<34} " + (
+            f"{results[name]['median_ms']:10.2f} ms" if 'median_ms' in results[name]
+            else f"skipped ({results[name]['skipped']})"))
+
+    today = date.today()
+    bench("get_all_devices (cold)", database.get_all_devices, setup=database.clear_query_cache)
+    bench("get_all_devices (cached)", database.get_all_devices)
+    bench("get_devices_page", database.get_devices_page)
+    bench("search_devices company", lambda: database.search_devices({'company': "Балкан"}))
+    bench("search_devices serial", lambda: database.search_devices({'serial': "ZK0001"}))
+    bench("search_devices phone", lambda: database.search_devices({'phone': "0888/1"}))
+    bench("search_devices address", lambda: database.search_devices({'address': "Витоша 1"}))
+    bench("search_devices euro", lambda: database.search_devices({'euro': True}))
+    index = database.DeviceIndex()
+    results['device_index_bytes'] = {'bytes': index.nbytes, 'devices': len(index)}
+    bench("DeviceIndex build", database.DeviceIndex, times=1)
+    bench("DeviceIndex.search company", lambda: index.search({'company': "Балкан"}))
+    bench("DeviceIndex.search serial", lambda: index.search({'serial': "ZK0001"}))
+    bench("DeviceIndex.search phone", lambda: index.search({'phone': "0888/1"}))
+    bench("get_db_stats", database.get_db_stats)
+    bench("get_expiring_contracts", lambda: database.get_expiring_contracts(today.month, today.year))
+    bench("get_devices_for_nra_report", database.get_devices_for_nra_report)
+
+    out_dir = os.path.join(tmp, "out")
+    os.makedirs(out_dir, exist_ok=True)
+
+    def fiskal_ser():
+        from contract_generator import generate_fiskal_ser
+        devices = database.get_devices_for_nra_report()
+        return generate_fiskal_ser(SERVICE_DATA, devices, out_dir)
+    bench("generate_fiskal_ser", fiskal_ser)
+
+    expiring = database.get_expiring_contracts(today.month, today.year)
+
+    def exporter(module, func_name, ext):
+        def run():
+            func = getattr(__import__(module), func_name)
+            return func(expiring, EXPORT_HEADERS, os.path.join(out_dir, f"export.{ext}"))
+        return run
+    bench(f"export_to_excel ({len(expiring)} rows)", exporter("export_excel", "export_to_excel", "xlsx"))
+    bench(f"export_to_word ({len(expiring)} rows)", exporter("export_word", "export_to_word", "docx"))
+    bench(f"export_to_pdf ({len(expiring)} rows)", exporter("export_pdf", "export_to_pdf", "pdf"))
+
+    # Import runs once: every run adds IMPORT_ROWS devices to the dataset
+    def import_excel():
+        import pandas  # noqa: F401 - import_from_excel needs it
+        from importer import import_from_excel
+        workbook = os.path.join(out_dir, "import.xlsx")
+        first_contract = int(database.get_next_contract_number())
+        write_import_workbook(workbook, IMPORT_ROWS, first_contract)
+        start = time.perf_counter()
+        import_from_excel(workbook)
+        return (time.perf_counter() - start) * 1000
+    try:
+        elapsed = import_excel()
+        results[f"import_from_excel ({IMPORT_ROWS} rows)"] = {'median_ms': round(elapsed, 3), 'runs': 1}
+        print(f"  {'import_from_excel':<34} {elapsed:10.2f} ms")
+    except ImportError as e:
+        results[f"import_from_excel ({IMPORT_ROWS} rows)"] = {'skipped': str(e)}
+        print(f"  {'import_from_excel':<34} skipped ({e})")
+
+    database.close_connections()
+    if not keep_dir:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    return {'dataset': dataset, 'results': results}
+
+
+def compare(old_path, new_report):
+    """Print median ratios new/old for every benchmark present in both runs"""
+    with open(old_path, 'r', encoding='utf-8') as f:
+        old_report = json.load(f)
+    print(f"\nCompared with {old_path} ({old_report.get('created', '?')}):")
+    for size, run in new_report['sizes'].items():
+        old_results = old_report.get('sizes', {}).get(size, {}).get('results', {})
+        print(f"  {size} devices")
+        for name, stats in run['results'].items():
+            old = old_results.get(name, {})
+            if 'median_ms' in stats and old.get('median_ms'):
+                ratio = stats['median_ms'] / old['median_ms']
+                print(f"    {name:<34} {old['median_ms']:10.2f} -> {stats['median_ms']:10.2f} ms  ({ratio:.2f}x)")
+
+
+def main():
+    args = sys.argv[1:]
+    options = {'--output': None, '--keep': None, '--repeat': "5", '--compare': None}
+    sizes = []
+    i = 0
+    while i < len(args):
+        if args[i] in options:
+            options[args[i]] = args[i + 1]
+            i += 2
+        else:
+            sizes.append(int(args[i]))
+            i += 1
+    sizes = sizes or [10_000, 100_000]
+    repeat = int(options['--repeat'])
+    output = options['--output'] or os.path.join(
+        "bench_results", f"scale_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+
+    report = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'seed': SEED,
+        'repeat': repeat,
+        'sizes': {},
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        for device_count in sizes:
+            report['sizes'][str(device_count)] = run_size(device_count, repeat, options['--keep'], tmp)
+
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\nResults saved to {output}")
+
+    if options['--compare']:
+        compare(options['--compare'], report)
+
+
+if __name__ == "__main__":
+    main()
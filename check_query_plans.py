@@ -0,0 +1,172 @@
+"""
+EXPLAIN QUERY PLAN regression check for Contracts_App_Pro/src/database.py.
+
+Builds a seeded throw-away database, calls every query function of the
+database module and captures the SQL it issues (trace callback). Each
+statement is run through EXPLAIN QUERY PLAN. Calls marked as indexed must
+not fall back to a full SCAN of any table; the others are only reported.
+
+Exit code is 1 when an indexed call scans, so the script can gate a
+release build.
+
+Usage:
+    python check_query_plans.py [-v] [devices]
+"""
+import os
+import sys
+import tempfile
+
+# Add src to path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "Contracts_App_Pro", "src"))
+
+import database
+from bench_db import build_database
+
+# Statements that have no useful plan
+SKIPPED_PREFIXES = ("PRAGMA", "BEGIN", "COMMIT", "ROLLBACK", "SAVEPOINT", "RELEASE", "--")
+
+# Scans that are fine for a given indexed call
+ALLOWED_SCANS = {
+    # First page walks idx_contract_key in order and stops at LIMIT
+    "get_devices_page": ("SCAN c USING INDEX idx_contract_key",),
+}
+
+
+def seed_extra(device_count):
+    """Audit, repair, product and certificate rows on top of bench_db's clients/devices"""
+    con = database.get_connection()
+    with con:
+        con.executemany("""
+            INSERT INTO audit_logs (user_id, username, action, details, timestamp, contract_number, device_id)
+            VALUES (1, 'admin', 'Редакция', '', '2025-01-01 10:00:00', ?, ?)
+        """, [(str(i // 3 + 1), i + 1) for i in range(0, device_count, 2)])
+        con.executemany("""
+            INSERT INTO repair_history (device_id, problem_description, repair_date, protocol_path)
+            VALUES (?, 'Не включва', '2025-03-01', '')
+        """, [(i + 1,) for i in range(0, device_count, 5)])
+        con.executemany("""
+            INSERT INTO products (name, category, price, description) VALUES (?, ?, ?, '')
+        """, [(f"Продукт {i}", f"Категория {i % 20}", i / 10) for i in range(2000)])
+        con.executemany("INSERT INTO certificates (number, expiry_date) VALUES (?, '2027-01-01')",
+                        [(f"C{i:05d}",) for i in range(2000)])
+        con.execute("INSERT INTO users (username, password_hash, full_name, role) VALUES ('admin', '', 'Админ', 'admin')")
+
+
+def query_cases(device_count):
+    """(label, indexed, call) for every query function of the module"""
+    mid = device_count // 2
+    contract = str(mid // 3 + 1)
+    device = database.get_device_full(mid)
+    client_data = device.as_dict()
+    first_page = database.get_devices_page(limit=100)
+    return [
+        ("get_client_by_contract", True, lambda: database.get_client_by_contract(contract)),
+        ("get_devices_by_contract", True, lambda: database.get_devices_by_contract(contract)),
+        ("get_client_device_ids", True, lambda: database.get_client_device_ids(device['client_id'])),
+        ("get_all_contract_numbers", False, database.get_all_contract_numbers),
+        ("get_device_full", True, lambda: database.get_device_full(mid)),
+        ("update_device", True, lambda: database.update_device(mid, client_data, client_data)),
+        ("get_all_devices", False, database.get_all_devices),
+        ("get_devices_page", True, lambda: database.get_devices_page(limit=100)),
+        ("get_devices_page (next)", True, lambda: database.get_devices_page(after=first_page[-1], limit=100)),
+        ("get_device_count", False, database.get_device_count),
+        ("get_devices_for_nra_report", False, database.get_devices_for_nra_report),
+        ("get_change_seq", True, database.get_change_seq),
+        ("get_device_changes", True, lambda: database.get_device_changes(database.get_change_seq() - 1)),
+        ("get_changes_since", True, lambda: database.get_changes_since("2999-01-01 00:00:00")),
+        ("get_device_rows", True, lambda: database.get_device_rows([1, mid, device_count])),
+        ("search_devices (company)", True, lambda: database.search_devices({'company': f"Фирма {mid // 3}"})),
+        ("search_devices (serial)", True, lambda: database.search_devices({'serial': f"ZK{mid:06d}"})),
+        ("search_devices (phone+address)", True, lambda: database.search_devices({'phone': '0888', 'address': f"Обект {mid}"})),
+        ("get_next_contract_number", True, database.get_next_contract_number),
+        ("allocate_contract_number", True, database.allocate_contract_number),
+        ("get_expiring_contracts", True, lambda: database.get_expiring_contracts(1, 2026)),
+        ("get_all_certificates", False, database.get_all_certificates),
+        ("get_certificate_expiry", True, lambda: database.get_certificate_expiry("C00100")),
+        ("get_user_by_username", True, lambda: database.get_user_by_username("admin")),
+        ("get_all_users", False, database.get_all_users),
+        ("get_device_history", True, lambda: database.get_device_history(mid)),
+        ("get_contract_history", True, lambda: database.get_contract_history(contract)),
+        ("get_repair_history", True, lambda: database.get_repair_history(mid)),
+        ("get_all_products", False, database.get_all_products),
+        ("search_products", False, lambda: database.search_products("Продукт 1")),
+        ("get_db_stats", False, database.get_db_stats),
+        ("delete_device", True, lambda: database.delete_device(device_count)),
+    ]
+
+
+def capture_statements(call):
+    """Run call() and return the SQL statements it executed on the shared connection"""
+    con = database.get_connection()
+    statements = []
+    database.clear_query_cache()
+    con.set_trace_callback(statements.append)
+    try:
+        call()
+    finally:
+        con.set_trace_callback(None)
+    # FTS5 queries its shadow tables itself, always as 'main'.'<table>'
+    return [s for s in statements
+            if not s.lstrip().upper().startswith(SKIPPED_PREFIXES) and "'main'." not in s]
+
+
+def explain(statement):
+    """EXPLAIN QUERY PLAN detail lines for an (already expanded) statement"""
+    cur = database.get_connection().cursor()
+    cur.execute("EXPLAIN QUERY PLAN " + statement)
+    return [row[3] for row in cur.fetchall()]
+
+
+def is_full_scan(detail):
+    """SCAN of a table or covering index; FTS MATCH lookups and constant rows are fine"""
+    if not detail.startswith("SCAN ") or detail == "SCAN CONSTANT ROW":
+        return False
+    if "VIRTUAL TABLE INDEX" in detail:
+        # FTS5 reports its constraints after the colon ("0:M9" = MATCH); none means a full scan
+        return detail.rstrip().endswith(":")
+    return True
+
+
+def main():
+    args = [a for a in sys.argv[1:] if a != "-v"]
+    verbose = "-v" in sys.argv[1:]
+    device_count = int(args[0]) if args else 20_000
+    failures = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "plans.db")
+        print(f"Building database with {device_count} devices...")
+        build_database(path, device_count)
+        seed_extra(device_count)
+
+        for label, indexed, call in query_cases(device_count):
+            scans = []
+            plans = []
+            for statement in capture_statements(call):
+                details = explain(statement)
+                plans.append((statement, details))
+                allowed = ALLOWED_SCANS.get(label, ())
+                scans.extend(d for d in details if is_full_scan(d) and d not in allowed)
+
+            status = "ok"
+            if scans:
+                status = "SCAN" if indexed else "scan (expected)"
+            if indexed and scans:
+                failures.append(label)
+            print(f"{label:<36} {len(plans):3d} statements  {status}")
+            if verbose or (indexed and scans):
+                for statement, details in plans:
+                    print("    " + " ".join(statement.split())[:160])
+                    for detail in details:
+                        print("        " + detail)
+
+        database.close_connections()
+
+    if failures:
+        print(f"\n{len(failures)} indexed queries fall back to a full scan: {', '.join(failures)}")
+        sys.exit(1)
+    print("\nAll indexed queries use an index.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+"""
+Synthetic dataset generator for Contracts_App_Pro.
+
+Fills a database with realistic-looking Bulgarian clients, fiscal devices,
+BIM certificates, audit log entries and repair history, so performance can
+be reproduced at real scale (10k, 100k, 1M devices). Rows are written
+through database.add_clients_bulk / add_devices_bulk, the same path the
+Excel import uses, so every trigger and index is maintained as in
+production. Output is deterministic for a given seed.
+
+The app itself can be pointed at a generated file with the
+CONTRACTS_DB_PATH environment variable.
+
+Usage:
+    python gen_dataset.py <devices> [output.db] [--seed N]
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+from datetime import date, timedelta
+
+# Add src to path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "Contracts_App_Pro", "src"))
+
+import database
+
+CITIES = [
+    ("София", "1000"), ("Пловдив", "4000"), ("Варна", "9000"), ("Бургас", "8000"),
+    ("Русе", "7000"), ("Стара Загора", "6000"), ("Плевен", "5800"), ("Сливен", "8800"),
+    ("Добрич", "9300"), ("Шумен", "9700"), ("Перник", "2300"), ("Хасково", "6300"),
+    ("Ямбол", "8600"), ("Пазарджик", "4400"), ("Благоевград", "2700"), ("Велико Търново", "5000"),
+    ("Враца", "3000"), ("Габрово", "5300"), ("Асеновград", "4230"), ("Видин", "3700"),
+    ("Казанлък", "6100"), ("Кюстендил", "2500"), ("Кърджали", "6600"), ("Монтана", "3400"),
+]
+STREETS = [
+    "ул. Витоша", "бул. Христо Ботев", "ул. Васил Левски", "бул. България", "ул. Иван Вазов",
+    "ул. Раковски", "бул. Цар Освободител", "ул. Шипка", "ул. Граф Игнатиев", "ул. Алеко Константинов",
+    "ул. Опълченска", "бул. Княгиня Мария Луиза", "ул. Хан Аспарух", "ул. Славянска", "ул. Гладстон",
+    "ул. Любен Каравелов", "бул. Македония", "ул. Цар Симеон", "ул. Съединение", "ул. Мир",
+]
+FIRST_NAMES = [
+    "Иван", "Георги", "Димитър", "Петър", "Николай", "Христо", "Стоян", "Тодор", "Васил", "Атанас",
+    "Мария", "Елена", "Йорданка", "Пенка", "Даниела", "Силвия", "Надежда", "Гергана", "Весела", "Цветелина",
+]
+LAST_NAMES = [
+    "Иванов", "Георгиев", "Димитров", "Петров", "Николов", "Христов", "Стоянов", "Тодоров",
+    "Василев", "Атанасов", "Попов", "Костов", "Маринов", "Колев", "Янков", "Ангелов",
+]
+BUSINESSES = [
+    "Хранителни стоки", "Аптека", "Кафе", "Пекарна", "Автосервиз", "Бензиностанция", "Книжарница",
+    "Цветарски магазин", "Фризьорски салон", "Строителни материали", "Ресторант", "Минимаркет",
+    "Оптика", "Зоомагазин", "Железария", "Пицария", "Месарница", "Павилион",
+]
+COMPANY_WORDS = [
+    "Алфа", "Бета", "Вега", "Зора", "Изгрев", "Балкан", "Родопа", "Странджа", "Пирин", "Марица",
+    "Янтра", "Дунав", "Черноморец", "Тракия", "Мизия", "Орбита", "Прогрес", "Елит", "Стил", "Експрес",
+]
+LEGAL_FORMS = ["ЕООД", "ООД", "ЕТ", "АД", "ЕАД"]
+# (model, serial prefix, certificate number)
+MODELS = [
+    ("Tremol S25", "ZK", "1234"), ("Tremol M23", "ZK", "1287"), ("Datecs DP-25", "DT", "1301"),
+    ("Datecs DP-150", "DT", "1342"), ("Datecs WP-50", "DT", "1388"), ("Daisy Compact S", "DY", "1410"),
+    ("Daisy Perfect M", "DY", "1425"), ("Eltrade A3", "ED", "1456"), ("Incotex 133", "IN", "1470"),
+    ("Tremol FP01", "ZK", "1502"),
+]
+STATUSES = ["Активен"] * 8 + ["Изтекъл", "Прекратен"]
+AUDIT_ACTIONS = ["ADD_DEVICE", "EDIT_DEVICE", "RENEW_CONTRACT", "GEN_CONTRACT", "GEN_REPAIR"]
+PROBLEMS = [
+    "Не включва", "Не печата", "Грешка във фискалната памет", "Счупен дисплей",
+    "Не отпечатва касова бележка", "Проблем с връзката към НАП", "Смяна на батерия",
+]
+
+CHUNK = 10_000
+
+
+def make_eik(rnd):
+    """9-digit EIK (BULSTAT) with a valid check digit"""
+    digits = [rnd.randint(1, 9)] + [rnd.randint(0, 9) for _ in range(7)]
+    check = sum(d * w for d, w in zip(digits, range(1, 9))) % 11
+    if check == 10:
+        check = sum(d * w for d, w in zip(digits, range(3, 11))) % 11 % 10
+    return "".join(map(str, digits)) + str(check)
+
+
+def make_phone(rnd):
+    return f"08{rnd.choice('789')}{rnd.randint(0, 9)}/{rnd.randint(0, 999):03d}-{rnd.randint(0, 999):03d}"
+
+
+def make_person(rnd):
+    return f"{rnd.choice(FIRST_NAMES)} {rnd.choice(LAST_NAMES)}"
+
+
+def make_client(rnd, contract_number, today):
+    city, postal_code = rnd.choice(CITIES)
+    start = today - timedelta(days=rnd.randint(0, 3 * 365))
+    status = rnd.choice(STATUSES)
+    company = f"{rnd.choice(COMPANY_WORDS)} {rnd.choice(COMPANY_WORDS)}-{rnd.randint(1, 99)} {rnd.choice(LEGAL_FORMS)}"
+    return {
+        'contract_number': str(contract_number),
+        'status': status,
+        'contract_start': start.isoformat(),
+        'contract_expiry': (start + timedelta(days=365)).isoformat(),
+        'company_name': company,
+        'city': city,
+        'postal_code': postal_code,
+        'address': f"{rnd.choice(STREETS)} {rnd.randint(1, 180)}",
+        'eik': make_eik(rnd),
+        'vat_registered': rnd.choice(["Да", "Не"]),
+        'mol': make_person(rnd),
+        'phone1': make_phone(rnd),
+        'phone2': make_phone(rnd) if rnd.random() < 0.3 else "",
+    }
+
+
+def make_device(rnd, n, client, today):
+    model, prefix, cert = rnd.choice(MODELS)
+    business = rnd.choice(BUSINESSES)
+    return {
+        'fdrid': str(4_000_000 + n),
+        'euro_done': rnd.random() < 0.6,
+        'object_name': f"{business} {rnd.choice(COMPANY_WORDS)}",
+        'object_address': f"гр. {client['city']}, {rnd.choice(STREETS)} {rnd.randint(1, 180)}",
+        'object_phone': make_phone(rnd) if rnd.random() < 0.5 else "",
+        'model': model,
+        'certificate_number': f"{cert}/{rnd.randint(2018, 2025)}",
+        'certificate_expiry': (today + timedelta(days=rnd.randint(-200, 1500))).isoformat(),
+        'serial_number': f"{prefix}{n:06d}" if n < 1_000_000 else f"{prefix}{n:07d}",
+        'fiscal_memory': str(50_000_000 + n),
+        'nra_report_enabled': rnd.random() < 0.9,
+        'maintenance_price': rnd.choice([60, 80, 100, 120, 150]),
+    }
+
+
+def generate_dataset(path, device_count, seed=42, progress=True):
+    """Create (or overwrite) path and fill it with device_count devices.
+
+    Returns a dict with row counts and the build time in seconds.
+    """
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    database.set_db_path(path)
+    database.init_db()
+
+    rnd = random.Random(seed)
+    today = date.today()
+    start = time.perf_counter()
+    contract_number = 0
+    devices_done = 0
+    client_count = 0
+
+    while devices_done < device_count:
+        chunk = min(CHUNK, device_count - devices_done)
+        clients = []
+        per_client = []
+        planned = 0
+        # 1-4 devices per contract, most contracts have one
+        while planned < chunk:
+            contract_number += 1
+            clients.append(make_client(rnd, contract_number, today))
+            n = min(rnd.choice([1, 1, 1, 1, 2, 2, 3, 4]), chunk - planned)
+            per_client.append(n)
+            planned += n
+        with database.transaction():
+            client_ids = database.add_clients_bulk(clients)
+            devices = []
+            for client_id, client, n in zip(client_ids, clients, per_client):
+                for _ in range(n):
+                    devices.append((client_id, make_device(rnd, devices_done + len(devices) + 1, client, today)))
+            database.add_devices_bulk(devices)
+        devices_done += chunk
+        client_count += len(clients)
+        if progress:
+            print(f"\r  {devices_done:>9} / {device_count} devices", end="", flush=True)
+    if progress:
+        print()
+
+    con = database.get_connection()
+    audit_rows = device_count // 2
+    repair_rows = device_count // 10
+    with database.transaction():
+        con.executemany("INSERT OR IGNORE INTO certificates (number, expiry_date) VALUES (?, ?)", [
+            (f"{cert}/{year}", date(year + 5, 12, 31).isoformat())
+            for _, _, cert in MODELS for year in range(2018, 2026)
+        ])
+        con.executemany("""
+            INSERT INTO audit_logs (user_id, username, action, details, timestamp, contract_number, device_id)
+            VALUES (1, 'vladpos', ?, ?, ?, ?, ?)
+        """, (
+            (rnd.choice(AUDIT_ACTIONS), f"Автоматичен запис {i}",
+             f"{today - timedelta(days=rnd.randint(0, 1000))} {rnd.randint(8, 18):02d}:{rnd.randint(0, 59):02d}:00",
+             str(rnd.randint(1, contract_number)), rnd.randint(1, device_count))
+            for i in range(audit_rows)
+        ))
+        con.executemany("""
+            INSERT INTO repair_history (device_id, problem_description, repair_date, protocol_path)
+            VALUES (?, ?, ?, '')
+        """, (
+            (rnd.randint(1, device_count), rnd.choice(PROBLEMS),
+             (today - timedelta(days=rnd.randint(0, 1000))).isoformat())
+            for _ in range(repair_rows)
+        ))
+    database.checkpoint_database()
+
+    return {
+        'devices': device_count,
+        'clients': client_count,
+        'audit_logs': audit_rows,
+        'repair_history': repair_rows,
+        'build_seconds': round(time.perf_counter() - start, 2),
+        'size_bytes': os.path.getsize(path),
+    }
+
+
+def main():
+    args = sys.argv[1:]
+    seed = 42
+    if "--seed" in args:
+        i = args.index("--seed")
+        seed = int(args[i + 1])
+        del args[i:i + 2]
+    if not args:
+        print(__doc__)
+        sys.exit(1)
+
+    device_count = int(args[0])
+    path = args[1] if len(args) > 1 else os.path.join(tempfile.gettempdir(), f"contracts_{device_count}.db")
+    print(f"Generating {device_count} devices into {path}...")
+    info = generate_dataset(path, device_count, seed)
+    database.close_connections()
+    print(f"{info['clients']} clients, {info['devices']} devices, {info['audit_logs']} audit rows, "
+          f"{info['repair_history']} repairs in {info['build_seconds']} s ({info['size_bytes'] / 1e6:.1f} MB)")
+
+
+if __name__ == "__main__":
+    main()
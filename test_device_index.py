@@ -0,0 +1,97 @@
+"""
+Interrupt check for the resident DeviceIndex in Contracts_App_Pro/src/database.py.
+
+DeviceLoadTask.cancel() interrupts the worker connection, which can hit a
+refresh halfway through its fetches. The index must then keep its previous
+state (same position, same results) and catch up on the next refresh.
+
+Usage:
+    python test_device_index.py   (or: python -m pytest test_device_index.py)
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+
+# Add src to path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "Contracts_App_Pro", "src"))
+
+import database
+from bench_db import build_database
+
+FILTERS = [{'model': 'Datecs'}, {'model': 'Tremol'}, {'serial': 'ZK'}, {}]
+
+
+def snapshot(index):
+    return (index.last_seq, set(index._stale), dict(index._overlay),
+            [sorted(index._search(filters)) for filters in FILTERS])
+
+
+def interrupt_after(con, steps):
+    """Progress handler that aborts the running statement after steps callbacks"""
+    calls = [0]
+
+    def handler():
+        calls[0] += 1
+        return 1 if calls[0] > steps else 0
+
+    con.set_progress_handler(handler, 100)
+
+
+def check_interrupted_refresh(device_count, changes):
+    with tempfile.TemporaryDirectory() as tmp:
+        build_database(os.path.join(tmp, "index.db"), device_count)
+        con = database.get_connection()
+        index = database.DeviceIndex()
+
+        for sql in changes:
+            con.execute(sql)
+        con.commit()
+        before = snapshot(index)
+
+        interrupted = 0
+        steps = 0
+        while True:
+            interrupt_after(con, steps)
+            try:
+                index.refresh()
+                break
+            except sqlite3.OperationalError:
+                interrupted += 1
+                assert snapshot(index) == before
+            finally:
+                con.set_progress_handler(None, 0)
+            steps = steps * 3 // 2 + 1
+        assert interrupted > 1
+
+        fresh = database.DeviceIndex()
+        assert index.last_seq == database.get_change_seq()
+        for filters in FILTERS:
+            assert sorted(index.search(filters)) == sorted(fresh.search(filters))
+
+        database.close_connections()
+        return index
+
+
+def test_interrupted_overlay_refresh_keeps_previous_state():
+    # Two fetch chunks, still small enough for the overlay
+    index = check_interrupted_refresh(12000, [
+        "UPDATE devices SET model = 'Datecs' WHERE id % 22 = 0",
+        "DELETE FROM devices WHERE id % 997 = 0",
+    ])
+    assert index._overlay
+
+
+def test_interrupted_rebuild_keeps_previous_state():
+    # Too many changes for the overlay: the refresh rebuilds
+    index = check_interrupted_refresh(2000, [
+        "UPDATE devices SET model = 'Datecs' WHERE id % 3 = 0",
+        "DELETE FROM devices WHERE id % 7 = 0",
+    ])
+    assert not index._overlay and not index._stale
+
+
+if __name__ == "__main__":
+    test_interrupted_overlay_refresh_keeps_previous_state()
+    test_interrupted_rebuild_keeps_previous_state()
+    print("OK")
@@ -0,0 +1,96 @@
+"""
+Checks behind the row-level table patching in Contracts_App_Pro/src/main.py.
+
+- ChangeWatcher.advance() after an own write: a later poll() reports only
+  what other connections committed, not the own write again.
+- device_row_key / search_row_key sort rows exactly like the queries that
+  load the table, so patched-in rows land where a reload would put them.
+
+Usage:
+    python test_row_patching.py   (or: python -m pytest test_row_patching.py)
+"""
+import os
+import random
+import sys
+import tempfile
+import threading
+
+# Add src to path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "Contracts_App_Pro", "src"))
+
+import database
+from bench_db import build_database
+
+
+def in_other_connection(func):
+    """Run func on a worker thread, i.e. on that thread's own connection"""
+    errors = []
+
+    def run():
+        try:
+            func()
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+    if errors:
+        raise errors[0]
+
+
+def test_own_write_is_not_reported_as_external():
+    with tempfile.TemporaryDirectory() as tmp:
+        build_database(os.path.join(tmp, "watch.db"), 30)
+        watcher = database.ChangeWatcher()
+
+        # Own write on the UI (main thread) connection
+        client_id = database.add_client({'contract_number': '500', 'company_name': 'Нова ЕООД'})
+        own_id = database.add_device(client_id, {'model': 'Tremol', 'serial_number': 'ZK500'})
+        changed, deleted = watcher.advance()
+        assert own_id in changed and not deleted
+        assert watcher.poll() is None
+
+        # Audit entries are committed by their writer thread: no device change
+        database.log_action(1, 'admin', 'ADD_DEVICE', f"Added new device ID {own_id}", device_id=own_id)
+        database.flush_audit_log()
+        assert watcher.poll() is None
+
+        # Another workstation edits a different device
+        other_id = 7
+        device = database.get_device_full(other_id)
+        in_other_connection(lambda: database.update_device(other_id, device.as_dict(), {
+            **device.as_dict(), 'model': 'Datecs'}))
+        changes = watcher.poll()
+        assert changes is not None
+        changed, deleted = changes
+        assert own_id not in changed and not deleted
+        assert other_id in changed
+
+        database.close_connections()
+
+
+def test_row_keys_match_load_order():
+    with tempfile.TemporaryDirectory() as tmp:
+        build_database(os.path.join(tmp, "order.db"), 300)
+        # Contract numbers the integer key treats specially
+        for number in ['abc', ' 7', '12a', '-3', '', '0', '007', 'Я1', '100', '99']:
+            client_id = database.add_client({'contract_number': number, 'company_name': 'Ред ООД'})
+            database.add_device(client_id, {'model': 'Tremol'})
+        database.clear_query_cache()
+
+        rows = database.get_all_devices()
+        shuffled = random.Random(1).sample(rows, len(rows))
+        assert sorted(shuffled, key=database.device_row_key) == rows
+
+        found = database.search_devices({'company': 'ООД'})
+        shuffled = random.Random(2).sample(found, len(found))
+        assert sorted(shuffled, key=database.search_row_key) == found
+
+        database.close_connections()
+
+
+if __name__ == "__main__":
+    test_own_write_is_not_reported_as_external()
+    test_row_keys_match_load_order()
+    print("OK")
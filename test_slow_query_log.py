@@ -0,0 +1,70 @@
+"""
+Slow-query log check for Contracts_App_Pro/src/database.py diagnostics.
+
+A statement is slowed down with a progress handler that sleeps, so the
+call crosses the threshold; the log entry must name the call and the SQL
+of the slow statement with its own time.
+
+Usage:
+    python test_slow_query_log.py   (or: python -m pytest test_slow_query_log.py)
+"""
+import os
+import sys
+import tempfile
+import time
+
+# Add src to path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "Contracts_App_Pro", "src"))
+
+import database
+from bench_db import build_database
+
+THRESHOLD_MS = 20
+COUNT_SQL = "SELECT COUNT(*) FROM devices d JOIN clients c ON c.id = d.client_id"
+
+
+def read_log():
+    for handler in database._slow_query_logger.handlers:
+        handler.flush()
+    with open(database.get_slow_query_log_path(), encoding="utf-8") as f:
+        return f.read()
+
+
+def test_slow_statement_is_logged_with_its_sql():
+    with tempfile.TemporaryDirectory() as tmp:
+        build_database(os.path.join(tmp, "slow.db"), 3000)
+        database.reset_query_stats()
+        database.enable_diagnostics(THRESHOLD_MS)
+        con = database.get_connection()
+        try:
+            # Fast call: nothing logged
+            database.get_change_seq()
+            assert "get_change_seq" not in read_log()
+
+            # ~1 ms every 100 VM instructions: the COUNT over 3000 devices takes well over the threshold
+            con.set_progress_handler(lambda: time.sleep(0.001) or 0, 100)
+            database.get_device_count()
+        finally:
+            con.set_progress_handler(None, 0)
+            database.disable_diagnostics()
+
+        log = read_log()
+        assert "get_device_count()" in log
+        statement_lines = [line for line in log.splitlines() if line.strip().endswith(COUNT_SQL)]
+        assert statement_lines, log
+        statement_ms = float(statement_lines[-1].split("ms")[0])
+        assert statement_ms >= THRESHOLD_MS
+
+        stats = {entry['name']: entry for entry in database.get_statement_stats()}
+        assert stats[COUNT_SQL]['max_ms'] >= THRESHOLD_MS
+        assert "SELECT MAX(seq) FROM change_log" in stats
+
+        database.close_connections()
+        for handler in list(database._slow_query_logger.handlers):
+            database._slow_query_logger.removeHandler(handler)
+            handler.close()
+
+
+if __name__ == "__main__":
+    test_slow_statement_is_logged_with_its_sql()
+    print("OK")